@@ -1,7 +1,7 @@
 import io
 from abc import ABC, abstractmethod
 from enum import Enum
-from typing import Any, Dict, Generator, List, Optional, Union
+from typing import Any, Dict, Generator, Iterable, List, Optional, Union
 
 from labmachine import types
 
@@ -205,13 +205,34 @@ class StorageSpec(ABC):
     ) -> List[types.Blob]:
         pass
 
+    @abstractmethod
+    def iter_pages(
+        self,
+        prefix: Optional[str] = None,
+        page_size: int = 1000,
+        page_token: Optional[str] = None,
+        history: bool = False,
+    ) -> Generator[types.BlobsPage, None, None]:
+        pass
+
+    @abstractmethod
+    def iter_objects(
+        self,
+        prefix: Optional[str] = None,
+        page_size: int = 1000,
+        page_token: Optional[str] = None,
+        history: bool = False,
+    ) -> Generator[types.Blob, None, None]:
+        pass
+
     @abstractmethod
     def put_bytes(
         self,
         key: str,
         *,
-        content: Union[bytes, io.BytesIO],
+        content: Union[bytes, bytearray, memoryview, io.BytesIO],
         metadata: Optional[Dict[str, str]] = None,
+        content_type: Optional[str] = None,
     ) -> types.Blob:
         pass
 
@@ -224,6 +245,30 @@ class StorageSpec(ABC):
     ) -> bool:
         pass
 
+    @abstractmethod
+    def upload_dir(
+        self,
+        local_dir: str,
+        prefix: str = "",
+        bucket=None,
+        workers: int = 8,
+        executor: Optional[str] = None,
+        manifest: Optional[str] = None,
+    ) -> types.TransferReport:
+        pass
+
+    @abstractmethod
+    def download_dir(
+        self,
+        prefix: str,
+        local_dir: str,
+        bucket=None,
+        workers: int = 8,
+        executor: Optional[str] = None,
+        manifest: Optional[str] = None,
+    ) -> types.TransferReport:
+        pass
+
     @abstractmethod
     def get_bytes(self, key: str, version=None) -> bytes:
         pass
@@ -244,6 +289,12 @@ class StorageSpec(ABC):
     ) -> List[types.Blob]:
         pass
 
+    @abstractmethod
+    def iter_history(
+        self, key: str, page_size: int = 1000
+    ) -> Generator[types.Blob, None, None]:
+        pass
+
     @abstractmethod
     def recover_blob(self, key: str, version=None):
         pass
@@ -260,6 +311,17 @@ class StorageSpec(ABC):
     def download_signed(self, key, minutes=15, bucket=None):
         pass
 
+    @abstractmethod
+    def sign_many(
+        self,
+        keys: Iterable[str],
+        method: str = "GET",
+        minutes: int = 15,
+        bucket=None,
+        content_type: Optional[str] = None,
+    ) -> List[str]:
+        pass
+
     @abstractmethod
     def upload_signed(
         self, key, minutes=15, bucket=None, content_type="application/octed-stream"
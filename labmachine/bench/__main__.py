@@ -0,0 +1,73 @@
+import json
+import platform
+import sys
+from datetime import datetime, timezone
+
+import click
+
+from labmachine.bench import kv as kvbench
+
+
+def _version() -> str:
+    try:
+        from importlib.metadata import version
+        return version("labmachine")
+    except Exception:
+        return "unknown"
+
+
+def _ints(value: str):
+    return [int(v) for v in value.split(",") if v]
+
+
+@click.group()
+def cli():
+    """
+    labmachine benchmarks
+    """
+    pass
+
+
+@cli.command(name="kv")
+@click.option("--backends", "-b",
+              default="local,async-local,files,async-files,gcs,async-gcs",
+              help="Comma separated list of backends")
+@click.option("--small-count", default=500, help="Objects for small ops")
+@click.option("--small-size", default=1024, help="Size of small objects")
+@click.option("--large-size", default=32 * 1024 ** 2,
+              help="Size of the large object")
+@click.option("--chunk-sizes", default="65536,262144,1048576",
+              help="Chunk sizes for streaming")
+@click.option("--concurrency", default="1,4,16",
+              help="Concurrency levels for the sweep")
+@click.option("--output", "-o", default=None,
+              help="Write results as JSON into this file instead of stdout")
+def kv(backends, small_count, small_size, large_size, chunk_sizes,
+       concurrency, output):
+    """ Benchmark the io KV backends against local stand-ins """
+    results = kvbench.run(
+        [b for b in backends.split(",") if b],
+        small_count=small_count,
+        small_size=small_size,
+        large_size=large_size,
+        chunk_sizes=_ints(chunk_sizes),
+        concurrency=_ints(concurrency),
+    )
+    report = {
+        "meta": {
+            "labmachine": _version(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+        },
+        "results": results,
+    }
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    cli()
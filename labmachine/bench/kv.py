@@ -0,0 +1,276 @@
+"""
+Throughput and latency benchmarks for the KV stores of `labmachine.io`.
+Remote backends run against the local stand-ins of `servers.py`
+so results are reproducible without network or credentials.
+"""
+import asyncio
+import contextlib
+import inspect
+import os
+import tempfile
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from labmachine.io.kvspec import AsyncKVSpec, GenericKVSpec
+
+from .servers import FakeGCSServer, FilesServer
+
+_MB = 1024 ** 2
+
+SYNC_BACKENDS = {
+    "local": "labmachine.io.kv_local.KVLocal",
+    "files": "labmachine.io.kv_files.KVFiles",
+    "gcs": "labmachine.io.kv_gcs.KVGS",
+    "packed": "labmachine.io.kv_packed.KVPacked",
+}
+ASYNC_BACKENDS = {
+    "async-local": "labmachine.io.kv_local.AsyncKVLocal",
+    "async-files": "labmachine.io.kv_files.AsyncKVFiles",
+    "async-gcs": "labmachine.io.kv_gcs.AsyncKVGS",
+    "async-packed": "labmachine.io.kv_packed.AsyncKVPacked",
+    "async-native-gcs": "labmachine.io.kv_gcs_native.NativeAsyncKVGS",
+}
+
+
+@contextlib.contextmanager
+def environ(name: str, value: str) -> Iterator[None]:
+    """ Sets an environment variable, the previous value is restored on exit """
+    previous = os.environ.get(name)
+    os.environ[name] = value
+    try:
+        yield
+    finally:
+        if previous is None:
+            os.environ.pop(name, None)
+        else:
+            os.environ[name] = previous
+
+
+class StandIns:
+    """
+    Starts the local servers only when a backend needs them,
+    everything is stopped (and the environment restored) on `close`.
+    """
+
+    def __init__(self):
+        self.tmpdir = tempfile.TemporaryDirectory(prefix="labmachine-bench-")
+        self._files: Optional[FilesServer] = None
+        self._gcs: Optional[FakeGCSServer] = None
+        self._env = contextlib.ExitStack()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def store_args(self, backend: str):
+        """ bucket and client_opts for a backend """
+        kind = backend.rsplit("-", 1)[-1]
+        if kind == "local":
+            return f"{self.tmpdir.name}/{backend}", {}
+        if kind == "packed":
+            return f"{self.tmpdir.name}/{backend}", {"maintenance_interval": 0}
+        if kind == "files":
+            if not self._files:
+                self._files = FilesServer().start()
+            return backend, {"url": self._files.url}
+        if not self._gcs:
+            self._gcs = FakeGCSServer(buckets=("bench",)).start()
+            self._env.enter_context(
+                environ("STORAGE_EMULATOR_HOST", self._gcs.url))
+        return "bench", {"project": "bench"}
+
+    def close(self):
+        self._env.close()
+        for server in (self._files, self._gcs):
+            if server:
+                server.stop()
+        self.tmpdir.cleanup()
+
+
+def _percentile(values: List[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[int(p * (len(ordered) - 1))]
+
+
+def _latency_result(backend: str, bench: str, latencies: List[float],
+                    **params) -> Dict[str, Any]:
+    total = sum(latencies)
+    return {
+        "backend": backend,
+        "bench": bench,
+        "params": params,
+        "seconds": round(total, 6),
+        "ops_per_sec": round(len(latencies) / total, 2) if total else None,
+        "p50_ms": round(_percentile(latencies, 0.5) * 1000, 3),
+        "p99_ms": round(_percentile(latencies, 0.99) * 1000, 3),
+    }
+
+
+def _throughput_result(backend: str, bench: str, nbytes: int,
+                       seconds: float, **params) -> Dict[str, Any]:
+    return {
+        "backend": backend,
+        "bench": bench,
+        "params": params,
+        "seconds": round(seconds, 6),
+        "mb_per_sec": round(nbytes / _MB / seconds, 2) if seconds else None,
+    }
+
+
+def _accepts_chunk_size(method: Callable) -> bool:
+    return "chunk_size" in inspect.signature(method).parameters
+
+
+def _chunks(payload: bytes, chunk_size: int):
+    for ix in range(0, len(payload), chunk_size):
+        yield payload[ix:ix + chunk_size]
+
+
+async def _achunks(payload: bytes, chunk_size: int):
+    for ix in range(0, len(payload), chunk_size):
+        yield payload[ix:ix + chunk_size]
+
+
+def run_sync(backend: str, store: GenericKVSpec, small_count: int,
+             small_size: int, large_size: int, chunk_sizes: List[int],
+             concurrency: List[int]) -> List[Dict[str, Any]]:
+    results = []
+    small = os.urandom(small_size)
+    keys = [f"small/{i}" for i in range(small_count)]
+
+    for bench, func in (("small_put", lambda k: store.put(k, small)),
+                        ("small_get", store.get)):
+        latencies = []
+        for key in keys:
+            start = time.perf_counter()
+            func(key)
+            latencies.append(time.perf_counter() - start)
+        results.append(_latency_result(backend, bench, latencies,
+                                       count=small_count, size=small_size))
+
+    large = os.urandom(large_size)
+    start = time.perf_counter()
+    store.put("large", large)
+    results.append(_throughput_result(backend, "large_put", large_size,
+                                      time.perf_counter() - start,
+                                      size=large_size))
+    start = time.perf_counter()
+    store.get("large")
+    results.append(_throughput_result(backend, "large_get", large_size,
+                                      time.perf_counter() - start,
+                                      size=large_size))
+
+    for chunk_size in chunk_sizes:
+        start = time.perf_counter()
+        store.put_stream("stream", _chunks(large, chunk_size))
+        results.append(_throughput_result(backend, "stream_put", large_size,
+                                          time.perf_counter() - start,
+                                          size=large_size, chunk_size=chunk_size))
+        kwargs = {"chunk_size": chunk_size} \
+            if _accepts_chunk_size(store.get_stream) else {}
+        start = time.perf_counter()
+        for _ in store.get_stream("stream", **kwargs):
+            pass
+        results.append(_throughput_result(backend, "stream_get", large_size,
+                                          time.perf_counter() - start,
+                                          size=large_size, chunk_size=chunk_size))
+
+    for workers in concurrency:
+        start = time.perf_counter()
+        store.get_many(keys, workers=workers)
+        elapsed = time.perf_counter() - start
+        results.append({
+            "backend": backend, "bench": "concurrent_get",
+            "params": {"count": small_count, "size": small_size,
+                       "concurrency": workers},
+            "seconds": round(elapsed, 6),
+            "ops_per_sec": round(small_count / elapsed, 2)})
+    return results
+
+
+async def run_async(backend: str, store: AsyncKVSpec, small_count: int,
+                    small_size: int, large_size: int, chunk_sizes: List[int],
+                    concurrency: List[int]) -> List[Dict[str, Any]]:
+    results = []
+    small = os.urandom(small_size)
+    keys = [f"small/{i}" for i in range(small_count)]
+
+    async def _put(key):
+        await store.put(key, small)
+
+    for bench, func in (("small_put", _put), ("small_get", store.get)):
+        latencies = []
+        for key in keys:
+            start = time.perf_counter()
+            await func(key)
+            latencies.append(time.perf_counter() - start)
+        results.append(_latency_result(backend, bench, latencies,
+                                       count=small_count, size=small_size))
+
+    large = os.urandom(large_size)
+    start = time.perf_counter()
+    await store.put("large", large)
+    results.append(_throughput_result(backend, "large_put", large_size,
+                                      time.perf_counter() - start,
+                                      size=large_size))
+    start = time.perf_counter()
+    await store.get("large")
+    results.append(_throughput_result(backend, "large_get", large_size,
+                                      time.perf_counter() - start,
+                                      size=large_size))
+
+    for chunk_size in chunk_sizes:
+        start = time.perf_counter()
+        await store.put_stream("stream", _achunks(large, chunk_size))
+        results.append(_throughput_result(backend, "stream_put", large_size,
+                                          time.perf_counter() - start,
+                                          size=large_size, chunk_size=chunk_size))
+        kwargs = {"chunk_size": chunk_size} \
+            if _accepts_chunk_size(store.get_stream) else {}
+        start = time.perf_counter()
+        async for _ in store.get_stream("stream", **kwargs):
+            pass
+        results.append(_throughput_result(backend, "stream_get", large_size,
+                                          time.perf_counter() - start,
+                                          size=large_size, chunk_size=chunk_size))
+
+    for conc in concurrency:
+        start = time.perf_counter()
+        await store.get_many(keys, concurrency=conc)
+        elapsed = time.perf_counter() - start
+        results.append({
+            "backend": backend, "bench": "concurrent_get",
+            "params": {"count": small_count, "size": small_size,
+                       "concurrency": conc},
+            "seconds": round(elapsed, 6),
+            "ops_per_sec": round(small_count / elapsed, 2)})
+    return results
+
+
+async def _run_async_backend(backend: str, bucket: str, opts: Dict[str, Any],
+                             **params) -> List[Dict[str, Any]]:
+    store = AsyncKVSpec.create(ASYNC_BACKENDS[backend], bucket, opts)
+    try:
+        return await run_async(backend, store, **params)
+    finally:
+        await store.close()
+
+
+def run(backends: List[str], **params) -> List[Dict[str, Any]]:
+    """ Run every benchmark for each backend given """
+    results: List[Dict[str, Any]] = []
+    with StandIns() as stand_ins:
+        for backend in backends:
+            bucket, opts = stand_ins.store_args(backend)
+            if backend in SYNC_BACKENDS:
+                with GenericKVSpec.create(SYNC_BACKENDS[backend],
+                                          bucket, opts) as store:
+                    results.extend(run_sync(backend, store, **params))
+            elif backend in ASYNC_BACKENDS:
+                results.extend(asyncio.run(
+                    _run_async_backend(backend, bucket, opts, **params)))
+            else:
+                raise KeyError(f"Unknown backend {backend}")
+    return results
@@ -0,0 +1,511 @@
+"""
+Local stand-ins used to benchmark the KV stores offline:
+
+- `FilesServer`: a http files server like the one used by `KVFiles`
+- `FakeGCSServer`: the subset of the GCS JSON API used by `KVGS`,
+  google-cloud-storage talks to it through STORAGE_EMULATOR_HOST.
+
+Both keep the data in memory and only one version of each object,
+unless `FakeGCS` is created with `versioning=True`.
+"""
+import base64
+import hashlib
+import json
+import threading
+from datetime import datetime, timezone
+from email.parser import BytesParser
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from labmachine.utils import generate_random
+
+try:
+    import google_crc32c
+except ImportError:
+    google_crc32c = None
+
+Response = Tuple[int, Dict[str, str], bytes]
+
+
+def _read_body(handler: BaseHTTPRequestHandler) -> bytes:
+    if handler.headers.get("Transfer-Encoding", "").lower() == "chunked":
+        chunks = []
+        while True:
+            size = int(handler.rfile.readline().split(b";")[0].strip(), 16)
+            if size == 0:
+                handler.rfile.readline()
+                break
+            chunks.append(handler.rfile.read(size))
+            handler.rfile.readline()
+        return b"".join(chunks)
+    length = int(handler.headers.get("Content-Length") or 0)
+    return handler.rfile.read(length)
+
+
+class _StandIn:
+    """ A threaded http server listening on a random local port """
+
+    handler_class: Any = None
+
+    def __init__(self):
+        self.httpd: Optional[ThreadingHTTPServer] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _make_handler(self):
+        return self.handler_class
+
+    def start(self) -> "_StandIn":
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), self._make_handler())
+        self.httpd.daemon_threads = True
+        thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are written apart, avoid delayed ACK stalls
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, rsp: Response, head: bool = False):
+        status, headers, body = rsp
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        if "Content-Length" not in headers:
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body and not head:
+            self.wfile.write(body)
+
+
+class FilesServer(_StandIn):
+    """
+    PUT/GET/HEAD/DELETE of files with ETag and If-None-Match support,
+    GET of a folder (ending with "/") returns its json index.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.files: Dict[str, Tuple[bytes, str, str]] = {}
+        self._lock = threading.Lock()
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(_Handler):
+
+            def _index(self):
+                """ json index of a folder as nginx `autoindex_format json` """
+                entries: Dict[str, Dict[str, Any]] = {}
+                with server._lock:
+                    for path, (data, _, mtime) in server.files.items():
+                        if not path.startswith(self.path):
+                            continue
+                        name, sep, _ = path[len(self.path):].partition("/")
+                        entries[name] = {"name": name, "mtime": mtime,
+                                         "type": "directory"} if sep else {
+                            "name": name, "mtime": mtime, "type": "file",
+                            "size": len(data)}
+                if not entries:
+                    return self._reply((404, {}, b""))
+                body = json.dumps(list(entries.values())).encode()
+                self._reply((200, {"Content-Type": "application/json"}, body))
+
+            def _get(self, head=False):
+                if self.path.endswith("/") and not head:
+                    return self._index()
+                with server._lock:
+                    entry = server.files.get(self.path)
+                if entry is None:
+                    return self._reply((404, {}, b""))
+                data, etag, mtime = entry
+                headers = {"ETag": etag, "Last-Modified": mtime,
+                           "Content-Length": str(len(data))}
+                if self.headers.get("If-None-Match") == etag:
+                    headers["Content-Length"] = "0"
+                    return self._reply((304, headers, b""))
+                self._reply((200, headers, data), head=head)
+
+            def do_GET(self):
+                self._get()
+
+            def do_HEAD(self):
+                self._get(head=True)
+
+            def do_PUT(self):
+                data = _read_body(self)
+                etag = f'"{hashlib.md5(data).hexdigest()}"'
+                with server._lock:
+                    server.files[self.path] = (data, etag,
+                                               formatdate(usegmt=True))
+                self._reply((201, {"ETag": etag}, b""))
+
+            def do_DELETE(self):
+                with server._lock:
+                    entry = server.files.pop(self.path, None)
+                self._reply((204 if entry else 404, {}, b""))
+
+        return Handler
+
+
+def _multipart(content_type: str, body: bytes) -> List[bytes]:
+    """ contents of a multipart/related body as sent by google-resumable-media """
+    boundary = content_type.split("boundary=", 1)[1].strip('"')
+    contents = []
+    for part in body.split(b"--" + boundary.encode())[1:-1]:
+        _, _, content = part.partition(b"\r\n\r\n")
+        contents.append(content[:-2] if content.endswith(b"\r\n") else content)
+    return contents
+
+
+def _b64(digest: bytes) -> str:
+    return base64.b64encode(digest).decode()
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+
+
+def _order(resource: Dict[str, Any]) -> Tuple[str, int]:
+    return resource["name"], int(resource["generation"])
+
+
+def _json(status: int, data: Dict[str, Any]) -> Response:
+    return status, {"Content-Type": "application/json"}, json.dumps(data).encode()
+
+
+def _error(status: int, msg: str) -> Response:
+    return _json(status, {"error": {"code": status, "message": msg}})
+
+
+class FakeGCS:
+    """
+    In memory implementation of the GCS JSON API calls used by KVGS.
+    With `versioning` replaced and deleted objects are kept as noncurrent
+    versions in `history`, like in a bucket with object versioning.
+    """
+
+    def __init__(self, buckets=("bench",), versioning: bool = False):
+        self.buckets: Dict[str, Dict[str, Dict[str, Any]]] = {
+            b: {} for b in buckets}
+        self.versioning = versioning
+        self.history: Dict[str, Dict[str, List[Dict[str, Any]]]] = {
+            b: {} for b in buckets}
+        self.sessions: Dict[str, Dict[str, Any]] = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def _store(self, bucket: str, name: str, data: bytes,
+               meta: Dict[str, Any], md5: bool = True) -> Dict[str, Any]:
+        with self._lock:
+            self._generation += 1
+            now = _now()
+            resource = {
+                "kind": "storage#object",
+                "id": f"{bucket}/{name}/{self._generation}",
+                "name": name,
+                "bucket": bucket,
+                "generation": str(self._generation),
+                "metageneration": "1",
+                "contentType": meta.get("contentType",
+                                        "application/octet-stream"),
+                "size": str(len(data)),
+                "etag": f"E{self._generation}",
+                "timeCreated": now,
+                "updated": now,
+            }
+            # like GCS, composite objects don't have md5
+            if md5:
+                resource["md5Hash"] = _b64(hashlib.md5(data).digest())
+            if google_crc32c:
+                resource["crc32c"] = _b64(
+                    google_crc32c.value(data).to_bytes(4, "big"))
+            if meta.get("metadata"):
+                resource["metadata"] = meta["metadata"]
+            self._archive(bucket, name)
+            self.buckets[bucket][name] = {"data": data, "resource": resource}
+        return resource
+
+    def _archive(self, bucket: str, name: str):
+        """ the live object becomes noncurrent, called with the lock held """
+        obj = self.buckets[bucket].pop(name, None)
+        if obj is not None and self.versioning:
+            obj["resource"]["timeDeleted"] = _now()
+            self.history[bucket].setdefault(name, []).append(obj)
+
+    def _find(self, bucket: str, name: str,
+              generation: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        obj = self.buckets[bucket].get(name)
+        if generation is None:
+            return obj
+        for version in [obj] + self.history[bucket].get(name, []):
+            if version and version["resource"]["generation"] == generation:
+                return version
+        return None
+
+    def _delete(self, bucket: str, name: str, query) -> Response:
+        generation = query.get("generation")
+        with self._lock:
+            obj = self._find(bucket, name, generation)
+            if obj is None:
+                return _error(404, "Not found")
+            failed = self._precondition(obj, query)
+            if failed:
+                return failed
+            if obj is self.buckets[bucket].get(name):
+                if generation is None:
+                    self._archive(bucket, name)
+                else:
+                    # a specific generation is removed for good
+                    self.buckets[bucket].pop(name)
+            else:
+                self.history[bucket][name].remove(obj)
+        return 204, {}, b""
+
+    def _precondition(self, obj, query) -> Optional[Response]:
+        gen = int(obj["resource"]["generation"]) if obj else 0
+        match = query.get("ifGenerationMatch")
+        if match is not None and int(match) != gen:
+            return _error(412, "Precondition Failed")
+        not_match = query.get("ifGenerationNotMatch")
+        if not_match is not None and obj and int(not_match) == gen:
+            return 304, {}, b""
+        return None
+
+    def handle(self, method: str, url: str, headers, body: bytes) -> Response:
+        parts = urlsplit(url)
+        query = {k: v[0] for k, v in parse_qs(parts.query).items()}
+        path = [unquote(p) for p in parts.path.split("/")]
+        # ['', 'storage', 'v1', 'b', bucket, 'o', name, ...]
+        if parts.path == "/batch/storage/v1":
+            return self._batch(headers, body)
+        if path[1] == "download":
+            path = path[:1] + path[2:]
+            query["alt"] = "media"
+        if path[1] == "upload":
+            if method == "POST":
+                return self._upload(path[5], query, headers, body)
+            return self._resumable(query, headers, body)
+        if len(path) < 5 or path[4] not in self.buckets:
+            return _error(404, "Bucket not found")
+        bucket = path[4]
+        if len(path) == 5:
+            return _json(200, {"kind": "storage#bucket", "name": bucket,
+                               "id": bucket, "location": "US",
+                               "storageClass": "STANDARD",
+                               "timeCreated": _now()})
+        if len(path) == 6:
+            return self._list(bucket, query)
+        name = path[6]
+        if len(path) == 8 and path[7] == "compose":
+            return self._compose(bucket, name, query, body)
+        if len(path) == 12 and path[7] == "copyTo":
+            return self._copy(bucket, name, path[9], path[11], query, body)
+        if method == "DELETE":
+            return self._delete(bucket, name, query)
+        obj = self._find(bucket, name, query.get("generation"))
+        if obj is None:
+            return _error(404, "Not found")
+        failed = self._precondition(obj, query)
+        if failed:
+            return failed
+        if method == "PATCH":
+            obj["resource"].update(json.loads(body or b"{}"))
+            return _json(200, obj["resource"])
+        if query.get("alt") == "media":
+            return self._media(obj, headers)
+        return _json(200, obj["resource"])
+
+    def _media(self, obj, headers) -> Response:
+        data = obj["data"]
+        resource = obj["resource"]
+        rsp_headers = {
+            "Content-Type": resource["contentType"],
+            "x-goog-generation": resource["generation"],
+            "x-goog-metageneration": "1",
+            "x-goog-stored-content-length": resource["size"],
+            "ETag": resource["etag"],
+        }
+        hashes = [f"{k}={resource[f]}" for k, f in
+                  (("crc32c", "crc32c"), ("md5", "md5Hash")) if f in resource]
+        rng = headers.get("Range")
+        if rng and data:
+            start, _, end = rng.split("=", 1)[1].partition("-")
+            _start = int(start)
+            _end = min(int(end), len(data) - 1) if end else len(data) - 1
+            rsp_headers["Content-Range"] = f"bytes {_start}-{_end}/{len(data)}"
+            return 206, rsp_headers, data[_start:_end + 1]
+        if hashes:
+            rsp_headers["x-goog-hash"] = ",".join(hashes)
+        return 200, rsp_headers, data
+
+    def _list(self, bucket: str, query) -> Response:
+        """ versions are listed by name and then from the oldest """
+        prefix = query.get("prefix", "")
+        start = query.get("startOffset") or ""
+        end = query.get("endOffset")
+        size = int(query.get("maxResults", 1000))
+        # the token is the name and generation of the next item
+        token = query.get("pageToken")
+        after = ("", 0)
+        if token:
+            _name, _, gen = token.rpartition("#")
+            after = (_name, int(gen))
+        with self._lock:
+            objs = list(self.buckets[bucket].values())
+            if query.get("versions", "").lower() == "true":
+                for versions in self.history[bucket].values():
+                    objs.extend(versions)
+            items = sorted(
+                (o["resource"] for o in objs
+                 if o["resource"]["name"].startswith(prefix)
+                 and o["resource"]["name"] >= start
+                 and (end is None or o["resource"]["name"] < end)
+                 and _order(o["resource"]) >= after),
+                key=_order)[:size + 1]
+        rsp: Dict[str, Any] = {"kind": "storage#objects", "items": items[:size]}
+        if len(items) > size:
+            name, gen = _order(items[size])
+            rsp["nextPageToken"] = f"{name}#{gen}"
+        return _json(200, rsp)
+
+    def _upload(self, bucket: str, query, headers, body: bytes) -> Response:
+        if bucket not in self.buckets:
+            return _error(404, "Bucket not found")
+        kind = query.get("uploadType")
+        meta: Dict[str, Any] = {}
+        data = body
+        if kind == "multipart":
+            _meta, data = _multipart(headers.get("Content-Type"), body)
+            meta = json.loads(_meta)
+        elif kind == "resumable":
+            meta = json.loads(body or b"{}")
+        name = query.get("name") or meta.get("name")
+        obj = self.buckets[bucket].get(name)
+        failed = self._precondition(obj, query)
+        if failed:
+            return failed
+        if kind == "resumable":
+            upload_id = generate_random(16)
+            self.sessions[upload_id] = {"bucket": bucket, "name": name,
+                                        "meta": meta, "data": bytearray()}
+            location = (f"http://{headers.get('Host', '')}"
+                        f"/upload/storage/v1/b/{bucket}/o?"
+                        f"uploadType=resumable&upload_id={upload_id}")
+            return 200, {"Location": location}, b""
+        return _json(200, self._store(bucket, name, data, meta))
+
+    def _resumable(self, query, headers, body: bytes) -> Response:
+        session = self.sessions.get(query.get("upload_id"))
+        if session is None:
+            return _error(404, "Upload session not found")
+        session["data"] += body
+        # Content-Range: bytes 0-99/* | bytes 0-99/100 | bytes */100
+        total = headers.get("Content-Range", "*/*").rsplit("/", 1)[1]
+        if total == "*":
+            received = len(session["data"])
+            rsp_headers = {"Range": f"bytes=0-{received - 1}"} if received else {}
+            return 308, rsp_headers, b""
+        self.sessions.pop(query["upload_id"])
+        return _json(200, self._store(session["bucket"], session["name"],
+                                      bytes(session["data"]), session["meta"]))
+
+    def _compose(self, bucket: str, name: str, query, body: bytes) -> Response:
+        req = json.loads(body)
+        datas = []
+        for src in req.get("sourceObjects", []):
+            obj = self.buckets[bucket].get(src["name"])
+            if obj is None:
+                return _error(404, f"Source {src['name']} not found")
+            datas.append(obj["data"])
+        failed = self._precondition(self.buckets[bucket].get(name), query)
+        if failed:
+            return failed
+        return _json(200, self._store(bucket, name, b"".join(datas),
+                                      req.get("destination", {}), md5=False))
+
+    def _copy(self, bucket: str, name: str, dest_bucket: str, dest: str,
+              query, body: bytes) -> Response:
+        if dest_bucket not in self.buckets:
+            return _error(404, "Bucket not found")
+        obj = self._find(bucket, name, query.get("sourceGeneration"))
+        if obj is None:
+            return _error(404, "Not found")
+        meta = {k: v for k, v in obj["resource"].items()
+                if k in ("contentType", "metadata")}
+        meta.update(json.loads(body or b"{}"))
+        return _json(200, self._store(dest_bucket, dest, obj["data"], meta,
+                                      md5="md5Hash" in obj["resource"]))
+
+    def _batch(self, headers, body: bytes) -> Response:
+        ctype = headers.get("Content-Type")
+        msg = BytesParser().parsebytes(
+            b"Content-Type: " + ctype.encode() + b"\r\n\r\n" + body)
+        boundary = f"batch_{generate_random(12)}"
+        out = []
+        for ix, part in enumerate(msg.get_payload()):
+            raw = part.get_payload(decode=True).replace(b"\r\n", b"\n")
+            head, _, sub_body = raw.partition(b"\n\n")
+            lines = head.decode().split("\n")
+            sub_method, sub_url, _ = lines[0].split(" ", 2)
+            sub_headers = dict(line.split(": ", 1) for line in lines[1:] if line)
+            status, rsp_headers, rsp_body = self.handle(
+                sub_method, sub_url, sub_headers, sub_body)
+            rsp_lines = [f"HTTP/1.1 {status} X"]
+            rsp_lines += [f"{k}: {v}" for k, v in rsp_headers.items()]
+            out.append(
+                f"--{boundary}\r\nContent-Type: application/http\r\n"
+                f"Content-ID: <response-{ix}>\r\n\r\n" +
+                "\r\n".join(rsp_lines) + "\r\n\r\n" + rsp_body.decode() + "\r\n")
+        out.append(f"--{boundary}--\r\n")
+        return 200, {"Content-Type": f"multipart/mixed; boundary={boundary}"}, \
+            "".join(out).encode()
+
+
+class FakeGCSServer(_StandIn):
+    """
+    Serves a `FakeGCS`, point google-cloud-storage to it with:
+
+        os.environ["STORAGE_EMULATOR_HOST"] = server.url
+    """
+
+    def __init__(self, buckets=("bench",), versioning: bool = False):
+        super().__init__()
+        self.gcs = FakeGCS(buckets, versioning)
+
+    def _make_handler(self):
+        gcs = self.gcs
+
+        class Handler(_Handler):
+
+            def _handle(self):
+                body = _read_body(self)
+                self._reply(gcs.handle(self.command, self.path,
+                                       self.headers, body),
+                            head=self.command == "HEAD")
+
+            do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = do_HEAD = _handle
+
+        return Handler
@@ -77,6 +77,12 @@ def helper():
     pass
 
 
+@click.group()
+def data():
+    """ data stores operations """
+    pass
+
+
 @cli.command(name="init")
 @click.option("--project", "-p", default="default", help="Project")
 @click.option("--compute-provider", "-C", default="gce",
@@ -559,11 +565,109 @@ def snapshot_destroy(state, name):
         console.print(f"[green]Snapshot {name} destroyed.[/]")
 
 
+@data.command(name="reshard")
+@click.argument("path")
+@click.option("--levels", "-L", default=2, type=int,
+              help="Levels of the new layout, 0 for a flat layout")
+@click.option("--width", "-W", default=2, type=int,
+              help="Hex chars of each level of the new layout")
+@click.option("--from-levels", default=0, type=int,
+              help="Levels of the current layout, 0 for a flat layout")
+@click.option("--from-width", default=2, type=int,
+              help="Hex chars of each level of the current layout")
+def data_reshard(path, levels, width, from_levels, from_width):
+    """ move a local store in place to another layout """
+    from labmachine.io.kv_local import reshard
+
+    _confirm = Confirm.ask(f"Do you want to reshard {path}?")
+    if _confirm:
+        with progress:
+            task = progress.add_task(f"Resharding {path}")
+
+            def _moved(n):
+                progress.update(task, description=f"Resharding {path}: "
+                                f"{n} keys moved")
+
+            moved = reshard(path, levels, width if levels else 0,
+                            from_levels, from_width if from_levels else 0,
+                            progress=_moved)
+        console.print(f"[green]{moved} keys moved.[/]")
+
+
+def _transfer_dir(direction, local_dir, url, workers, processes, manifest):
+    from labmachine import executors
+    from labmachine.providers.google.storage import Storage
+
+    if not url.startswith("gs://"):
+        raise click.BadParameter(f"{url} should be like gs://bucket/prefix")
+    bucket, _, prefix = url[len("gs://"):].partition("/")
+    st = Storage(bucket, keyvar=defaults.JUP_COMPUTE_KEY)
+    executor = None
+    if processes:
+        executors.configure("transfer", max_workers=workers, kind="process")
+        executor = "transfer"
+    verb = "Pushing" if direction == "push" else "Pulling"
+    try:
+        with progress:
+            task = progress.add_task(f"{verb} {local_dir} <-> {url}")
+
+            def _update(rsp):
+                progress.update(
+                    task, description=f"{verb} {rsp.transferred} files, "
+                    f"{convert_size(rsp.bytes)} ({rsp.skipped} skipped)")
+
+            opts = dict(workers=workers, executor=executor,
+                        manifest=manifest, progress=_update)
+            if direction == "push":
+                rsp = st.upload_dir(local_dir, prefix, **opts)
+            else:
+                rsp = st.download_dir(prefix, local_dir, **opts)
+    finally:
+        executors.shutdown()
+    console.print(f"[green]{rsp.transferred} files transferred "
+                  f"({convert_size(rsp.bytes)}), {rsp.skipped} skipped.[/]")
+    if rsp.errors:
+        for rel, error in rsp.errors.items():
+            console.print(f"[red]{rel}: {error}[/]")
+        console.print(f"[red]{len(rsp.errors)} files failed, "
+                      "run it again to resume.[/]")
+        sys.exit(1)
+
+
+@data.command(name="push")
+@click.argument("local_dir", type=click.Path(exists=True, file_okay=False))
+@click.argument("url")
+@click.option("--workers", "-w", default=8, type=int,
+              help="Batches of files transferred concurrently")
+@click.option("--processes", "-P", is_flag=True, default=False,
+              help="Use a pool of processes instead of threads")
+@click.option("--manifest", "-m", default=None,
+              help="Where progress is kept to resume, by default in the dir")
+def data_push(local_dir, url, workers, processes, manifest):
+    """ upload a directory to gs://bucket/prefix """
+    _transfer_dir("push", local_dir, url, workers, processes, manifest)
+
+
+@data.command(name="pull")
+@click.argument("url")
+@click.argument("local_dir", type=click.Path(file_okay=False))
+@click.option("--workers", "-w", default=8, type=int,
+              help="Batches of files transferred concurrently")
+@click.option("--processes", "-P", is_flag=True, default=False,
+              help="Use a pool of processes instead of threads")
+@click.option("--manifest", "-m", default=None,
+              help="Where progress is kept to resume, by default in the dir")
+def data_pull(url, local_dir, workers, processes, manifest):
+    """ download gs://bucket/prefix into a directory """
+    _transfer_dir("pull", local_dir, url, workers, processes, manifest)
+
+
 if os.getenv("JUP_HELPERS"):
     cli.add_command(helpers)
 
 cli.add_command(volumes)
 cli.add_command(snapshot)
+cli.add_command(data)
 
 if __name__ == "__main__":
 
@@ -6,7 +6,7 @@ class BlobNotFound(Exception):
 
 class BucketNotFound(Exception):
     def __init__(self, bucket):
-        msg = f"{Bucket} not found"
+        msg = f"{bucket} not found"
         super().__init__(msg)
 
 
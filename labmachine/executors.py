@@ -0,0 +1,257 @@
+"""
+Named and bounded executors for blocking work called from async code.
+Each executor keeps metrics (queue depth, active workers, wait and run
+time histograms) so latency could be attributed to a pool:
+
+    from labmachine import executors
+
+    executors.configure("gcs", max_workers=64)
+    executors.configure("cpu", max_workers=4, kind="process")
+    await run_async(func, arg, executor="gcs")
+    executors.metrics()
+
+Functions sent to a process pool must be picklable (module level).
+Stores calling their own methods only accept thread pools, see `from_opts`.
+"""
+import bisect
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import (CancelledError, Executor, Future,
+                                ProcessPoolExecutor, ThreadPoolExecutor)
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+DEFAULT = "default"
+KINDS = ("thread", "process")
+# upper bounds in seconds of the histogram buckets, the last one is +Inf
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+class Histogram:
+    """ Cumulative histogram like prometheus ones """
+
+    def __init__(self, buckets: Tuple[float, ...] = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self) -> Dict[str, Any]:
+        cumulative, acc = {}, 0
+        for bound, n in zip([*map(str, self.buckets), "+Inf"], self.counts):
+            acc += n
+            cumulative[bound] = acc
+        return {"count": self.count, "sum": round(self.sum, 6),
+                "buckets": cumulative}
+
+
+# calls running in the pool of a worker process, see `_init_worker`
+_running = None
+
+
+def _init_worker(running):
+    global _running
+    _running = running
+
+
+def _timed(fn: Callable, args: tuple, kwargs: dict) -> Tuple[float, float, Any]:
+    """
+    Runs in the worker, it returns when the call started and ended
+    (wall clock, comparable between processes) along with the result.
+    """
+    started = time.time()
+    if _running is not None:
+        with _running.get_lock():
+            _running.value += 1
+    try:
+        result = fn(*args, **kwargs)
+    finally:
+        if _running is not None:
+            with _running.get_lock():
+                _running.value -= 1
+    return started, time.time(), result
+
+
+class MeteredExecutor(Executor):
+    """
+    A thread or process pool that keeps track of the calls submitted.
+    `queued` are calls waiting for a worker and `active` are running.
+    """
+
+    def __init__(self, name: str, max_workers: Optional[int] = None,
+                 kind: str = "thread"):
+        if kind == "thread":
+            self._pool: Executor = ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix=f"lab-{name}")
+        elif kind == "process":
+            # workers count the calls running, the pool doesn't tell
+            self._running = multiprocessing.Value("i", 0)
+            self._pool = ProcessPoolExecutor(
+                max_workers=max_workers, initializer=_init_worker,
+                initargs=(self._running,))
+        else:
+            raise ValueError(f"Executor kind {kind} not supported")
+        self.name = name
+        self.kind = kind
+        self.max_workers = self._pool._max_workers  # type: ignore
+        self.queued = 0
+        self.active = 0
+        self.completed = 0
+        self.failed = 0
+        self.wait = Histogram()
+        self.run = Histogram()
+        self._lock = threading.Lock()
+
+    def _thread_call(self, submitted: float, fn: Callable, args, kwargs):
+        started = time.time()
+        with self._lock:
+            self.queued -= 1
+            self.active += 1
+            self.wait.observe(started - submitted)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._lock:
+                self.active -= 1
+                self.run.observe(time.time() - started)
+
+    def _process_done(self, submitted: float, inner: Future, outer: Future):
+        with self._lock:
+            # `queued` counts the calls not done, see `metrics`
+            self.queued -= 1
+            error = CancelledError() if inner.cancelled() else inner.exception()
+            if error is None:
+                started, ended, result = inner.result()
+                self.wait.observe(max(started - submitted, 0.0))
+                self.run.observe(ended - started)
+                self.completed += 1
+            else:
+                self.failed += 1
+        if error is None:
+            outer.set_result(result)
+        else:
+            outer.set_exception(error)
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        submitted = time.time()
+        with self._lock:
+            self.queued += 1
+        if self.kind == "thread":
+            fut = self._pool.submit(self._thread_call, submitted, fn, args, kwargs)
+            fut.add_done_callback(self._count)
+            return fut
+        outer: Future = Future()
+        outer.set_running_or_notify_cancel()
+        inner = self._pool.submit(_timed, fn, args, kwargs)
+        inner.add_done_callback(
+            lambda f: self._process_done(submitted, f, outer))
+        return outer
+
+    def _count(self, fut: Future):
+        with self._lock:
+            if fut.cancelled():
+                self.queued -= 1
+            elif fut.exception() is not None:
+                self.failed += 1
+            else:
+                self.completed += 1
+
+    def shutdown(self, wait: bool = True, **kwargs):
+        self._pool.shutdown(wait=wait)
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            queued, active = self.queued, self.active
+            if self.kind == "process":
+                active = self._running.value
+                queued = max(queued - active, 0)
+            return {
+                "name": self.name,
+                "kind": self.kind,
+                "max_workers": self.max_workers,
+                "queued": queued,
+                "active": active,
+                "completed": self.completed,
+                "failed": self.failed,
+                "wait_seconds": self.wait.snapshot(),
+                "run_seconds": self.run.snapshot(),
+            }
+
+
+_executors: Dict[str, MeteredExecutor] = {}
+_lock = threading.Lock()
+
+
+def configure(name: str, max_workers: Optional[int] = None,
+              kind: str = "thread") -> MeteredExecutor:
+    """
+    Create or replace the executor `name`. A replaced executor finishes
+    the calls already submitted.
+    """
+    executor = MeteredExecutor(name, max_workers, kind)
+    with _lock:
+        old = _executors.pop(name, None)
+        _executors[name] = executor
+    if old:
+        old.shutdown(wait=False)
+    return executor
+
+
+def get(name: Optional[str] = None) -> MeteredExecutor:
+    """ The executor `name`, it's created with default params if missing """
+    _name = name or DEFAULT
+    with _lock:
+        executor = _executors.get(_name)
+        if executor is None:
+            executor = MeteredExecutor(_name, min(32, (os.cpu_count() or 1) + 4))
+            _executors[_name] = executor
+    return executor
+
+
+def from_opts(opts: Dict[str, Any], kinds: Sequence[str] = KINDS
+              ) -> Optional[str]:
+    """
+    Executor of a store from its `client_opts`:
+
+    :param executor: name of the executor, None for the default one
+    :param executor_workers: size of the pool, used when it's created
+    :param executor_kind: "thread" or "process" (default "thread")
+
+    Stores sending bound methods or closures pass `kinds=("thread",)`,
+    a ValueError is raised if the executor is of another kind.
+    """
+    name = opts.get("executor")
+    kind = opts.get("executor_kind", "thread")
+    with _lock:
+        executor = _executors.get(name or DEFAULT)
+        if executor is not None:
+            kind = executor.kind
+    if kind not in kinds:
+        raise ValueError(f"Executor {name} is a {kind} pool, "
+                         f"it should be one of {', '.join(kinds)}")
+    if name and opts.get("executor_workers"):
+        with _lock:
+            if name not in _executors:
+                _executors[name] = MeteredExecutor(
+                    name, opts["executor_workers"], kind)
+    return name
+
+
+def metrics() -> List[Dict[str, Any]]:
+    with _lock:
+        executors = list(_executors.values())
+    return [e.metrics() for e in executors]
+
+
+def shutdown(wait: bool = True):
+    with _lock:
+        executors = list(_executors.values())
+        _executors.clear()
+    for e in executors:
+        e.shutdown(wait=wait)
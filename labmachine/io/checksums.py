@@ -0,0 +1,150 @@
+"""
+md5 and crc32c of data, base64 encoded as GCS (and `KeyInfo`) does.
+crc32c uses google-crc32c, installed along with google-cloud-storage,
+without it only md5 is available.
+
+Streams are hashed as they pass through with `ChecksumStream` and
+`AsyncChecksumStream`, so checking them doesn't need a second read.
+"""
+import base64
+import hashlib
+from typing import Any, AsyncIterator, Callable, Iterator, Optional
+
+from .kvspec import KeyInfo
+
+try:
+    import google_crc32c
+except ImportError:  # pragma: no cover
+    google_crc32c = None
+
+READ_SIZE = 1024 * 1024
+
+
+def _b64(digest: bytes) -> str:
+    return base64.b64encode(digest).decode("ascii")
+
+
+class Checksum:
+    """ Hashes of data given in chunks with `update` """
+
+    def __init__(self, md5: bool = True, crc32c: bool = True):
+        self._md5 = hashlib.md5() if md5 else None
+        self._crc = google_crc32c.Checksum() \
+            if crc32c and google_crc32c else None
+        self.size = 0
+
+    def update(self, chunk: bytes):
+        if self._md5 is not None:
+            self._md5.update(chunk)
+        if self._crc is not None:
+            # the C extension of google-crc32c only takes bytes
+            self._crc.update(chunk if isinstance(chunk, bytes) else bytes(chunk))
+        self.size += len(chunk)
+
+    @property
+    def md5(self) -> Optional[str]:
+        return _b64(self._md5.digest()) if self._md5 is not None else None
+
+    @property
+    def crc32c(self) -> Optional[str]:
+        return _b64(self._crc.digest()) if self._crc is not None else None
+
+    def info(self, key: str, **fields) -> KeyInfo:
+        return KeyInfo(key, size=self.size, md5=self.md5, crc32c=self.crc32c,
+                       **fields)
+
+    def mismatch(self, info: KeyInfo) -> Optional[str]:
+        """ What differs from `info`, only fields known by both are compared """
+        if info.size is not None and info.size != self.size:
+            return f"size {self.size} doesn't match {info.size}"
+        if info.md5 and self.md5 and info.md5 != self.md5:
+            return f"md5 {self.md5} doesn't match {info.md5}"
+        if info.crc32c and self.crc32c and info.crc32c != self.crc32c:
+            return f"crc32c {self.crc32c} doesn't match {info.crc32c}"
+        return None
+
+
+class _Hashing:
+    """
+    The checksum is complete once the stream is exhausted. When
+    `expected` is known (it could be set while streaming) the exception
+    made by `error(msg)` is raised at the end if it doesn't match.
+    """
+
+    def __init__(self, chunks: Any, expected: Optional[KeyInfo] = None,
+                 error: Callable[[str], Exception] = ValueError,
+                 md5: bool = True, crc32c: bool = True):
+        self._chunks = chunks
+        self._it: Any = None
+        self._done = False
+        self.checksum = Checksum(md5=md5, crc32c=crc32c)
+        self.expected = expected
+        self._error = error
+
+    def _end(self):
+        if self._done:
+            return
+        self._done = True
+        if self.expected is not None:
+            msg = self.checksum.mismatch(self.expected)
+            if msg:
+                raise self._error(msg)
+
+
+class ChecksumStream(_Hashing):
+    """ Iterator over `chunks` hashing them """
+
+    def __iter__(self) -> Iterator[bytes]:
+        return self
+
+    def __next__(self) -> bytes:
+        if self._it is None:
+            self._it = iter(self._chunks)
+        try:
+            chunk = next(self._it)
+        except StopIteration:
+            self._end()
+            raise
+        self.checksum.update(chunk)
+        return chunk
+
+    def close(self):
+        if hasattr(self._chunks, "close"):
+            self._chunks.close()
+
+
+class AsyncChecksumStream(_Hashing):
+    """ Async iterator over `chunks` (sync or async) hashing them """
+
+    def __aiter__(self) -> AsyncIterator[bytes]:
+        return self
+
+    async def __anext__(self) -> bytes:
+        if self._it is None:
+            if hasattr(self._chunks, "__aiter__"):
+                self._it = self._chunks.__aiter__()
+            else:
+                self._it = iter(self._chunks)
+        try:
+            if hasattr(self._it, "__anext__"):
+                chunk = await self._it.__anext__()
+            else:
+                chunk = next(self._it)
+        except (StopIteration, StopAsyncIteration):
+            self._end()
+            raise StopAsyncIteration
+        self.checksum.update(chunk)
+        return chunk
+
+    async def aclose(self):
+        if hasattr(self._chunks, "aclose"):
+            await self._chunks.aclose()
+
+
+def file_checksum(fpath: str, md5: bool = True,
+                  crc32c: bool = True) -> Checksum:
+    checksum = Checksum(md5=md5, crc32c=crc32c)
+    with open(fpath, "rb") as f:
+        for chunk in iter(lambda: f.read(READ_SIZE), b""):
+            checksum.update(chunk)
+    return checksum
@@ -0,0 +1,74 @@
+"""
+Process-wide cache of google-cloud-storage clients. Creating a client
+parses the credentials file and sets up a new http session, so
+`KVGS` and `providers.google.storage.Storage` share one client
+per credentials file (and project) instead.
+
+Buckets should be bound with `client.bucket(name)`, which doesn't do
+any request, errors like a missing bucket are raised on the first call.
+"""
+import os
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from google.cloud.storage import Client
+
+_GOOGLE = "GOOGLE_APPLICATION_CREDENTIALS"
+_EMULATOR = "STORAGE_EMULATOR_HOST"
+
+_clients: Dict[Tuple[str, ...], Client] = {}
+_lock = threading.Lock()
+
+
+def get_client(creds: Optional[str] = None,
+               project: Optional[str] = None) -> Client:
+    """
+    Shared client for the service account file `creds`, by default
+    GOOGLE_APPLICATION_CREDENTIALS. When STORAGE_EMULATOR_HOST is set
+    an anonymous client is used for local emulators and fakes.
+    """
+    emulator = os.environ.get(_EMULATOR)
+    if emulator:
+        key = ("emulator", emulator, project or "")
+    else:
+        creds = os.path.abspath(creds or os.environ[_GOOGLE])
+        key = ("creds", creds, project or "")
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            if emulator:
+                client = Client(project=project or "emulator")
+            else:
+                client = Client.from_service_account_json(creds, project=project)
+            _clients[key] = client
+    return client
+
+
+def batch_responses(batch) -> List[Any]:
+    """
+    Sub-responses of an exited `client.batch()` block, what `finish()`
+    returned. The library doesn't expose them publicly, so the private
+    attribute is checked to fail with a clear error on other versions.
+    """
+    try:
+        return batch._responses
+    except AttributeError:
+        raise RuntimeError(
+            "batch responses are not available, "
+            "google-cloud-storage >= 2.10 is needed") from None
+
+
+def clear():
+    """ Forget the cached clients, e.g. after rotating credentials """
+    with _lock:
+        _clients.clear()
+
+
+def _after_fork():
+    # http sessions can't be shared with forked processes
+    global _lock
+    _lock = threading.Lock()
+    _clients.clear()
+
+
+os.register_at_fork(after_in_child=_after_fork)
@@ -0,0 +1,320 @@
+"""
+Parallel transfers for Google Cloud Storage shared by
+`labmachine.io.kv_gcs.KVGS` and `labmachine.providers.google.storage.Storage`
+"""
+import io
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Dict, Generator, Iterable, List, Optional, Tuple
+
+from google.cloud.storage import Blob, Bucket
+
+from labmachine.utils import generate_random
+
+PART_SIZE = 32 * 1024 ** 2
+# data sent by request in resumable uploads, a multiple of 256KB
+UPLOAD_CHUNK_SIZE = 16 * 1024 ** 2
+UPLOAD_WORKERS = 4
+SLICE_SIZE = 16 * 1024 ** 2
+DOWNLOAD_WORKERS = 8
+# max number of sources allowed by GCS in a compose request
+COMPOSE_LIMIT = 32
+# max number of calls allowed by GCS in a batch request
+BATCH_SIZE = 100
+
+
+def iter_parts(generator: Iterable[bytes],
+               part_size: int = PART_SIZE) -> Generator[bytes, None, None]:
+    """
+    Group the chunks of a generator in parts of at least `part_size`,
+    the last one could be smaller. Compose doesn't need parts of the
+    same size so chunks are never split.
+    """
+    pending: List[bytes] = []
+    size = 0
+    for chunk in generator:
+        pending.append(chunk)
+        size += len(chunk)
+        if size >= part_size:
+            yield b"".join(pending)
+            pending, size = [], 0
+    if pending:
+        yield b"".join(pending)
+
+
+def delete_quietly(bucket: Bucket, names: List[str]):
+    """ best effort cleanup of temporal objects using batch requests """
+    for ix in range(0, len(names), BATCH_SIZE):
+        try:
+            with bucket.client.batch():
+                for name in names[ix:ix + BATCH_SIZE]:
+                    bucket.delete_blob(name)
+        except Exception:
+            pass
+
+
+def compose(bucket: Bucket, key: str, sources: List[Blob],
+            content_type: Optional[str] = None,
+            metadata: Optional[Dict[str, str]] = None) -> Tuple[Blob, List[str]]:
+    """
+    Compose `sources` into `key`. When there are more sources than
+    allowed by GCS, they are composed in levels.
+    It returns the final blob and the names of the intermediate objects.
+    """
+    temps: List[str] = []
+    level = 0
+    while len(sources) > COMPOSE_LIMIT:
+        next_sources = []
+        for ix in range(0, len(sources), COMPOSE_LIMIT):
+            group = sources[ix:ix + COMPOSE_LIMIT]
+            if len(group) == 1:
+                next_sources.append(group[0])
+                continue
+            dest = bucket.blob(f"{group[0].name}.l{level}")
+            dest.compose(group)
+            temps.append(dest.name)
+            next_sources.append(dest)
+        sources = next_sources
+        level += 1
+
+    final = bucket.blob(key)
+    final.content_type = content_type or "application/octet-stream"
+    final.metadata = metadata
+    final.compose(sources)
+    return final, temps
+
+
+def _upload_part(bucket: Bucket, name: str, data: bytes,
+                 slots: threading.Semaphore) -> Blob:
+    try:
+        blob = bucket.blob(name)
+        # the precondition makes the upload safe to retry
+        blob.upload_from_string(data, content_type="application/octet-stream",
+                                if_generation_match=0)
+        return blob
+    finally:
+        slots.release()
+
+
+def composite_upload(bucket: Bucket, key: str,
+                     generator: Iterable[bytes],
+                     part_size: int = PART_SIZE,
+                     workers: int = UPLOAD_WORKERS,
+                     content_type: Optional[str] = None,
+                     metadata: Optional[Dict[str, str]] = None) -> Blob:
+    """
+    Parallel composite upload: the stream is split in parts of `part_size`
+    uploaded by `workers` threads as temporal objects, then they are
+    stitched with compose and removed.
+    At most `workers * 2` parts are kept in memory.
+
+    Composite objects don't have a md5 hash, only crc32c.
+    """
+    parts = iter_parts(generator, part_size)
+    first = next(parts, b"")
+    second = next(parts, None)
+    if second is None:
+        blob = bucket.blob(key)
+        blob.metadata = metadata
+        blob.upload_from_string(
+            first, content_type=content_type or "application/octet-stream")
+        return blob
+
+    prefix = f"{key}.parts-{generate_random(8)}"
+    names: List[str] = []
+    futures = []
+    slots = threading.Semaphore(workers * 2)
+    head = [first, second]
+    first = second = None
+
+    def _all_parts():
+        while head:
+            yield head.pop(0)
+        yield from parts
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for ix, data in enumerate(_all_parts()):
+                slots.acquire()
+                name = f"{prefix}/{ix:06d}"
+                names.append(name)
+                futures.append(pool.submit(_upload_part, bucket, name, data, slots))
+            sources = [f.result() for f in futures]
+        blob, temps = compose(bucket, key, sources,
+                              content_type=content_type, metadata=metadata)
+        names.extend(temps)
+    finally:
+        delete_quietly(bucket, names)
+    return blob
+
+
+class _ChunksReader(io.RawIOBase):
+    """
+    Read-only file over an iterable of chunks. Reads return `size`
+    bytes until the end, resumable uploads take a short read as the last.
+    """
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self._chunks = iter(chunks)
+        self._buf = bytearray()
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        # only to the current position, when an upload is resumed
+        if whence != io.SEEK_SET or offset != self._pos:
+            raise io.UnsupportedOperation("stream can't go back")
+        return self._pos
+
+    def read(self, size: Optional[int] = -1) -> bytes:
+        whole = size is None or size < 0
+        while whole or len(self._buf) < size:  # type: ignore
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buf += chunk
+        n = len(self._buf) if whole else min(size, len(self._buf))  # type: ignore
+        data = bytes(self._buf[:n])
+        del self._buf[:n]
+        self._pos += n
+        return data
+
+
+def stream_upload(bucket: Bucket, key: str, generator: Iterable[bytes],
+                  chunk_size: int = UPLOAD_CHUNK_SIZE,
+                  content_type: Optional[str] = None,
+                  metadata: Optional[Dict[str, str]] = None) -> Blob:
+    """
+    Resumable upload of a stream of unknown size, at most `chunk_size`
+    bytes are kept in memory. The blob returned has the metadata of
+    the object written (generation, hashes) without another request.
+    """
+    blob = bucket.blob(key, chunk_size=chunk_size)
+    blob.metadata = metadata
+    blob.upload_from_file(_ChunksReader(generator),
+                          content_type=content_type or "application/octet-stream")
+    return blob
+
+
+class _ViewWriter:
+    """ file-like object that writes into a preallocated buffer """
+
+    def __init__(self, view: memoryview):
+        self._view = view
+        self._pos = 0
+
+    def write(self, data: bytes) -> int:
+        n = len(data)
+        self._view[self._pos:self._pos + n] = data
+        self._pos += n
+        return n
+
+
+class _OffsetWriter:
+    """ file-like object that writes into a fd starting from an offset """
+
+    def __init__(self, fd: int, offset: int):
+        self._fd = fd
+        self._pos = offset
+
+    def write(self, data: bytes) -> int:
+        view = memoryview(data)
+        while view:
+            n = os.pwrite(self._fd, view, self._pos)
+            self._pos += n
+            view = view[n:]
+        return len(data)
+
+
+def slices(size: int, slice_size: int = SLICE_SIZE) -> List[Tuple[int, int]]:
+    """ byte ranges of `slice_size` as (start, end) with `end` included """
+    return [(start, min(start + slice_size, size) - 1)
+            for start in range(0, size, slice_size)]
+
+
+def _pinned(blob: Blob) -> Blob:
+    """
+    A new handle for each slice pinned to the generation of `blob`,
+    so every range comes from the same version of the object.
+    """
+    return blob.bucket.blob(blob.name, generation=blob.generation)
+
+
+def sliced_download(blob: Blob, slice_size: int = SLICE_SIZE,
+                    workers: int = DOWNLOAD_WORKERS) -> bytes:
+    """
+    Download ranges of the object concurrently into a preallocated buffer.
+    `blob` must have its metadata loaded (e.g. from `bucket.get_blob`).
+    The buffer is copied once into the bytes returned, use
+    `sliced_download_to_file` for objects that don't fit twice in memory.
+    """
+    buf = bytearray(blob.size)
+    view = memoryview(buf)
+
+    def _fetch(start: int, end: int):
+        _pinned(blob).download_to_file(
+            _ViewWriter(view[start:end + 1]), start=start, end=end)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_fetch, start, end)
+                   for start, end in slices(blob.size, slice_size)]
+        for f in futures:
+            f.result()
+    view.release()
+    return bytes(buf)
+
+
+def sliced_download_to_file(blob: Blob, fpath: str,
+                            slice_size: int = SLICE_SIZE,
+                            workers: int = DOWNLOAD_WORKERS):
+    """ Like `sliced_download` but each range is written in place into `fpath` """
+    fd = os.open(fpath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, blob.size)
+
+        def _fetch(start: int, end: int):
+            _pinned(blob).download_to_file(
+                _OffsetWriter(fd, start), start=start, end=end)
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_fetch, start, end)
+                       for start, end in slices(blob.size, slice_size)]
+            for f in futures:
+                f.result()
+    finally:
+        os.close(fd)
+
+
+def iter_sliced(blob: Blob, slice_size: int = SLICE_SIZE,
+                workers: int = DOWNLOAD_WORKERS) -> Generator[bytes, None, None]:
+    """
+    Ordered stream of the object: ranges are fetched ahead by `workers`
+    threads but yielded in order. At most `workers * 2` slices are
+    kept in memory.
+    """
+    ranges = iter(slices(blob.size, slice_size))
+
+    def _fetch(start: int, end: int) -> bytes:
+        return _pinned(blob).download_as_bytes(start=start, end=end)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        window = deque(pool.submit(_fetch, start, end)
+                       for start, end in islice(ranges, workers * 2))
+        try:
+            while window:
+                data = window.popleft().result()
+                nxt = next(ranges, None)
+                if nxt:
+                    window.append(pool.submit(_fetch, *nxt))
+                yield data
+        finally:
+            for f in window:
+                f.cancel()
@@ -0,0 +1,505 @@
+import hashlib
+import heapq
+import itertools
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import (IO, Any, AsyncGenerator, Dict, Generator, Iterable,
+                    List, Optional, Tuple, Union)
+
+from labmachine import executors
+from labmachine.utils import mkdir_p, run_async
+
+from .kvspec import AsyncKVSpec, BatchResult, GenericKVSpec, KeyInfo
+
+CHUNK_SIZE = 256 * 1024
+# generations of keys are kept by stripes of the key hash
+GEN_STRIPES = 4096
+
+
+class MemoryTier:
+    """ LRU cache bounded by the total bytes of the values """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.evictions = 0
+        self._data: "OrderedDict[str, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Union[bytes, None]:
+        with self._lock:
+            data = self._data.get(key)
+            if data is not None:
+                self._data.move_to_end(key)
+            return data
+
+    def set(self, key: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._data[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def invalidate(self, key: str):
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+
+
+class DiskTier:
+    """
+    Cache of files under `path` bounded by `max_bytes`.
+    Eviction policy could be "lru" or "lfu". Entries already in `path`
+    are indexed on start so the cache survives restarts.
+
+    For "lfu" a heap of (hits, seq, name) is kept, where seq orders
+    entries with the same hits by their last use. Each hit pushes a new
+    item, outdated ones are skipped when popped.
+    """
+
+    def __init__(self, path: str, max_bytes: int, policy: str = "lru"):
+        if policy not in ("lru", "lfu"):
+            raise ValueError(f"Eviction policy {policy} not supported")
+        self.path = path
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.size = 0
+        self.evictions = 0
+        # name -> [size, hits, seq]
+        self._index: "OrderedDict[str, List[int]]" = OrderedDict()
+        self._heap: List[Tuple[int, int, str]] = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        mkdir_p(path)
+        self._load()
+
+    def _load(self):
+        entries = []
+        for shard in os.scandir(self.path):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith(".tmp"):
+                    os.unlink(entry.path)
+                    continue
+                st = entry.stat()
+                entries.append((st.st_atime, entry.name, st.st_size))
+        for _, name, size in sorted(entries):
+            self._index[name] = [size, 0, 0]
+            self._push(name)
+            self.size += size
+
+    @staticmethod
+    def _name(key: str) -> str:
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def _fpath(self, name: str) -> str:
+        return f"{self.path}/{name[:2]}/{name}"
+
+    def _push(self, name: str):
+        """ update the place of `name` in the lfu heap """
+        if self.policy != "lfu":
+            return
+        entry = self._index[name]
+        entry[2] = next(self._seq)
+        heapq.heappush(self._heap, (entry[1], entry[2], name))
+        if len(self._heap) > 2 * len(self._index) + 1024:
+            # too many outdated items
+            self._heap = [(e[1], e[2], n) for n, e in self._index.items()]
+            heapq.heapify(self._heap)
+
+    def _touch(self, name: str) -> bool:
+        entry = self._index.get(name)
+        if entry is None:
+            return False
+        entry[1] += 1
+        self._index.move_to_end(name)
+        self._push(name)
+        return True
+
+    def file(self, key: str) -> Union[str, None]:
+        """ path to the cached file or None if the key is not cached """
+        name = self._name(key)
+        with self._lock:
+            if not self._touch(name):
+                return None
+        return self._fpath(name)
+
+    def get(self, key: str) -> Union[bytes, None]:
+        fpath = self.file(key)
+        if fpath is None:
+            return None
+        try:
+            with open(fpath, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            # evicted meanwhile
+            return None
+
+    def set(self, key: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        name = self._name(key)
+        fpath = self._fpath(name)
+        mkdir_p(Path(fpath).parent)
+        tmp = f"{fpath}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, fpath)
+        with self._lock:
+            old = self._index.pop(name, None)
+            if old is not None:
+                self.size -= old[0]
+            self._index[name] = [len(data), 1, 0]
+            self._push(name)
+            self.size += len(data)
+            self._evict()
+
+    def _victim(self) -> str:
+        if self.policy == "lfu":
+            while True:
+                _, seq, name = heapq.heappop(self._heap)
+                entry = self._index.get(name)
+                if entry is not None and entry[2] == seq:
+                    return name
+        return next(iter(self._index))
+
+    def _evict(self):
+        while self.size > self.max_bytes:
+            name = self._victim()
+            size = self._index.pop(name)[0]
+            self.size -= size
+            self.evictions += 1
+            try:
+                os.unlink(self._fpath(name))
+            except FileNotFoundError:
+                pass
+
+    def invalidate(self, key: str):
+        name = self._name(key)
+        with self._lock:
+            old = self._index.pop(name, None)
+            if old is None:
+                return
+            self.size -= old[0]
+        try:
+            os.unlink(self._fpath(name))
+        except FileNotFoundError:
+            pass
+
+
+class TieredCache:
+    """
+    A memory tier in front of an optional disk tier.
+    Options taken from `client_opts`:
+
+    :param memory_bytes: max bytes kept in memory (default 64MB)
+    :param disk_path: folder for the disk tier, without it only memory is used
+    :param disk_bytes: max bytes kept in disk (default 1GB)
+    :param disk_policy: "lru" or "lfu" (default "lru")
+    """
+
+    def __init__(self, memory: MemoryTier, disk: Optional[DiskTier] = None):
+        self.memory = memory
+        self.disk = disk
+        self._gens = [0] * GEN_STRIPES
+        self._gens_lock = threading.Lock()
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+
+    @classmethod
+    def from_opts(cls, opts: Dict[str, Any]) -> "TieredCache":
+        memory = MemoryTier(opts.get("memory_bytes", 64 * 1024 ** 2))
+        disk = None
+        if opts.get("disk_path"):
+            disk = DiskTier(opts["disk_path"],
+                            opts.get("disk_bytes", 1024 ** 3),
+                            policy=opts.get("disk_policy", "lru"))
+        return cls(memory, disk)
+
+    def get(self, key: str) -> Union[bytes, None]:
+        data = self.memory.get(key)
+        if data is not None:
+            self.hits_memory += 1
+            return data
+        if self.disk:
+            data = self.disk.get(key)
+            if data is not None:
+                self.hits_disk += 1
+                self.memory.set(key, data)
+                return data
+        self.misses += 1
+        return None
+
+    def set(self, key: str, data: bytes):
+        self.memory.set(key, data)
+        if self.disk:
+            self.disk.set(key, data)
+
+    def generation(self, key: str) -> int:
+        """ It changes every time `key` is invalidated """
+        return self._gens[hash(key) % GEN_STRIPES]
+
+    def fill(self, key: str, data: bytes, generation: int):
+        """
+        Cache a value read from the store when `generation` was current.
+        If `key` was invalidated meanwhile the value could be stale and
+        it's removed again.
+        """
+        self.set(key, data)
+        if self.generation(key) != generation:
+            self.invalidate(key)
+
+    def invalidate(self, key: str):
+        # the generation changes before removing, see `fill`
+        with self._gens_lock:
+            self._gens[hash(key) % GEN_STRIPES] += 1
+        self.memory.invalidate(key)
+        if self.disk:
+            self.disk.invalidate(key)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits_memory": self.hits_memory,
+            "hits_disk": self.hits_disk,
+            "misses": self.misses,
+            "evictions_memory": self.memory.evictions,
+            "evictions_disk": self.disk.evictions if self.disk else 0,
+            "memory_bytes": self.memory.size,
+            "disk_bytes": self.disk.size if self.disk else 0,
+        }
+
+
+def _read_file(f: IO[bytes],
+               chunk_size: int = CHUNK_SIZE) -> Generator[bytes, None, None]:
+    with f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+def _open(fpath: Union[str, None]) -> Union[IO[bytes], None]:
+    """ an open file keeps the data even if the entry is evicted later """
+    if fpath is None:
+        return None
+    try:
+        return open(fpath, "rb")
+    except FileNotFoundError:
+        # evicted between the lookup and the open
+        return None
+
+
+class CachedKV(GenericKVSpec):
+    """
+    Read-through cache over any other store. The wrapped store is
+    configured with `store_class` and `store_opts` so it plugs in through
+    `GenericKVSpec.create`:
+
+        GenericKVSpec.create("labmachine.io.kv_cache.CachedKV", "my-bucket",
+                             {"store_class": "labmachine.io.kv_gcs.KVGS",
+                              "disk_path": "/tmp/kvcache"})
+
+    See `TieredCache` for the cache options.
+    """
+
+    def __init__(self, bucket: str, client_opts: Dict[str, Any] = {}):
+        self._opts = client_opts
+        self._bucket = bucket
+        self.store = GenericKVSpec.create(
+            client_opts["store_class"], bucket, client_opts.get("store_opts", {}))
+        self.cache = TieredCache.from_opts(client_opts)
+
+    def put(self, key: str, bdata: bytes):
+        rsp = self.store.put(key, bdata)
+        self.cache.invalidate(key)
+        return rsp
+
+    def put_stream(self, key: str, generator: Generator[bytes, None, None]) -> bool:
+        rsp = self.store.put_stream(key, generator)
+        self.cache.invalidate(key)
+        return rsp
+
+    def get(self, key: str) -> Union[bytes, None]:
+        data = self.cache.get(key)
+        if data is None:
+            gen = self.cache.generation(key)
+            data = self.store.get(key)
+            if data is not None:
+                self.cache.fill(key, data, gen)
+        return data
+
+    def get_stream(self, key: str) -> Generator[bytes, None, None]:
+        """ cached values are served from the cache, other are not cached """
+        data = self.cache.memory.get(key)
+        if data is not None:
+            self.cache.hits_memory += 1
+            yield data
+            return
+        f = _open(self.cache.disk.file(key)) if self.cache.disk else None
+        if f:
+            self.cache.hits_disk += 1
+            yield from _read_file(f)
+            return
+        self.cache.misses += 1
+        yield from self.store.get_stream(key)
+
+    def list(self) -> List[str]:
+        return self.store.list()
+
+    def iter_keys(self, prefix: Optional[str] = None, page_size: int = 1000,
+                  start_after: Optional[str] = None, with_meta: bool = False
+                  ) -> Generator[Union[str, KeyInfo], None, None]:
+        return self.store.iter_keys(prefix, page_size, start_after, with_meta)
+
+    def stat(self, key: str) -> Union[KeyInfo, None]:
+        return self.store.stat(key)
+
+    def exists_many(self, keys: Iterable[str],
+                    workers: Optional[int] = None) -> BatchResult:
+        return self.store.exists_many(keys, workers)
+
+    def get_if_changed(self, key: str, etag: Optional[str] = None
+                       ) -> Tuple[Union[bytes, None], Union[str, None]]:
+        gen = self.cache.generation(key)
+        data, _etag = self.store.get_if_changed(key, etag)
+        if data is not None:
+            self.cache.fill(key, data, gen)
+        return data, _etag
+
+    def delete(self, key: str):
+        self.store.delete(key)
+        self.cache.invalidate(key)
+
+    def delete_many(self, keys: Iterable[str],
+                    workers: Optional[int] = None) -> BatchResult:
+        """ the batch of the wrapped store is used, keys failed included """
+        _keys = list(keys)
+        rsp = self.store.delete_many(_keys, workers)
+        for key in _keys:
+            self.cache.invalidate(key)
+        return rsp
+
+    def stats(self) -> Dict[str, int]:
+        return self.cache.stats()
+
+    def close(self):
+        self.store.close()
+
+
+class AsyncCachedKV(AsyncKVSpec):
+    """ Async version of `CachedKV`, disk tier I/O is done in a thread """
+
+    def __init__(self, bucket: str, client_opts: Dict[str, Any] = {}):
+        self._opts = client_opts
+        self._bucket = bucket
+        # it calls methods of this store, which can't be sent to processes
+        self._executor = executors.from_opts(client_opts, kinds=("thread",))
+        self.store = AsyncKVSpec.create(
+            client_opts["store_class"], bucket, client_opts.get("store_opts", {}))
+        self.cache = TieredCache.from_opts(client_opts)
+
+    async def put(self, key: str, bdata: bytes):
+        rsp = await self.store.put(key, bdata)
+        await run_async(self.cache.invalidate, key, executor=self._executor)
+        return rsp
+
+    async def put_stream(
+        self, key: str, generator: Generator[bytes, None, None]
+    ) -> bool:
+        rsp = await self.store.put_stream(key, generator)
+        await run_async(self.cache.invalidate, key, executor=self._executor)
+        return rsp
+
+    async def get(self, key: str) -> Union[bytes, None]:
+        data = self.cache.memory.get(key)
+        if data is not None:
+            self.cache.hits_memory += 1
+            return data
+        data = await run_async(self.cache.get, key, executor=self._executor)
+        if data is None:
+            gen = self.cache.generation(key)
+            data = await self.store.get(key)
+            if data is not None:
+                await run_async(self.cache.fill, key, data, gen,
+                                executor=self._executor)
+        return data
+
+    async def get_stream(self, key: str) -> AsyncGenerator[bytes, None]:
+        """ cached values are served from the cache, other are not cached """
+        data = self.cache.memory.get(key)
+        if data is not None:
+            self.cache.hits_memory += 1
+        elif self.cache.disk:
+            data = await run_async(self.cache.disk.get, key,
+                                   executor=self._executor)
+            if data is not None:
+                self.cache.hits_disk += 1
+        if data is not None:
+            yield data
+            return
+        self.cache.misses += 1
+        async for chunk in self.store.get_stream(key):
+            yield chunk
+
+    async def list(self) -> List[str]:
+        rsp = await self.store.list()
+        return rsp
+
+    async def iter_keys(self, prefix: Optional[str] = None, page_size: int = 1000,
+                        start_after: Optional[str] = None, with_meta: bool = False
+                        ) -> AsyncGenerator[Union[str, KeyInfo], None]:
+        async for key in self.store.iter_keys(prefix, page_size,
+                                              start_after, with_meta):
+            yield key
+
+    async def stat(self, key: str) -> Union[KeyInfo, None]:
+        rsp = await self.store.stat(key)
+        return rsp
+
+    async def exists_many(self, keys: Iterable[str],
+                          concurrency: Optional[int] = None) -> BatchResult:
+        rsp = await self.store.exists_many(keys, concurrency)
+        return rsp
+
+    async def get_if_changed(self, key: str, etag: Optional[str] = None
+                             ) -> Tuple[Union[bytes, None], Union[str, None]]:
+        gen = self.cache.generation(key)
+        data, _etag = await self.store.get_if_changed(key, etag)
+        if data is not None:
+            await run_async(self.cache.fill, key, data, gen,
+                            executor=self._executor)
+        return data, _etag
+
+    async def delete(self, key: str):
+        await self.store.delete(key)
+        await run_async(self.cache.invalidate, key, executor=self._executor)
+
+    async def delete_many(self, keys: Iterable[str],
+                          concurrency: Optional[int] = None) -> BatchResult:
+        _keys = list(keys)
+        rsp = await self.store.delete_many(_keys, concurrency)
+        await run_async(self._invalidate_many, _keys, executor=self._executor)
+        return rsp
+
+    def _invalidate_many(self, keys: List[str]):
+        for key in keys:
+            self.cache.invalidate(key)
+
+    def stats(self) -> Dict[str, int]:
+        return self.cache.stats()
+
+    async def close(self):
+        await self.store.close()
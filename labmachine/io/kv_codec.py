@@ -0,0 +1,464 @@
+"""
+Compression for any KV store. Values are written as a small frame
+followed by the compressed data:
+
+    MAGIC | codec id | data
+
+so the codec used is stored within each object and values written
+without this wrapper are read as they are. The frame is kept in-band
+because stores don't have a place for metadata (local files, packed
+segments) or they would need another request to read it before the
+value (GCS, http files).
+
+A value is taken as framed only when the data after the frame starts
+with the signature of its codec (gzip, zstd and lz4 have one), so
+values written without the wrapper that start with MAGIC are read as
+they are. Only such a value followed by the id of "none" (0) can't be
+told apart.
+"""
+import zlib
+from typing import (Any, AsyncGenerator, Callable, Dict, Generator,
+                    Iterable, List, Optional, Tuple, Union)
+
+from labmachine import executors
+from labmachine.utils import run_async
+
+from .kvspec import AsyncKVSpec, BatchResult, GenericKVSpec, KeyInfo
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4frame
+except ImportError:
+    lz4frame = None
+
+MAGIC = b"\x89LMC"
+HEADER_SIZE = len(MAGIC) + 1
+# first bytes of the data of each codec
+SIGNATURES = {"none": b"", "gzip": b"\x1f\x8b",
+              "zstd": b"\x28\xb5\x2f\xfd", "lz4": b"\x04\x22\x4d\x18"}
+# bytes needed to tell if a value is framed
+_PEEK = HEADER_SIZE + max(len(sig) for sig in SIGNATURES.values())
+
+
+class CodecError(Exception):
+    def __init__(self, codec, error_msg):
+        msg = f"Codec {codec} failed with error: {error_msg}"
+        super().__init__(msg)
+
+
+class _Identity:
+    def compress(self, data: bytes) -> bytes:
+        return data
+
+    def decompress(self, data: bytes) -> bytes:
+        return data
+
+    def flush(self) -> bytes:
+        return b""
+
+
+class _Zlib:
+    """ gzip format, so values could be read with any gzip tool """
+
+    def __init__(self, level: Optional[int] = None, decompress: bool = False):
+        if decompress:
+            self._obj = zlib.decompressobj(wbits=31)
+        else:
+            self._obj = zlib.compressobj(
+                level if level is not None else 6, wbits=31)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._obj.compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        return self._obj.decompress(data)
+
+    def flush(self) -> bytes:
+        return self._obj.flush()
+
+    @property
+    def eof(self) -> bool:
+        return self._obj.eof
+
+
+class _Zstd:
+    def __init__(self, level: Optional[int] = None, decompress: bool = False):
+        self._decompress = decompress
+        if decompress:
+            self._obj = zstandard.ZstdDecompressor().decompressobj()
+        else:
+            self._obj = zstandard.ZstdCompressor(
+                level=level if level is not None else 3).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return self._obj.compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        return self._obj.decompress(data)
+
+    def flush(self) -> bytes:
+        if self._decompress:
+            return b""
+        return self._obj.flush()
+
+    @property
+    def eof(self) -> bool:
+        # only known by recent versions of zstandard
+        return getattr(self._obj, "eof", True)
+
+
+class _LZ4:
+    def __init__(self, level: Optional[int] = None, decompress: bool = False):
+        self._started = False
+        self._decompress = decompress
+        if decompress:
+            self._obj = lz4frame.LZ4FrameDecompressor()
+        else:
+            self._obj = lz4frame.LZ4FrameCompressor(
+                compression_level=level or 0)
+
+    def _begin(self) -> bytes:
+        if self._started:
+            return b""
+        self._started = True
+        return self._obj.begin()
+
+    def compress(self, data: bytes) -> bytes:
+        return self._begin() + self._obj.compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        return self._obj.decompress(data)
+
+    def flush(self) -> bytes:
+        if self._decompress:
+            return b""
+        return self._begin() + self._obj.flush()
+
+    @property
+    def eof(self) -> bool:
+        return self._obj.eof
+
+
+# name -> (id, class, module required)
+CODECS: Dict[str, Tuple[int, Callable, Any]] = {
+    "none": (0, lambda level=None, decompress=False: _Identity(), True),
+    "gzip": (1, _Zlib, True),
+    "zstd": (2, _Zstd, zstandard),
+    "lz4": (3, _LZ4, lz4frame),
+}
+_BY_ID = {cid: name for name, (cid, _, _) in CODECS.items()}
+
+
+def _codec(name: str, level: Optional[int] = None, decompress: bool = False):
+    if name not in CODECS:
+        raise CodecError(name, "not supported")
+    _, factory, available = CODECS[name]
+    if not available:
+        raise CodecError(name, "the python package is not installed")
+    return factory(level=level, decompress=decompress)
+
+
+def available_codecs() -> List[str]:
+    return [name for name, (_, _, available) in CODECS.items() if available]
+
+
+class Encoder:
+    """ Incremental compression of a value, the frame comes first """
+
+    def __init__(self, codec: str = "gzip", level: Optional[int] = None):
+        self._obj = _codec(codec, level)
+        self._header = MAGIC + bytes([CODECS[codec][0]])
+
+    def compress(self, data: bytes) -> bytes:
+        out = self._obj.compress(data)
+        if self._header:
+            out, self._header = self._header + out, b""
+        return out
+
+    def flush(self) -> bytes:
+        out = self._header + self._obj.flush()
+        self._header = b""
+        return out
+
+    def iter(self, generator: Iterable[bytes]) -> Generator[bytes, None, None]:
+        for chunk in generator:
+            out = self.compress(chunk)
+            if out:
+                yield out
+        yield self.flush()
+
+
+def frame_codec(data: bytes) -> Union[str, None]:
+    """ codec of a value from its first `_PEEK` bytes, None if not framed """
+    if data[:len(MAGIC)] != MAGIC or len(data) < HEADER_SIZE:
+        return None
+    name = _BY_ID.get(data[len(MAGIC)])
+    if name is None or not data[HEADER_SIZE:].startswith(SIGNATURES[name]):
+        return None
+    return name
+
+
+class Decoder:
+    """
+    Incremental decompression of a value. The codec is taken from the
+    frame, data without the frame is given back untouched.
+    A compressed value that ends early raises `CodecError`.
+    """
+
+    def __init__(self):
+        self._obj = None
+        self._name: Optional[str] = None
+        self._pending = b""
+
+    @property
+    def codec(self) -> Union[str, None]:
+        """ codec of the value, known after the first bytes """
+        return self._name
+
+    def _start(self, data: bytes, final: bool) -> bytes:
+        data = self._pending + data
+        if len(data) < _PEEK and not final and \
+                MAGIC.startswith(data[:len(MAGIC)]):
+            self._pending = data
+            return b""
+        self._pending = b""
+        name = frame_codec(data)
+        if name:
+            data = data[HEADER_SIZE:]
+        self._name = name or "none"
+        self._obj = _codec(self._name, decompress=True)
+        return data
+
+    def decompress(self, data: bytes) -> bytes:
+        if self._obj is None:
+            data = self._start(data, final=False)
+            if self._obj is None:
+                return b""
+        return self._obj.decompress(data)
+
+    def flush(self) -> bytes:
+        out = b""
+        if self._obj is None:
+            data = self._start(b"", final=True)
+            out = self._obj.decompress(data)
+        out += self._obj.flush()
+        if not getattr(self._obj, "eof", True):
+            raise CodecError(self._name, "the value is truncated")
+        return out
+
+    def iter(self, generator: Iterable[bytes]) -> Generator[bytes, None, None]:
+        for chunk in generator:
+            out = self.decompress(chunk)
+            if out:
+                yield out
+        out = self.flush()
+        if out:
+            yield out
+
+
+def encode(data: bytes, codec: str = "gzip", level: Optional[int] = None) -> bytes:
+    encoder = Encoder(codec, level)
+    return encoder.compress(data) + encoder.flush()
+
+
+def decode(data: bytes) -> bytes:
+    decoder = Decoder()
+    return decoder.decompress(data) + decoder.flush()
+
+
+class CodecPolicy:
+    """
+    Codec by key. Options taken from `client_opts`:
+
+    :param codec: default codec, "gzip", "zstd", "lz4" or "none" (default "gzip")
+    :param codec_prefixes: dict of key prefix to codec, the longest
+        prefix that matches the key wins
+    :param codec_levels: dict of codec to compression level
+    """
+
+    def __init__(self, default: str = "gzip",
+                 prefixes: Optional[Dict[str, str]] = None,
+                 levels: Optional[Dict[str, int]] = None):
+        for name in [default, *(prefixes or {}).values()]:
+            # fail early if a codec is not available
+            _codec(name)
+        self.default = default
+        self.prefixes = sorted((prefixes or {}).items(),
+                               key=lambda p: len(p[0]), reverse=True)
+        self.levels = levels or {}
+
+    @classmethod
+    def from_opts(cls, opts: Dict[str, Any]) -> "CodecPolicy":
+        return cls(opts.get("codec", "gzip"), opts.get("codec_prefixes"),
+                   opts.get("codec_levels"))
+
+    def codec(self, key: str) -> str:
+        for prefix, name in self.prefixes:
+            if key.startswith(prefix):
+                return name
+        return self.default
+
+    def params(self, key: str) -> Tuple[str, Optional[int]]:
+        """ codec and level for `key` """
+        name = self.codec(key)
+        return name, self.levels.get(name)
+
+    def encoder(self, key: str) -> Encoder:
+        return Encoder(*self.params(key))
+
+
+class CodecKV(GenericKVSpec):
+    """
+    Compress values of any other store. The wrapped store is configured
+    with `store_class` and `store_opts` like in `CachedKV`:
+
+        GenericKVSpec.create("labmachine.io.kv_codec.CodecKV", "my-bucket",
+                             {"store_class": "labmachine.io.kv_gcs.KVGS",
+                              "codec": "zstd",
+                              "codec_prefixes": {"images/": "none"}})
+
+    See `CodecPolicy` for the codec options. `stat` gives the size
+    of the compressed value.
+    """
+
+    def __init__(self, bucket: str, client_opts: Dict[str, Any] = {}):
+        self._opts = client_opts
+        self._bucket = bucket
+        self.store = GenericKVSpec.create(
+            client_opts["store_class"], bucket, client_opts.get("store_opts", {}))
+        self.policy = CodecPolicy.from_opts(client_opts)
+
+    def put(self, key: str, bdata: bytes):
+        return self.store.put(key, encode(bdata, *self.policy.params(key)))
+
+    def put_stream(self, key: str, generator: Generator[bytes, None, None]) -> bool:
+        return self.store.put_stream(key, self.policy.encoder(key).iter(generator))
+
+    def get(self, key: str) -> Union[bytes, None]:
+        data = self.store.get(key)
+        if data is None:
+            return None
+        return decode(data)
+
+    def get_stream(self, key: str) -> Generator[bytes, None, None]:
+        yield from Decoder().iter(self.store.get_stream(key))
+
+    def list(self) -> List[str]:
+        return self.store.list()
+
+    def iter_keys(self, prefix: Optional[str] = None, page_size: int = 1000,
+                  start_after: Optional[str] = None, with_meta: bool = False
+                  ) -> Generator[Union[str, KeyInfo], None, None]:
+        return self.store.iter_keys(prefix, page_size, start_after, with_meta)
+
+    def stat(self, key: str) -> Union[KeyInfo, None]:
+        return self.store.stat(key)
+
+    def exists_many(self, keys: Iterable[str],
+                    workers: Optional[int] = None) -> BatchResult:
+        return self.store.exists_many(keys, workers)
+
+    def get_if_changed(self, key: str, etag: Optional[str] = None
+                       ) -> Tuple[Union[bytes, None], Union[str, None]]:
+        data, _etag = self.store.get_if_changed(key, etag)
+        if data is not None:
+            data = decode(data)
+        return data, _etag
+
+    def delete(self, key: str):
+        self.store.delete(key)
+
+    def close(self):
+        self.store.close()
+
+
+class AsyncCodecKV(AsyncKVSpec):
+    """
+    Async version of `CodecKV`, compression is done in a thread.
+    Whole values are compressed in the `executor` of `client_opts`,
+    which could be a process pool, see `labmachine.executors`.
+    Streams keep state between chunks so they always use threads.
+    """
+
+    def __init__(self, bucket: str, client_opts: Dict[str, Any] = {}):
+        self._opts = client_opts
+        self._bucket = bucket
+        self._executor = executors.from_opts(client_opts)
+        self.store = AsyncKVSpec.create(
+            client_opts["store_class"], bucket, client_opts.get("store_opts", {}))
+        self.policy = CodecPolicy.from_opts(client_opts)
+
+    async def put(self, key: str, bdata: bytes):
+        data = await run_async(encode, bdata, *self.policy.params(key),
+                               executor=self._executor)
+        rsp = await self.store.put(key, data)
+        return rsp
+
+    async def _encode(self, key: str, generator: AsyncGenerator[bytes, None]
+                      ) -> AsyncGenerator[bytes, None]:
+        encoder = self.policy.encoder(key)
+        async for chunk in generator:
+            out = await run_async(encoder.compress, chunk)
+            if out:
+                yield out
+        yield encoder.flush()
+
+    async def put_stream(
+        self, key: str, generator: AsyncGenerator[bytes, None]
+    ) -> bool:
+        rsp = await self.store.put_stream(key, self._encode(key, generator))
+        return rsp
+
+    async def get(self, key: str) -> Union[bytes, None]:
+        data = await self.store.get(key)
+        if data is None:
+            return None
+        rsp = await run_async(decode, data, executor=self._executor)
+        return rsp
+
+    async def get_stream(self, key: str) -> AsyncGenerator[bytes, None]:
+        decoder = Decoder()
+        async for chunk in self.store.get_stream(key):
+            out = await run_async(decoder.decompress, chunk)
+            if out:
+                yield out
+        out = decoder.flush()
+        if out:
+            yield out
+
+    async def list(self) -> List[str]:
+        rsp = await self.store.list()
+        return rsp
+
+    async def iter_keys(self, prefix: Optional[str] = None, page_size: int = 1000,
+                        start_after: Optional[str] = None, with_meta: bool = False
+                        ) -> AsyncGenerator[Union[str, KeyInfo], None]:
+        async for key in self.store.iter_keys(prefix, page_size,
+                                              start_after, with_meta):
+            yield key
+
+    async def stat(self, key: str) -> Union[KeyInfo, None]:
+        rsp = await self.store.stat(key)
+        return rsp
+
+    async def exists_many(self, keys: Iterable[str],
+                          concurrency: Optional[int] = None) -> BatchResult:
+        rsp = await self.store.exists_many(keys, concurrency)
+        return rsp
+
+    async def get_if_changed(self, key: str, etag: Optional[str] = None
+                             ) -> Tuple[Union[bytes, None], Union[str, None]]:
+        data, _etag = await self.store.get_if_changed(key, etag)
+        if data is not None:
+            data = await run_async(decode, data, executor=self._executor)
+        return data, _etag
+
+    async def delete(self, key: str):
+        await self.store.delete(key)
+
+    async def close(self):
+        await self.store.close()
@@ -0,0 +1,602 @@
+"""
+Content addressed store with deduplication over any other KV store.
+Values are split with content-defined chunking (FastCDC), so an edit
+only changes the chunks around it. Chunks are stored by their sha256
+and each key gets a manifest listing its chunks:
+
+    chunks/<sha256>
+    manifests/<key>
+    leases/<upload id>/<n>
+    gc/<gc id>
+
+Only chunks missing from the store are uploaded. Uploads lease the
+chunks they reuse, so `gc` doesn't remove them before the manifest
+is written. A lease written while `gc` deletes a batch could be missed,
+so `gc` marks each batch under `gc/` and uploads wait for running
+batches before checking which chunks exist.
+
+Chunking needs the `fastcdc` package (`labmachine[dedup]`), its compiled
+version chunks at about 1GB/s. Without a compiler it falls back to pure
+python with the same cut points, but much slower.
+"""
+import asyncio
+import hashlib
+import json
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import islice
+from typing import (Any, AsyncGenerator, Dict, Generator, Iterable, List,
+                    Optional, Set, Tuple, Union)
+
+from labmachine import executors
+from labmachine.utils import run_async
+
+from .kvspec import (AsyncKVSpec, GenericKVSpec, KeyInfo, KeyReadError,
+                     KeyWriteError)
+
+try:
+    from fastcdc.fastcdc_cy import fastcdc_cy as fastcdc
+except ImportError:  # pragma: no cover
+    try:
+        from fastcdc.fastcdc_py import fastcdc_py as fastcdc
+    except ImportError:
+        fastcdc = None
+
+MIN_SIZE = 256 * 1024
+AVG_SIZE = 1024 ** 2
+MAX_SIZE = 4 * 1024 ** 2
+# chunks checked and uploaded together
+WINDOW = 16
+# unused chunks deleted together by `gc`, leases are read before each batch
+GC_BATCH = 1000
+# seconds between checks of running gc batches and age of the marks
+# of gc runs that didn't finish (they are ignored)
+GC_POLL = 1
+GC_TIMEOUT = 3600
+
+
+def cut_point(buf: Union[bytes, bytearray, memoryview], min_size: int,
+              avg_size: int, max_size: int) -> int:
+    """
+    Size of the first chunk of `buf` by FastCDC with normalized chunking,
+    only the first `max_size` bytes are scanned.
+    """
+    if len(buf) <= min_size:
+        return len(buf)
+    with memoryview(buf) as view:
+        chunks = fastcdc(view, min_size, avg_size, max_size)
+        try:
+            return next(chunks).length
+        finally:
+            # the generator keeps slices of `view`
+            chunks.close()
+            del chunks
+
+
+class Chunker:
+    """ Incremental content-defined chunking of a stream """
+
+    def __init__(self, min_size: int = MIN_SIZE, avg_size: int = AVG_SIZE,
+                 max_size: int = MAX_SIZE):
+        if fastcdc is None:
+            raise ImportError("Chunking needs the fastcdc package, "
+                              "install labmachine[dedup]")
+        if not min_size <= avg_size <= max_size:
+            raise ValueError("Chunk sizes must be min <= avg <= max")
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+        self._buf = bytearray()
+        # start of the bytes not chunked yet, `_buf` is compacted once
+        # per feed instead of after each chunk
+        self._pos = 0
+
+    def _pending(self) -> int:
+        return len(self._buf) - self._pos
+
+    def _cut(self) -> bytes:
+        with memoryview(self._buf) as view:
+            rest = view[self._pos:]
+            try:
+                n = cut_point(rest, self.min_size, self.avg_size, self.max_size)
+                chunk = bytes(rest[:n])
+            finally:
+                rest.release()
+        self._pos += n
+        return chunk
+
+    def _compact(self):
+        del self._buf[:self._pos]
+        self._pos = 0
+
+    def feed(self, data: bytes) -> List[bytes]:
+        """ chunks completed by `data` """
+        self._buf += data
+        chunks = []
+        while self._pending() >= self.max_size:
+            chunks.append(self._cut())
+        self._compact()
+        return chunks
+
+    def finish(self) -> List[bytes]:
+        chunks = []
+        while self._pending():
+            chunks.append(self._cut())
+        self._compact()
+        return chunks
+
+    def iter(self, generator: Iterable[bytes]) -> Generator[bytes, None, None]:
+        for data in generator:
+            yield from self.feed(data)
+        yield from self.finish()
+
+    @classmethod
+    def from_opts(cls, opts: Dict[str, Any]) -> "Chunker":
+        return cls(opts.get("chunk_min", MIN_SIZE),
+                   opts.get("chunk_avg", AVG_SIZE),
+                   opts.get("chunk_max", MAX_SIZE))
+
+
+def _windows(iterable: Iterable, size: int) -> Generator[List, None, None]:
+    it = iter(iterable)
+    while True:
+        window = list(islice(it, size))
+        if not window:
+            return
+        yield window
+
+
+class Manifest:
+    """ chunks of a value as a list of (sha256, size) """
+
+    def __init__(self, chunks: Optional[List[Tuple[str, int]]] = None,
+                 size: int = 0, sha256: Optional[str] = None):
+        self.chunks = chunks or []
+        self.size = size
+        self.sha256 = sha256
+
+    def dumps(self) -> bytes:
+        return json.dumps({"version": 1, "size": self.size,
+                           "sha256": self.sha256,
+                           "chunks": self.chunks}).encode()
+
+    @classmethod
+    def loads(cls, data: bytes) -> "Manifest":
+        obj = json.loads(data)
+        return cls([(h, s) for h, s in obj["chunks"]], obj["size"], obj["sha256"])
+
+
+def chunk_hashes(chunks: List[bytes]) -> List[str]:
+    return [hashlib.sha256(chunk).hexdigest() for chunk in chunks]
+
+
+class _Upload:
+    """ state of a value while its chunks are uploaded """
+
+    def __init__(self):
+        self.manifest = Manifest()
+        self.digest = hashlib.sha256()
+        # chunks already in the store, known during this upload
+        self.known = set()
+        self.id = uuid.uuid4().hex
+        self.leases = 0
+
+    def lease(self, hashes: List[str]) -> Tuple[str, bytes]:
+        """ key suffix and value of the lease of `hashes` """
+        self.leases += 1
+        return f"{self.id}/{self.leases}", json.dumps(hashes).encode()
+
+    def lease_names(self) -> List[str]:
+        return [f"{self.id}/{n}" for n in range(1, self.leases + 1)]
+
+    def add(self, chunks: List[bytes], hashes: List[str]) -> Dict[str, bytes]:
+        """ register `chunks`, it returns the new ones by hash """
+        new: Dict[str, bytes] = {}
+        for chunk, h in zip(chunks, hashes):
+            self.digest.update(chunk)
+            self.manifest.chunks.append((h, len(chunk)))
+            self.manifest.size += len(chunk)
+            if h not in self.known:
+                new[h] = chunk
+        return new
+
+    def finish(self) -> Manifest:
+        self.manifest.sha256 = self.digest.hexdigest()
+        return self.manifest
+
+
+class _DedupBase:
+    """ keys layout and counters shared by the sync and async stores """
+
+    def _setup(self, client_opts: Dict[str, Any]):
+        self._chunks_prefix = client_opts.get("chunks_prefix", "chunks/")
+        self._manifests_prefix = client_opts.get("manifests_prefix", "manifests/")
+        self._leases_prefix = client_opts.get("leases_prefix", "leases/")
+        self._gc_prefix = client_opts.get("gc_prefix", "gc/")
+        self._window = client_opts.get("upload_window", WINDOW)
+        self.counters = {"chunks": 0, "chunks_uploaded": 0,
+                         "bytes": 0, "bytes_uploaded": 0}
+
+    def chunk_key(self, h: str) -> str:
+        return f"{self._chunks_prefix}{h}"
+
+    def manifest_key(self, key: str) -> str:
+        return f"{self._manifests_prefix}{key}"
+
+    def lease_key(self, name: str) -> str:
+        return f"{self._leases_prefix}{name}"
+
+    def gc_key(self) -> str:
+        return f"{self._gc_prefix}{uuid.uuid4().hex}"
+
+    def _logical(self, info: Union[str, KeyInfo]) -> Union[str, KeyInfo]:
+        """ manifest key to key, the size is only known by `stat` """
+        n = len(self._manifests_prefix)
+        if isinstance(info, KeyInfo):
+            return KeyInfo(info.key[n:], mtime=info.mtime, etag=info.etag)
+        return info[n:]
+
+    def _count(self, new: Dict[str, bytes], missing: List[str],
+               chunks: List[bytes]):
+        self.counters["chunks"] += len(chunks)
+        self.counters["bytes"] += sum(len(c) for c in chunks)
+        self.counters["chunks_uploaded"] += len(missing)
+        self.counters["bytes_uploaded"] += sum(len(new[h]) for h in missing)
+
+    def _check(self, key: str, h: str, data: Union[bytes, None]) -> bytes:
+        if data is None:
+            raise KeyReadError(self._bucket, key, f"chunk {h} not found")
+        if hashlib.sha256(data).hexdigest() != h:
+            raise KeyReadError(self._bucket, key, f"chunk {h} is corrupted")
+        return data
+
+    def stats(self) -> Dict[str, int]:
+        return dict(self.counters)
+
+
+def _age(info: KeyInfo) -> float:
+    """ seconds since `info` was written, 0 if unknown """
+    if info.mtime is None:
+        return 0
+    return (datetime.now(tz=info.mtime.tzinfo) - info.mtime).total_seconds()
+
+
+def _gc_running(info: KeyInfo) -> bool:
+    return _age(info) < GC_TIMEOUT
+
+
+def _failed(rsp, keys: List[str]) -> Union[str, None]:
+    """ first error of a put_many, stores like KVFiles return False """
+    for key, result in zip(keys, rsp.results):
+        if key in rsp.errors:
+            return f"{key}: {rsp.errors[key]}"
+        if result is False:
+            return f"{key}: not written"
+    return None
+
+
+class DedupKV(_DedupBase, GenericKVSpec):
+    """
+    Deduplicated values over any other store, configured with
+    `store_class` and `store_opts` like `CachedKV`. Other options:
+
+    :param chunk_min: min chunk size (default 256KB)
+    :param chunk_avg: average chunk size, a power of two (default 1MB)
+    :param chunk_max: max chunk size (default 4MB)
+    :param upload_window: chunks checked and uploaded together (default 16)
+    :param chunks_prefix: prefix of the chunks (default "chunks/")
+    :param manifests_prefix: prefix of the manifests (default "manifests/")
+    :param leases_prefix: prefix of the leases (default "leases/")
+    :param gc_prefix: prefix of the marks of gc batches (default "gc/")
+
+    Deleting a key removes only its manifest, run `gc` to remove
+    chunks that are not used anymore.
+    """
+
+    def __init__(self, bucket: str, client_opts: Dict[str, Any] = {}):
+        self._opts = client_opts
+        self._bucket = bucket
+        self.store = GenericKVSpec.create(
+            client_opts["store_class"], bucket, client_opts.get("store_opts", {}))
+        self._setup(client_opts)
+
+    def _upload(self, key: str, upload: _Upload, chunks: List[bytes]):
+        new = upload.add(chunks, chunk_hashes(chunks))
+        hashes = list(new)
+        missing: List[str] = []
+        if hashes:
+            # leased before checking them, see `gc`
+            name, lease = upload.lease(hashes)
+            self.store.put(self.lease_key(name), lease)
+            self._wait_gc()
+            rsp = self.store.exists_many([self.chunk_key(h) for h in hashes])
+            # on errors the chunk is uploaded again
+            missing = [h for h, found in zip(hashes, rsp.results) if not found]
+        if missing:
+            keys = [self.chunk_key(h) for h in missing]
+            put = self.store.put_many(zip(keys, [new[h] for h in missing]))
+            error = _failed(put, keys)
+            if error:
+                raise KeyWriteError(self._bucket, key, error)
+        upload.known.update(hashes)
+        self._count(new, missing, chunks)
+
+    def _wait_gc(self):
+        """ chunks found while gc deletes a batch could be gone, see `gc` """
+        while any(_gc_running(info) for info in self.store.iter_keys(
+                self._gc_prefix, with_meta=True)):
+            time.sleep(GC_POLL)
+
+    def put_stream(self, key: str, generator: Generator[bytes, None, None]) -> bool:
+        upload = _Upload()
+        chunker = Chunker.from_opts(self._opts)
+        for window in _windows(chunker.iter(generator), self._window):
+            self._upload(key, upload, window)
+        self.store.put(self.manifest_key(key), upload.finish().dumps())
+        # the manifest keeps the chunks now, leases left expire in `gc`
+        self.store.delete_many([self.lease_key(n) for n in upload.lease_names()])
+        return True
+
+    def put(self, key: str, bdata: bytes):
+        self.put_stream(key, iter([bdata]))
+
+    def manifest(self, key: str) -> Union[Manifest, None]:
+        try:
+            data = self.store.get(self.manifest_key(key))
+        except KeyReadError:
+            return None
+        return Manifest.loads(data) if data is not None else None
+
+    def _iter_chunks(self, key: str, manifest: Manifest
+                     ) -> Generator[bytes, None, None]:
+        """ chunks are fetched ahead by a pool but given in order """
+        workers = self._batch_workers(None)
+        hashes = iter(h for h, _ in manifest.chunks)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            window = deque((h, pool.submit(self.store.get, self.chunk_key(h)))
+                           for h in islice(hashes, workers))
+            try:
+                while window:
+                    h, fut = window.popleft()
+                    nxt = next(hashes, None)
+                    if nxt:
+                        window.append(
+                            (nxt, pool.submit(self.store.get, self.chunk_key(nxt))))
+                    yield self._check(key, h, fut.result())
+            finally:
+                for _, fut in window:
+                    fut.cancel()
+
+    def get(self, key: str) -> Union[bytes, None]:
+        manifest = self.manifest(key)
+        if manifest is None:
+            return None
+        return b"".join(self._iter_chunks(key, manifest))
+
+    def get_stream(self, key: str) -> Generator[bytes, None, None]:
+        manifest = self.manifest(key)
+        if manifest is None:
+            raise KeyReadError(self._bucket, key, "manifest not found")
+        yield from self._iter_chunks(key, manifest)
+
+    def list(self) -> List[str]:
+        return list(self.iter_keys())
+
+    def iter_keys(self, prefix: Optional[str] = None, page_size: int = 1000,
+                  start_after: Optional[str] = None, with_meta: bool = False
+                  ) -> Generator[Union[str, KeyInfo], None, None]:
+        for info in self.store.iter_keys(
+                self.manifest_key(prefix or ""), page_size,
+                self.manifest_key(start_after) if start_after else None,
+                with_meta):
+            yield self._logical(info)
+
+    def stat(self, key: str) -> Union[KeyInfo, None]:
+        """ the etag is the sha256 of the value """
+        info = self.store.stat(self.manifest_key(key))
+        manifest = self.manifest(key) if info else None
+        if manifest is None:
+            return None
+        return KeyInfo(key, size=manifest.size, mtime=info.mtime,
+                       etag=manifest.sha256)
+
+    def delete(self, key: str):
+        self.store.delete(self.manifest_key(key))
+
+    def _leased(self, min_age: Optional[float]) -> Tuple[Set[str], List[str]]:
+        """ chunks leased in the last `min_age` seconds and older leases """
+        leased: Set[str] = set()
+        expired = []
+        for info in self.store.iter_keys(self._leases_prefix, with_meta=True):
+            if not min_age or _age(info) >= min_age:
+                expired.append(info.key)
+                continue
+            data = self.store.get(info.key)
+            if data:
+                leased.update(json.loads(data))
+        return leased, expired
+
+    def gc(self, min_age: Optional[float] = 3600) -> int:
+        """
+        Delete chunks not used by any manifest. Chunks written or leased
+        by an upload in the last `min_age` seconds are kept, uploads
+        should take less than that. Leases are read again right before
+        each batch of deletes and the expired ones are removed.
+
+        Each batch is marked under `gc/` before the leases are read until
+        its chunks are deleted. Uploads check the chunks only when no batch
+        is running, so a lease gc didn't see can't reuse a deleted chunk.
+        It returns the number of chunks deleted.
+        """
+        used = set()
+        for key in self.iter_keys():
+            manifest = self.manifest(key)
+            if manifest:
+                used.update(h for h, _ in manifest.chunks)
+        unused = []
+        for info in self.store.iter_keys(self._chunks_prefix, with_meta=True):
+            h = info.key[len(self._chunks_prefix):]
+            if h in used:
+                continue
+            if min_age and _age(info) < min_age:
+                continue
+            unused.append(info.key)
+        deleted = 0
+        n = len(self._chunks_prefix)
+        for batch in _windows(unused, GC_BATCH):
+            mark = self.gc_key()
+            self.store.put(mark, b"")
+            try:
+                leased, _ = self._leased(min_age)
+                keys = [k for k in batch if k[n:] not in leased]
+                rsp = self.store.delete_many(keys)
+                deleted += len(keys) - len(rsp.errors)
+            finally:
+                self.store.delete(mark)
+        _, expired = self._leased(min_age)
+        if expired:
+            self.store.delete_many(expired)
+        return deleted
+
+    def close(self):
+        self.store.close()
+
+
+class AsyncDedupKV(_DedupBase, AsyncKVSpec):
+    """
+    Async version of `DedupKV`, chunking is done in a thread. Chunks
+    are hashed in the `executor` of `client_opts`, which could be
+    a process pool, see `labmachine.executors`.
+    """
+
+    def __init__(self, bucket: str, client_opts: Dict[str, Any] = {}):
+        self._opts = client_opts
+        self._bucket = bucket
+        self._executor = executors.from_opts(client_opts)
+        self.store = AsyncKVSpec.create(
+            client_opts["store_class"], bucket, client_opts.get("store_opts", {}))
+        self._setup(client_opts)
+
+    async def _upload(self, key: str, upload: _Upload, chunks: List[bytes]):
+        hashes = await run_async(chunk_hashes, chunks, executor=self._executor)
+        new = await run_async(upload.add, chunks, hashes)
+        hashes = list(new)
+        missing: List[str] = []
+        if hashes:
+            # leased before checking them, see `DedupKV.gc`
+            name, lease = upload.lease(hashes)
+            await self.store.put(self.lease_key(name), lease)
+            await self._wait_gc()
+            rsp = await self.store.exists_many([self.chunk_key(h) for h in hashes])
+            missing = [h for h, found in zip(hashes, rsp.results) if not found]
+        if missing:
+            keys = [self.chunk_key(h) for h in missing]
+            put = await self.store.put_many(
+                list(zip(keys, [new[h] for h in missing])))
+            error = _failed(put, keys)
+            if error:
+                raise KeyWriteError(self._bucket, key, error)
+        upload.known.update(hashes)
+        self._count(new, missing, chunks)
+
+    async def _wait_gc(self):
+        while True:
+            running = False
+            async for info in self.store.iter_keys(self._gc_prefix,
+                                                   with_meta=True):
+                running = running or _gc_running(info)
+            if not running:
+                return
+            await asyncio.sleep(GC_POLL)
+
+    async def put_stream(
+        self, key: str, generator: AsyncGenerator[bytes, None]
+    ) -> bool:
+        upload = _Upload()
+        chunker = Chunker.from_opts(self._opts)
+        pending: List[bytes] = []
+        async for data in generator:
+            pending.extend(await run_async(chunker.feed, data))
+            while len(pending) >= self._window:
+                await self._upload(key, upload, pending[:self._window])
+                del pending[:self._window]
+        pending.extend(await run_async(chunker.finish))
+        for window in _windows(pending, self._window):
+            await self._upload(key, upload, window)
+        await self.store.put(self.manifest_key(key), upload.finish().dumps())
+        await self.store.delete_many(
+            [self.lease_key(n) for n in upload.lease_names()])
+        return True
+
+    async def put(self, key: str, bdata: bytes):
+        async def _one():
+            yield bdata
+        await self.put_stream(key, _one())
+
+    async def manifest(self, key: str) -> Union[Manifest, None]:
+        try:
+            data = await self.store.get(self.manifest_key(key))
+        except KeyReadError:
+            return None
+        return Manifest.loads(data) if data is not None else None
+
+    async def _iter_chunks(self, key: str, manifest: Manifest
+                           ) -> AsyncGenerator[bytes, None]:
+        size = self._batch_concurrency(None)
+        hashes = iter(h for h, _ in manifest.chunks)
+        window = deque(
+            (h, asyncio.ensure_future(self.store.get(self.chunk_key(h))))
+            for h in islice(hashes, size))
+        try:
+            while window:
+                h, task = window.popleft()
+                nxt = next(hashes, None)
+                if nxt:
+                    window.append((nxt, asyncio.ensure_future(
+                        self.store.get(self.chunk_key(nxt)))))
+                yield self._check(key, h, await task)
+        finally:
+            for _, task in window:
+                task.cancel()
+
+    async def get(self, key: str) -> Union[bytes, None]:
+        manifest = await self.manifest(key)
+        if manifest is None:
+            return None
+        return b"".join([c async for c in self._iter_chunks(key, manifest)])
+
+    async def get_stream(self, key: str) -> AsyncGenerator[bytes, None]:
+        manifest = await self.manifest(key)
+        if manifest is None:
+            raise KeyReadError(self._bucket, key, "manifest not found")
+        async for chunk in self._iter_chunks(key, manifest):
+            yield chunk
+
+    async def list(self) -> List[str]:
+        return [key async for key in self.iter_keys()]
+
+    async def iter_keys(self, prefix: Optional[str] = None, page_size: int = 1000,
+                        start_after: Optional[str] = None, with_meta: bool = False
+                        ) -> AsyncGenerator[Union[str, KeyInfo], None]:
+        async for info in self.store.iter_keys(
+                self.manifest_key(prefix or ""), page_size,
+                self.manifest_key(start_after) if start_after else None,
+                with_meta):
+            yield self._logical(info)
+
+    async def stat(self, key: str) -> Union[KeyInfo, None]:
+        info = await self.store.stat(self.manifest_key(key))
+        manifest = (await self.manifest(key)) if info else None
+        if manifest is None:
+            return None
+        return KeyInfo(key, size=manifest.size, mtime=info.mtime,
+                       etag=manifest.sha256)
+
+    async def delete(self, key: str):
+        await self.store.delete(self.manifest_key(key))
+
+    async def close(self):
+        await self.store.close()
@@ -1,86 +1,264 @@
-from typing import Any, AsyncGenerator, Dict, Generator, Union
+from email.utils import parsedate_to_datetime
+from typing import (Any, AsyncGenerator, Dict, Generator, List, Optional,
+                    Tuple, Union)
 
 import httpx
 
-from .kvspec import AsyncKVSpec, GenericKVSpec
+from .checksums import AsyncChecksumStream, ChecksumStream
+from .kvspec import AsyncKVSpec, GenericKVSpec, KeyInfo
+
+
+def client_params(opts: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Build the httpx client params from the `client_opts` of the store.
+    Supported keys:
+
+    :param timeout: timeout in seconds for each request (default 60)
+    :param http2: enable HTTP/2, it requires `httpx[http2]` (default False)
+    :param max_connections: max connections of the pool (default 100)
+    :param max_keepalive: max idle connections kept alive (default 20)
+    :param keepalive_expiry: seconds to keep an idle connection (default 5)
+    """
+    limits = httpx.Limits(
+        max_connections=opts.get("max_connections", 100),
+        max_keepalive_connections=opts.get("max_keepalive", 20),
+        keepalive_expiry=opts.get("keepalive_expiry", 5.0),
+    )
+    return dict(
+        timeout=opts.get("timeout", 60),
+        http2=opts.get("http2", False),
+        limits=limits,
+    )
+
+
+def response_info(key: str, r: httpx.Response) -> Union[KeyInfo, None]:
+    """ KeyInfo from the headers of a HEAD/GET response """
+    if r.status_code == 404:
+        return None
+    r.raise_for_status()
+    size = r.headers.get("content-length")
+    mtime = r.headers.get("last-modified")
+    return KeyInfo(key,
+                   size=int(size) if size else None,
+                   mtime=parsedate_to_datetime(mtime) if mtime else None,
+                   etag=r.headers.get("etag"))
+
+
+def index_entries(path: str, r: httpx.Response
+                  ) -> List[Tuple[str, Union[KeyInfo, None]]]:
+    """
+    Entries of the json index of the folder `path` (as nginx does with
+    `autoindex_format json`), in the order of the keys. Folders end with
+    "/" and have no KeyInfo.
+    """
+    if r.status_code == 404:
+        return []
+    r.raise_for_status()
+    entries = []
+    for e in r.json():
+        if e.get("type") == "directory":
+            entries.append((f"{path}{e['name']}/", None))
+            continue
+        mtime = e.get("mtime")
+        key = f"{path}{e['name']}"
+        entries.append((key, KeyInfo(
+            key, size=e.get("size"),
+            mtime=parsedate_to_datetime(mtime) if mtime else None)))
+    return sorted(entries, key=lambda e: e[0])
+
+
+def _skip_folder(folder: str, prefix: Optional[str],
+                 start_after: Optional[str]) -> bool:
+    if prefix and not (folder.startswith(prefix) or prefix.startswith(folder)):
+        return True
+    # every key of the folder is before `start_after`
+    return bool(start_after) and folder < start_after \
+        and not start_after.startswith(folder)  # type: ignore
+
+
+def _wanted(key: str, prefix: Optional[str], start_after: Optional[str]) -> bool:
+    if prefix and not key.startswith(prefix):
+        return False
+    return not (start_after and key <= start_after)
+
+
+def _if_none_match(etag: Optional[str]) -> Dict[str, str]:
+    return {"If-None-Match": etag} if etag else {}
 
 
 class KVFiles(GenericKVSpec):
+    """
+    KV store over a http files server. One pooled client is kept
+    by instance, so connections are reused between calls.
+    Use `close()` or a `with` block to release them.
+
+    Listing needs the json index of folders, like nginx with
+    `autoindex on; autoindex_format json;`.
+    """
+
     def __init__(self, bucket: str, client_opts: Dict[str, Any] = {}):
         self._opts = client_opts
         self._bucket = bucket
+        self.client = httpx.Client(**client_params(client_opts))
 
     @property
     def url(self):
         return f"{self._opts['url']}/{self._bucket}"
 
     def put(self, key: str, bdata: bytes):
-        ts = self._opts.get("timeout", 60)
-        with httpx.Client(timeout=ts) as client:
-            r = client.put(f"{self.url}/{key}", content=bdata)
+        r = self.client.put(f"{self.url}/{key}", content=bdata)
         if r.status_code == 201:
             return True
         return False
 
-    def put_stream(self, key: str, generator: Generator[bytes, None, None]) -> bool:
-        ts = self._opts.get("timeout", 60)
-        with httpx.Client(timeout=ts) as client:
-            r = client.put(f"{self.url}/{key}", content=generator())
+    def put_stream(self, key: str, generator: Generator[bytes, None, None]
+                   ) -> Union[KeyInfo, bool]:
+        """ It returns the size, md5 and crc32c of the data sent """
+        stream = ChecksumStream(generator)
+        r = self.client.put(f"{self.url}/{key}", content=stream)
         if r.status_code == 201:
-            return True
+            return stream.checksum.info(key, etag=r.headers.get("etag"))
         return False
 
     def get(self, key: str) -> Union[bytes, None]:
-        with httpx.Client() as client:
-            r = client.get(f"{self.url}/{key}")
+        r = self.client.get(f"{self.url}/{key}")
         if r.status_code == 200:
             return r.content
         return None
 
-    def get_stream(self, key: str) -> Generator[bytes, None, None]:
+    def _iter_raw(self, key: str) -> Generator[bytes, None, None]:
+        with self.client.stream("GET", f"{self.url}/{key}") as r:
+            for raw in r.iter_raw():
+                yield raw
+
+    def get_stream(self, key: str) -> ChecksumStream:
+        """ The hashes of the data read are in `checksum` of the stream """
+        return ChecksumStream(self._iter_raw(key))
 
-        with httpx.Client() as client:
-            with client.stream("GET", f"{self.url}/{key}") as r:
-                for raw in r.iter_raw():
-                    yield raw
+    def _walk(self, folder: str, prefix: Optional[str],
+              start_after: Optional[str]
+              ) -> Generator[Tuple[str, KeyInfo], None, None]:
+        r = self.client.get(f"{self.url}/{folder}")
+        for key, info in index_entries(folder, r):
+            if info is not None:
+                yield key, info
+            elif not _skip_folder(key, prefix, start_after):
+                yield from self._walk(key, prefix, start_after)
+
+    def iter_keys(self, prefix: Optional[str] = None, page_size: int = 1000,
+                  start_after: Optional[str] = None, with_meta: bool = False
+                  ) -> Generator[Union[str, KeyInfo], None, None]:
+        """
+        Folders are walked one index at a time, only the ones that could
+        have keys after `start_after` with `prefix`. `page_size` is unused.
+        """
+        for key, info in self._walk("", prefix, start_after):
+            if _wanted(key, prefix, start_after):
+                yield info if with_meta else key
+
+    def list(self) -> List[str]:
+        return list(self.iter_keys())
+
+    def stat(self, key: str) -> Union[KeyInfo, None]:
+        r = self.client.head(f"{self.url}/{key}")
+        return response_info(key, r)
+
+    def get_if_changed(self, key: str, etag: Optional[str] = None
+                       ) -> Tuple[Union[bytes, None], Union[str, None]]:
+        r = self.client.get(f"{self.url}/{key}", headers=_if_none_match(etag))
+        if r.status_code == 304:
+            return None, etag
+        if r.status_code == 404:
+            return None, None
+        r.raise_for_status()
+        return r.content, r.headers.get("etag")
+
+    def delete(self, key: str):
+        self.client.delete(f"{self.url}/{key}")
+
+    def close(self):
+        self.client.close()
 
 
 class AsyncKVFiles(AsyncKVSpec):
     def __init__(self, bucket: str, client_opts: Dict[str, Any] = {}):
         self._opts = client_opts
         self._bucket = bucket
+        self.client = httpx.AsyncClient(**client_params(client_opts))
 
     @property
     def url(self):
         return f"{self._opts['url']}/{self._bucket}"
 
     async def put(self, key: str, bdata: bytes):
-        async with httpx.AsyncClient() as client:
-            r = await client.put(f"{self.url}/{key}", content=bdata)
-            if r.status_code == 201:
-                return True
+        r = await self.client.put(f"{self.url}/{key}", content=bdata)
+        if r.status_code == 201:
+            return True
         return False
 
     async def put_stream(
         self, key: str, generator: Generator[bytes, None, None]
-    ) -> bool:
-        ts = self._opts.get("timeout", 60)
-        async with httpx.AsyncClient(timeout=ts) as client:
-            r = await client.put(f"{self.url}/{key}", content=generator)
-            if r.status_code == 201:
-                return True
+    ) -> Union[KeyInfo, bool]:
+        """ It returns the size, md5 and crc32c of the data sent """
+        stream = AsyncChecksumStream(generator)
+        r = await self.client.put(f"{self.url}/{key}", content=stream)
+        if r.status_code == 201:
+            return stream.checksum.info(key, etag=r.headers.get("etag"))
         return False
 
     async def get(self, key: str) -> Union[bytes, None]:
-        ts = self._opts.get("timeout", 60)
-        async with httpx.AsyncClient(timeout=ts) as client:
-            r = await client.get(f"{self.url}/{key}")
-            return r.content
+        r = await self.client.get(f"{self.url}/{key}")
+        return r.content
 
-    async def get_stream(self, key: str) -> AsyncGenerator[bytes, None]:
+    async def _iter_bytes(self, key: str) -> AsyncGenerator[bytes, None]:
         u = f"{self.url}/{key}"
-        ts = self._opts.get("timeout", 60)
-        async with httpx.AsyncClient(timeout=ts) as client:
-            async with client.stream("GET", u) as r:
-                async for chunk in r.aiter_bytes():
-                    yield chunk
+        async with self.client.stream("GET", u) as r:
+            async for chunk in r.aiter_bytes():
+                yield chunk
+
+    def get_stream(self, key: str) -> AsyncChecksumStream:
+        """ The hashes of the data read are in `checksum` of the stream """
+        return AsyncChecksumStream(self._iter_bytes(key))
+
+    async def _walk(self, folder: str, prefix: Optional[str],
+                    start_after: Optional[str]
+                    ) -> AsyncGenerator[Tuple[str, KeyInfo], None]:
+        r = await self.client.get(f"{self.url}/{folder}")
+        for key, info in index_entries(folder, r):
+            if info is not None:
+                yield key, info
+            elif not _skip_folder(key, prefix, start_after):
+                async for entry in self._walk(key, prefix, start_after):
+                    yield entry
+
+    async def iter_keys(self, prefix: Optional[str] = None, page_size: int = 1000,
+                        start_after: Optional[str] = None, with_meta: bool = False
+                        ) -> AsyncGenerator[Union[str, KeyInfo], None]:
+        """ See `KVFiles.iter_keys` """
+        async for key, info in self._walk("", prefix, start_after):
+            if _wanted(key, prefix, start_after):
+                yield info if with_meta else key
+
+    async def list(self) -> List[str]:
+        return [key async for key in self.iter_keys()]
+
+    async def stat(self, key: str) -> Union[KeyInfo, None]:
+        r = await self.client.head(f"{self.url}/{key}")
+        return response_info(key, r)
+
+    async def get_if_changed(self, key: str, etag: Optional[str] = None
+                             ) -> Tuple[Union[bytes, None], Union[str, None]]:
+        r = await self.client.get(f"{self.url}/{key}",
+                                  headers=_if_none_match(etag))
+        if r.status_code == 304:
+            return None, etag
+        if r.status_code == 404:
+            return None, None
+        r.raise_for_status()
+        return r.content, r.headers.get("etag")
+
+    async def delete(self, key: str):
+        await self.client.delete(f"{self.url}/{key}")
+
+    async def close(self):
+        await self.client.aclose()
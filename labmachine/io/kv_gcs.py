@@ -1,26 +1,55 @@
+import asyncio
 import io
-import os
 from datetime import datetime, timedelta
-from typing import Any, AsyncGenerator, Dict, Generator, List, Union
+from typing import (Any, AsyncGenerator, Callable, Dict, Generator, Iterable,
+                    List, Optional, Tuple, Union)
 
-from google.cloud.storage import Client
-from labmachine.utils import run_async
+from google.api_core.exceptions import (NotFound, NotModified,
+                                        from_http_response)
+from google.cloud.storage import Blob
+from labmachine import executors
+from labmachine.utils import iter_from_async, iter_in_thread, run_async
 from smart_open import open
 
-from .kvspec import AsyncKVSpec, GenericKVSpec
+from .checksums import AsyncChecksumStream, ChecksumStream
+from .gcs_client import batch_responses, get_client
+from .gcs_transfer import (DOWNLOAD_WORKERS, PART_SIZE, SLICE_SIZE,
+                           UPLOAD_WORKERS, composite_upload, iter_sliced,
+                           sliced_download, stream_upload)
+from .kvspec import (AsyncKVSpec, BatchResult, GenericKVSpec, KeyInfo,
+                     KeyReadError, run_many)
 
-_GOOGLE = "GOOGLE_APPLICATION_CREDENTIALS"
+# max number of calls allowed by GCS in a batch request
+BATCH_SIZE = 100
+CHUNK_SIZE = 256 * 1024
+
+
+def blob_info(blob: Blob) -> KeyInfo:
+    return KeyInfo(blob.name, size=blob.size, mtime=blob.updated,
+                   etag=str(blob.generation), md5=blob.md5_hash,
+                   crc32c=blob.crc32c)
 
 
 class KVGS(GenericKVSpec):
-    """https://googleapis.dev/python/storage/latest/client.html"""
+    """
+    https://googleapis.dev/python/storage/latest/client.html
+
+    Streams are uploaded as parallel composite uploads when
+    `parallel_upload` is set in `client_opts`, along with
+    `part_size` and `upload_workers`, see `gcs_transfer.composite_upload`.
+
+    In the same way, `sliced_download` with `slice_size` and
+    `download_workers` enables concurrent range downloads for objects
+    bigger than a slice, see `gcs_transfer.sliced_download`.
+    """
 
     def __init__(self, bucket: str, client_opts: Dict[str, Any] = {}):
         self._opts = client_opts
         self._bucket = bucket
-        service_account_path = client_opts.get("creds", os.environ[_GOOGLE])
-        self.client = Client.from_service_account_json(service_account_path)
-        self.bucket = self.client.get_bucket(bucket)
+        self.client = get_client(client_opts.get("creds"),
+                                 client_opts.get("project"))
+        # bound without a request, see `gcs_client`
+        self.bucket = self.client.bucket(bucket)
         self.params = {"client": self.client}
 
     @property
@@ -32,45 +61,206 @@ class KVGS(GenericKVSpec):
         blob = self.bucket.blob(key)
         blob.upload_from_string(bdata, content_type="application/octet-stream")
 
-    def _writer(self, key: str, generator: Generator[bytes, None, None]):
-        with open(f"{self.uri}/{key}", "wb", transport_params=self.params) as f:
-            data = True
-            while data:
-                try:
-                    _data = generator.__next__()
-                    f.write(_data)
-                except StopIteration:
-                    data = False
-
     def list(self) -> List[str]:
         # TODO: define a type for objects that include size, name, path etc...
         blobs = [b.name for b in self.bucket.list_blobs()]
         return blobs
 
+    def iter_keys(self, prefix: Optional[str] = None, page_size: int = 1000,
+                  start_after: Optional[str] = None, with_meta: bool = False
+                  ) -> Generator[Union[str, KeyInfo], None, None]:
+        """ Pages are requested to GCS as they are consumed """
+        fields = None if with_meta else "items(name),nextPageToken"
+        blobs = self.bucket.list_blobs(prefix=prefix, page_size=page_size,
+                                       start_offset=start_after, fields=fields)
+        for page in blobs.pages:
+            for b in page:
+                # start_offset is inclusive
+                if b.name == start_after:
+                    continue
+                if with_meta:
+                    yield blob_info(b)
+                else:
+                    yield b.name
+
+    def stat(self, key: str) -> Union[KeyInfo, None]:
+        blob = self.bucket.get_blob(key)
+        if blob is None:
+            return None
+        return blob_info(blob)
+
+    def get_if_changed(self, key: str, etag: Optional[str] = None
+                       ) -> Tuple[Union[bytes, None], Union[str, None]]:
+        """ Only one request, using the generation as precondition """
+        blob = self.bucket.blob(key)
+        try:
+            data = blob.download_as_bytes(
+                if_generation_not_match=int(etag) if etag else None)
+        except NotModified:
+            return None, etag
+        except NotFound:
+            return None, None
+        if blob.generation is None:
+            blob.reload()
+        return data, str(blob.generation)
+
     def delete(self, key: str):
         self.bucket.delete_blob(key)
 
-    def put_stream(self, key: str, generator: Generator[bytes, None, None]) -> bool:
-        rsp = True
+    def _batch_responses(self, call: Callable[[str], Any], keys: List[str]):
+        """ run `call` for each key in one batch request, returns the sub-responses """
+        with self.client.batch(raise_exception=False) as batch:
+            for key in keys:
+                call(key)
+        return batch_responses(batch)
+
+    def _delete_batch(self, keys: List[str]) -> Dict[str, Exception]:
+        """ per-key errors are taken from the sub-responses of the batch """
+        responses = self._batch_responses(self.bucket.delete_blob, keys)
+        errors: Dict[str, Exception] = {}
+        for key, rsp in zip(keys, responses):
+            if rsp.status_code >= 400:
+                errors[key] = from_http_response(rsp)
+        return errors
+
+    def delete_many(self, keys: Iterable[str],
+                    workers: Optional[int] = None) -> BatchResult:
+        """
+        Deletes are sent in batch requests of up to 100 keys. If a whole
+        batch request fails, its keys are deleted one by one.
+        """
+        _keys = list(keys)
+        results: List[Any] = []
+        errors: Dict[str, Exception] = {}
+        for ix in range(0, len(_keys), BATCH_SIZE):
+            chunk = _keys[ix:ix + BATCH_SIZE]
+            try:
+                errors.update(self._delete_batch(chunk))
+                results.extend([None] * len(chunk))
+            except Exception:
+                rsp = run_many(self.delete, chunk, [(k,) for k in chunk],
+                               self._batch_workers(workers))
+                results.extend(rsp.results)
+                errors.update(rsp.errors)
+        return BatchResult(results=results, errors=errors)
+
+    def exists_many(self, keys: Iterable[str],
+                    workers: Optional[int] = None) -> BatchResult:
+        """ Like `delete_many`, keys are checked in batch requests of up to 100 """
+        _keys = list(keys)
+        results: List[Any] = []
+        errors: Dict[str, Exception] = {}
+        for ix in range(0, len(_keys), BATCH_SIZE):
+            chunk = _keys[ix:ix + BATCH_SIZE]
+            try:
+                responses = self._batch_responses(
+                    lambda k: self.bucket.blob(k).exists(), chunk)
+            except Exception:
+                rsp = run_many(self.exists, chunk, [(k,) for k in chunk],
+                               self._batch_workers(workers))
+                results.extend(rsp.results)
+                errors.update(rsp.errors)
+                continue
+            for key, rsp in zip(chunk, responses):
+                if rsp.status_code < 400:
+                    results.append(True)
+                elif rsp.status_code == 404:
+                    results.append(False)
+                else:
+                    results.append(None)
+                    errors[key] = from_http_response(rsp)
+        return BatchResult(results=results, errors=errors)
+
+    def put_stream(self, key: str, generator: Generator[bytes, None, None]
+                   ) -> Union[KeyInfo, bool]:
+        """
+        md5 and crc32c are computed while uploading and checked against
+        the ones GCS returns for the object written. It returns them in
+        a KeyInfo, or False if the upload failed or they don't match.
+        An object that doesn't match is deleted.
+        """
+        stream = ChecksumStream(generator)
         try:
-            self._writer(key, generator)
+            if self._opts.get("parallel_upload"):
+                blob = composite_upload(
+                    self.bucket, key, stream,
+                    part_size=self._opts.get("part_size", PART_SIZE),
+                    workers=self._opts.get("upload_workers", UPLOAD_WORKERS))
+            else:
+                blob = stream_upload(self.bucket, key, stream)
         except Exception:
-            rsp = False
-        return rsp
+            return False
+        if stream.checksum.mismatch(blob_info(blob)):
+            try:
+                # unless it was replaced meanwhile
+                self.bucket.delete_blob(key, if_generation_match=blob.generation)
+            except Exception:
+                pass
+            return False
+        return stream.checksum.info(key, mtime=blob.updated,
+                                    etag=str(blob.generation))
+
+    def _sliced(self, blob: Blob) -> bool:
+        """ if it's worth to slice the download of `blob` """
+        return bool(self._opts.get("sliced_download")) \
+            and blob.size > self._opts.get("slice_size", SLICE_SIZE)
+
+    def _sliced_blob(self, key: str):
+        """ blob with metadata if it's worth to slice it, otherwise None """
+        if not self._opts.get("sliced_download"):
+            return None
+        blob = self.bucket.get_blob(key)
+        if blob and self._sliced(blob):
+            return blob
+        return None
 
     def get(self, key: str) -> Union[bytes, None]:
-        blob = self.bucket.blob(key)
         obj = None
         try:
-            obj = blob.download_as_bytes()
+            blob = self._sliced_blob(key)
+            if blob:
+                obj = sliced_download(
+                    blob,
+                    slice_size=self._opts.get("slice_size", SLICE_SIZE),
+                    workers=self._opts.get("download_workers", DOWNLOAD_WORKERS))
+            else:
+                obj = self.bucket.blob(key).download_as_bytes()
         except Exception:
             pass
         return obj
 
-    def get_stream(self, key: str) -> Generator[bytes, None, None]:
+    def _iter_blob(self, key: str, chunk_size: int,
+                   found: Callable[[KeyInfo], None]) -> Generator[bytes, None, None]:
+        """ `found` gets the metadata of the object before reading it """
+        blob = self.bucket.get_blob(key)
+        if blob is None:
+            raise KeyReadError(self._bucket, key, "not found")
+        found(blob_info(blob))
+        if self._sliced(blob):
+            yield from iter_sliced(
+                blob,
+                slice_size=self._opts.get("slice_size", SLICE_SIZE),
+                workers=self._opts.get("download_workers", DOWNLOAD_WORKERS))
+            return
         uri = f"{self.uri}/{key}"
-        for chunk in open(uri, "rb", transport_params=self.params):
-            yield chunk
+        with open(uri, "rb", transport_params=self.params) as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    def get_stream(self, key: str, chunk_size: int = CHUNK_SIZE) -> ChecksumStream:
+        """
+        Chunks are hashed as they are read and checked against the
+        hashes of GCS at the end, raising `KeyReadError` if they don't
+        match. The hashes are in `checksum` of the stream returned.
+        """
+        stream = ChecksumStream(
+            self._iter_blob(key, chunk_size, lambda info: setattr(
+                stream, "expected", info)),
+            error=lambda msg: KeyReadError(self._bucket, key, msg))
+        return stream
 
 
 class AsyncKVGS(AsyncKVSpec):
@@ -79,27 +269,77 @@ class AsyncKVGS(AsyncKVSpec):
     def __init__(self, bucket: str, client_opts: Dict[str, Any] = {}):
         self._opts = client_opts
         self._bucket = bucket
+        # it calls methods of this store, which can't be sent to processes
+        self._executor = executors.from_opts(client_opts, kinds=("thread",))
         self.client = KVGS(bucket, client_opts)
 
     async def put(self, key: str, bdata: bytes):
-        await run_async(self.client.put, key, bdata)
+        await run_async(self.client.put, key, bdata, executor=self._executor)
 
     async def put_stream(
-        self, key: str, generator: Generator[bytes, None, None]
-    ) -> bool:
-        rsp = await run_async(self.client.put_stream, key, generator)
+        self, key: str,
+        generator: Union[Generator[bytes, None, None],
+                         AsyncGenerator[bytes, None]]
+    ) -> Union[KeyInfo, bool]:
+        if hasattr(generator, "__anext__"):
+            loop = asyncio.get_running_loop()
+            generator = iter_from_async(generator, loop)
+        rsp = await run_async(self.client.put_stream, key, generator,
+                              executor=self._executor)
         return rsp
 
     async def get(self, key: str) -> Union[bytes, str, None]:
-        rsp = await run_async(self.client.get, key)
+        rsp = await run_async(self.client.get, key, executor=self._executor)
         return rsp
 
-    async def get_stream(self, key: str) -> AsyncGenerator[bytes, None]:
-        yield await run_async(self.client.get_stream, key)
+    def get_stream(self, key: str,
+                   chunk_size: int = CHUNK_SIZE) -> AsyncChecksumStream:
+        """
+        Chunks are read in the executor, at most `stream_queue`
+        chunks (client_opts, default 8) are buffered in memory.
+        They are checked like in `KVGS.get_stream`.
+        """
+        maxsize = self._opts.get("stream_queue", 8)
+        stream = AsyncChecksumStream(
+            iter_in_thread(self.client._iter_blob, key, chunk_size,
+                           lambda info: setattr(stream, "expected", info),
+                           maxsize=maxsize, executor=self._executor),
+            error=lambda msg: KeyReadError(self._bucket, key, msg))
+        return stream
 
     async def list(self) -> List[str]:
-        rsp = await run_async(self.client.list)
+        rsp = await run_async(self.client.list, executor=self._executor)
+        return rsp
+
+    async def iter_keys(self, prefix: Optional[str] = None, page_size: int = 1000,
+                        start_after: Optional[str] = None, with_meta: bool = False
+                        ) -> AsyncGenerator[Union[str, KeyInfo], None]:
+        async for key in iter_in_thread(self.client.iter_keys, prefix, page_size,
+                                        start_after, with_meta, maxsize=page_size,
+                                        executor=self._executor):
+            yield key
+
+    async def stat(self, key: str) -> Union[KeyInfo, None]:
+        rsp = await run_async(self.client.stat, key, executor=self._executor)
+        return rsp
+
+    async def get_if_changed(self, key: str, etag: Optional[str] = None
+                             ) -> Tuple[Union[bytes, None], Union[str, None]]:
+        rsp = await run_async(self.client.get_if_changed, key, etag,
+                              executor=self._executor)
         return rsp
 
     async def delete(self, key: str):
-        await run_async(self.client.delete, key)
+        await run_async(self.client.delete, key, executor=self._executor)
+
+    async def delete_many(self, keys: Iterable[str],
+                          concurrency: Optional[int] = None) -> BatchResult:
+        rsp = await run_async(self.client.delete_many, list(keys),
+                              executor=self._executor)
+        return rsp
+
+    async def exists_many(self, keys: Iterable[str],
+                          concurrency: Optional[int] = None) -> BatchResult:
+        rsp = await run_async(self.client.exists_many, list(keys),
+                              executor=self._executor)
+        return rsp
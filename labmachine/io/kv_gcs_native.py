@@ -0,0 +1,354 @@
+"""
+Async GCS store that talks to the JSON API with httpx,
+without threads in between.
+"""
+import asyncio
+import os
+from datetime import datetime
+from typing import (Any, AsyncGenerator, Callable, Dict, Generator, List,
+                    Optional, Tuple, Union)
+from urllib.parse import quote
+
+import httpx
+from google.auth.transport.requests import Request
+from google.oauth2 import service_account
+
+from labmachine.utils import run_async
+
+from .checksums import AsyncChecksumStream
+from .kv_files import client_params
+from .kvspec import AsyncKVSpec, KeyInfo, KeyReadError, KeyWriteError
+
+_GOOGLE = "GOOGLE_APPLICATION_CREDENTIALS"
+_EMULATOR = "STORAGE_EMULATOR_HOST"
+ENDPOINT = "https://storage.googleapis.com"
+SCOPES = ["https://www.googleapis.com/auth/devstorage.read_write"]
+# chunks of a resumable upload must be multiple of 256KiB
+UPLOAD_QUANTUM = 256 * 1024
+UPLOAD_CHUNK = 32 * UPLOAD_QUANTUM
+RESUMABLE_THRESHOLD = 8 * 1024 ** 2
+CHUNK_SIZE = 256 * 1024
+RETRY_STATUS = (408, 429, 500, 502, 503, 504)
+
+
+def object_info(obj: Dict[str, Any]) -> KeyInfo:
+    """ KeyInfo from an object resource of the JSON API """
+    updated = obj.get("updated")
+    if updated:
+        updated = datetime.fromisoformat(updated.replace("Z", "+00:00"))
+    return KeyInfo(obj["name"],
+                   size=int(obj["size"]) if "size" in obj else None,
+                   mtime=updated, etag=obj.get("generation"),
+                   md5=obj.get("md5Hash"), crc32c=obj.get("crc32c"))
+
+
+def response_info(key: str, r: httpx.Response) -> KeyInfo:
+    """ KeyInfo from the headers of a media download """
+    hashes = {}
+    for item in r.headers.get_list("x-goog-hash", split_commas=True):
+        name, _, value = item.strip().partition("=")
+        hashes[name] = value
+    size = r.headers.get("x-goog-stored-content-length")
+    # transcoded objects are not served as stored
+    if r.headers.get("content-encoding") == "gzip":
+        return KeyInfo(key, etag=r.headers.get("x-goog-generation"))
+    return KeyInfo(key, size=int(size) if size else None,
+                   etag=r.headers.get("x-goog-generation"),
+                   md5=hashes.get("md5"), crc32c=hashes.get("crc32c"))
+
+
+class TokenSource:
+    """
+    OAuth2 tokens of a service account. The refresh is a blocking call
+    of google-auth, so it runs in a thread and only one at a time.
+    Without credentials (e.g. an emulator) no token is sent.
+    """
+
+    def __init__(self, creds_path: Optional[str] = None):
+        self._creds = None
+        if creds_path:
+            self._creds = service_account.Credentials.from_service_account_file(
+                creds_path, scopes=SCOPES)
+        # created on first use, before python 3.10 a lock is bound to
+        # the loop running when it's created
+        self._lock: Optional[asyncio.Lock] = None
+
+    async def headers(self, force: bool = False) -> Dict[str, str]:
+        if self._creds is None:
+            return {}
+        if force or not self._creds.valid:
+            if self._lock is None:
+                self._lock = asyncio.Lock()
+            async with self._lock:
+                if force or not self._creds.valid:
+                    await run_async(self._creds.refresh, Request())
+        return {"Authorization": f"Bearer {self._creds.token}"}
+
+
+class NativeAsyncKVGS(AsyncKVSpec):
+    """
+    GCS store over the JSON API using one pooled `httpx.AsyncClient`,
+    so concurrency is only bounded by the pool (`max_connections` and
+    the other params of `kv_files.client_params`). Other options:
+
+    :param creds: service account file, by default GOOGLE_APPLICATION_CREDENTIALS
+    :param endpoint: API endpoint, STORAGE_EMULATOR_HOST when it is set
+    :param upload_chunk: chunk size of resumable uploads, a multiple
+        of 256KiB (default 8MB)
+    :param resumable_threshold: values bigger than this are uploaded
+        with a resumable upload by `put` (default 8MB)
+    :param retries: attempts for failed idempotent requests (default 3),
+        simple uploads are not retried because they are not idempotent
+    """
+
+    def __init__(self, bucket: str, client_opts: Dict[str, Any] = {}):
+        self._opts = client_opts
+        self._bucket = bucket
+        emulator = os.environ.get(_EMULATOR)
+        if emulator and "://" not in emulator:
+            emulator = f"http://{emulator}"
+        self.endpoint = (client_opts.get("endpoint") or emulator
+                         or ENDPOINT).rstrip("/")
+        creds = None
+        if not emulator:
+            creds = client_opts.get("creds") or os.environ[_GOOGLE]
+        self.tokens = TokenSource(creds)
+        self.client = httpx.AsyncClient(**client_params(client_opts))
+        self._upload_chunk = client_opts.get("upload_chunk", UPLOAD_CHUNK)
+        if self._upload_chunk % UPLOAD_QUANTUM:
+            raise ValueError("upload_chunk must be a multiple of 256KiB")
+        self._retries = client_opts.get("retries", 3)
+
+    def _object_url(self, key: str, media: bool = False) -> str:
+        prefix = "/download" if media else ""
+        return (f"{self.endpoint}{prefix}/storage/v1/b/{self._bucket}"
+                f"/o/{quote(key, safe='')}")
+
+    @property
+    def _upload_url(self) -> str:
+        return f"{self.endpoint}/upload/storage/v1/b/{self._bucket}/o"
+
+    async def _request(self, method: str, url: str, retry: bool = True,
+                       stream: bool = False, **kwargs) -> httpx.Response:
+        """
+        Authorized request, the token is refreshed once on a 401.
+        With `retry` it's retried on transient errors with backoff,
+        it should be only used for idempotent requests. With `stream`
+        the body is not read, the caller must close the response.
+        Only for requests without a streamed body.
+        """
+        headers = kwargs.pop("headers", {})
+        retries = self._retries if retry else 0
+        refreshed = False
+        attempt = 0
+        while True:
+            auth = await self.tokens.headers(force=refreshed)
+            request = self.client.build_request(
+                method, url, headers={**headers, **auth}, **kwargs)
+            try:
+                r = await self.client.send(request, stream=stream)
+            except httpx.TransportError:
+                if attempt >= retries:
+                    raise
+            else:
+                if r.status_code == 401 and not refreshed and auth:
+                    await r.aclose()
+                    refreshed = True
+                    continue
+                if r.status_code not in RETRY_STATUS or attempt >= retries:
+                    return r
+                await r.aclose()
+            await asyncio.sleep(0.5 * 2 ** attempt)
+            attempt += 1
+
+    async def put(self, key: str, bdata: bytes):
+        if len(bdata) > self._opts.get("resumable_threshold",
+                                       RESUMABLE_THRESHOLD):
+            await self.put_stream(key, [bdata])
+            return
+        # a second attempt could overwrite a newer value
+        r = await self._request(
+            "POST", self._upload_url, retry=False,
+            params={"uploadType": "media", "name": key},
+            headers={"Content-Type": "application/octet-stream"},
+            content=bdata)
+        if r.status_code >= 400:
+            raise KeyWriteError(self._bucket, key, r.text)
+
+    async def _start_upload(self, key: str) -> str:
+        """ nothing is written until the session is used, so it's retried """
+        r = await self._request(
+            "POST", self._upload_url,
+            params={"uploadType": "resumable", "name": key},
+            json={"name": key, "contentType": "application/octet-stream"})
+        if r.status_code >= 400:
+            raise KeyWriteError(self._bucket, key, r.text)
+        return r.headers["Location"]
+
+    async def _send_chunk(self, key: str, session: str, offset: int,
+                          data: bytes, total: Optional[int]
+                          ) -> Tuple[int, Optional[Dict[str, Any]]]:
+        """
+        Send `data` at `offset` of the upload, it returns how many
+        bytes of `data` were persisted by GCS and the object resource
+        once the upload is complete.
+        """
+        size = "*" if total is None else str(total)
+        if data:
+            crange = f"bytes {offset}-{offset + len(data) - 1}/{size}"
+        else:
+            crange = f"bytes */{size}"
+        # the session makes the chunks idempotent
+        r = await self._request("PUT", session, content=data,
+                                headers={"Content-Range": crange})
+        if r.status_code in (200, 201):
+            return len(data), r.json()
+        if r.status_code == 308:
+            persisted = r.headers.get("Range")
+            end = int(persisted.rsplit("-", 1)[1]) + 1 if persisted else 0
+            if end < offset:
+                raise KeyWriteError(self._bucket, key,
+                                    f"upload session lost data before {offset}")
+            return end - offset, None
+        raise KeyWriteError(self._bucket, key, r.text)
+
+    async def put_stream(
+        self, key: str,
+        generator: Union[Generator[bytes, None, None],
+                         AsyncGenerator[bytes, None]]
+    ) -> KeyInfo:
+        """
+        Resumable upload, the stream is sent in chunks of `upload_chunk`
+        and only one chunk is kept in memory. Bytes not persisted by GCS
+        are sent again with the next chunk.
+
+        md5 and crc32c are computed on the way and checked against the
+        ones of the object created, they are returned in a KeyInfo.
+        On a mismatch the object is deleted, unless it was replaced
+        meanwhile, and `KeyWriteError` is raised.
+        """
+        session = await self._start_upload(key)
+        stream = AsyncChecksumStream(generator)
+        buf = bytearray()
+        offset = 0
+        async for chunk in stream:
+            buf += chunk
+            while len(buf) >= self._upload_chunk:
+                sent, _ = await self._send_chunk(
+                    key, session, offset, bytes(buf[:self._upload_chunk]), None)
+                del buf[:sent]
+                offset += sent
+        total = offset + len(buf)
+        while True:
+            sent, obj = await self._send_chunk(key, session, offset,
+                                               bytes(buf), total)
+            offset += sent
+            del buf[:sent]
+            if offset >= total and not buf:
+                break
+        info = object_info(obj or {"name": key})
+        error = stream.checksum.mismatch(info)
+        if error:
+            if info.etag:
+                await self._request("DELETE", self._object_url(key),
+                                    params={"ifGenerationMatch": info.etag})
+            raise KeyWriteError(self._bucket, key, error)
+        return stream.checksum.info(key, mtime=info.mtime, etag=info.etag)
+
+    async def get(self, key: str) -> Union[bytes, None]:
+        r = await self._request("GET", self._object_url(key, media=True),
+                                params={"alt": "media"})
+        if r.status_code == 404:
+            return None
+        if r.status_code >= 400:
+            raise KeyReadError(self._bucket, key, r.text)
+        return r.content
+
+    async def _iter_media(self, key: str, chunk_size: int,
+                          found: Callable[[KeyInfo], None]
+                          ) -> AsyncGenerator[bytes, None]:
+        """
+        `found` gets the metadata from the headers before reading.
+        Failures are retried until the body starts, not while reading it.
+        """
+        r = await self._request("GET", self._object_url(key, media=True),
+                                params={"alt": "media"}, stream=True)
+        try:
+            if r.status_code >= 400:
+                await r.aread()
+                raise KeyReadError(self._bucket, key, r.text)
+            found(response_info(key, r))
+            async for chunk in r.aiter_bytes(chunk_size):
+                yield chunk
+        finally:
+            await r.aclose()
+
+    def get_stream(self, key: str,
+                   chunk_size: int = CHUNK_SIZE) -> AsyncChecksumStream:
+        """
+        Chunks are hashed as they arrive and checked at the end against
+        the x-goog-hash header, raising `KeyReadError` if they don't
+        match. The hashes are in `checksum` of the stream returned.
+        """
+        stream = AsyncChecksumStream(
+            self._iter_media(key, chunk_size, lambda info: setattr(
+                stream, "expected", info)),
+            error=lambda msg: KeyReadError(self._bucket, key, msg))
+        return stream
+
+    async def list(self) -> List[str]:
+        return [key async for key in self.iter_keys()]
+
+    async def iter_keys(self, prefix: Optional[str] = None, page_size: int = 1000,
+                        start_after: Optional[str] = None, with_meta: bool = False
+                        ) -> AsyncGenerator[Union[str, KeyInfo], None]:
+        params: Dict[str, Any] = {"maxResults": page_size}
+        if prefix:
+            params["prefix"] = prefix
+        if start_after:
+            params["startOffset"] = start_after
+        if not with_meta:
+            params["fields"] = "items(name),nextPageToken"
+        url = f"{self.endpoint}/storage/v1/b/{self._bucket}/o"
+        while True:
+            r = await self._request("GET", url, params=params)
+            r.raise_for_status()
+            page = r.json()
+            for obj in page.get("items", []):
+                # startOffset is inclusive
+                if obj["name"] == start_after:
+                    continue
+                yield object_info(obj) if with_meta else obj["name"]
+            token = page.get("nextPageToken")
+            if not token:
+                break
+            params["pageToken"] = token
+
+    async def stat(self, key: str) -> Union[KeyInfo, None]:
+        r = await self._request("GET", self._object_url(key))
+        if r.status_code == 404:
+            return None
+        r.raise_for_status()
+        return object_info(r.json())
+
+    async def get_if_changed(self, key: str, etag: Optional[str] = None
+                             ) -> Tuple[Union[bytes, None], Union[str, None]]:
+        """ Only one request, using the generation as precondition """
+        params = {"alt": "media"}
+        if etag:
+            params["ifGenerationNotMatch"] = etag
+        r = await self._request("GET", self._object_url(key, media=True),
+                                params=params)
+        if r.status_code == 304:
+            return None, etag
+        if r.status_code == 404:
+            return None, None
+        r.raise_for_status()
+        return r.content, r.headers.get("x-goog-generation")
+
+    async def delete(self, key: str):
+        r = await self._request("DELETE", self._object_url(key))
+        r.raise_for_status()
+
+    async def close(self):
+        await self.client.aclose()
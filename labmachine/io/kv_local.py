@@ -1,15 +1,260 @@
 import asyncio
+import hashlib
+import heapq
+import mmap
 import os
 import tempfile
+from datetime import datetime, timezone
 from pathlib import Path
-from typing import Any, AsyncGenerator, Dict, Generator, List, Union
+from typing import (Any, AsyncGenerator, Callable, Dict, Generator, Iterable,
+                    List, Optional, Tuple, Union)
 
 import aiofiles
 from smart_open import open as sopen
 
-from labmachine.utils import mkdir_p, run_async
+from labmachine import executors
+from labmachine.utils import iter_in_thread, mkdir_p, run_async
 
-from .kvspec import AsyncKVSpec, GenericKVSpec, KeyReadError, KeyWriteError
+from .checksums import AsyncChecksumStream, ChecksumStream
+from .kvspec import (AsyncKVSpec, BatchResult, GenericKVSpec, KeyInfo,
+                     KeyReadError, KeyWriteError)
+
+
+CHUNK_SIZE = 256 * 1024
+# folder used by `reshard` to stage files while moving them
+RESHARD_DIR = ".reshard"
+# written by `reshard` once every file is staged
+RESHARD_MARK = ".reshard.staged"
+RESHARD_PROGRESS = 1000
+
+
+def copy_fd(src_fd: int, dst_fd: int, size: int) -> int:
+    """
+    Copy `size` bytes between two file descriptors inside the kernel.
+    It tries copy_file_range (reflinks when the fs supports it), then
+    sendfile and finally a plain read/write loop.
+    Returns the amount of bytes copied.
+    """
+    offset = 0
+    if hasattr(os, "copy_file_range"):
+        try:
+            while offset < size:
+                n = os.copy_file_range(src_fd, dst_fd, size - offset)
+                if n == 0:
+                    break
+                offset += n
+            return offset
+        except OSError:
+            pass
+    if hasattr(os, "sendfile"):
+        try:
+            while offset < size:
+                n = os.sendfile(dst_fd, src_fd, offset, size - offset)
+                if n == 0:
+                    break
+                offset += n
+            return offset
+        except OSError:
+            pass
+    os.lseek(src_fd, offset, os.SEEK_SET)
+    while offset < size:
+        data = os.read(src_fd, min(CHUNK_SIZE, size - offset))
+        if not data:
+            break
+        os.write(dst_fd, data)
+        offset += len(data)
+    return offset
+
+
+def scan_keys(root: str, prefix: Optional[str] = None,
+              start_after: Optional[str] = None, with_meta: bool = False
+              ) -> Generator[Union[str, KeyInfo], None, None]:
+    """
+    Walk `root` recursively with os.scandir, yielding keys relative to it.
+    Keys are sorted, folders are ordered by their name with the trailing
+    slash (`a/b` goes after `a-c`), so `start_after` can be used for
+    paging. Folders outside of `prefix` or before `start_after` are not
+    visited.
+    """
+
+    def _order(entry: os.DirEntry) -> str:
+        if entry.is_dir(follow_symlinks=False):
+            return f"{entry.name}/"
+        return entry.name
+
+    def _skip_dir(sub: str) -> bool:
+        if prefix and not (sub.startswith(prefix) or prefix.startswith(sub)):
+            return True
+        if start_after and sub < start_after and not start_after.startswith(sub):
+            return True
+        return False
+
+    def _walk(path: str, rel: str):
+        with os.scandir(path) as it:
+            entries = sorted(it, key=_order)
+        for entry in entries:
+            key = f"{rel}{entry.name}"
+            if entry.is_dir(follow_symlinks=False):
+                sub = f"{key}/"
+                if not _skip_dir(sub):
+                    yield from _walk(entry.path, sub)
+                continue
+            if prefix and not key.startswith(prefix):
+                continue
+            if start_after and key <= start_after:
+                continue
+            if with_meta:
+                st = entry.stat()
+                mtime = datetime.fromtimestamp(st.st_mtime, tz=timezone.utc)
+                yield KeyInfo(key, size=st.st_size, mtime=mtime)
+            else:
+                yield key
+
+    yield from _walk(root, "")
+
+
+def shard_opts(opts: Dict[str, Any]) -> Tuple[int, int]:
+    """
+    Layout of a local store from its `client_opts`:
+
+    :param layout: "flat" (default) or "sharded"
+    :param shard_levels: levels of folders for "sharded" (default 2)
+    :param shard_width: hex chars of each level (default 2)
+
+    It returns (levels, width), levels is 0 for the flat layout.
+    """
+    if opts.get("layout", "flat") == "flat":
+        return 0, 0
+    if opts["layout"] != "sharded":
+        raise ValueError(f"Layout {opts['layout']} not supported")
+    return opts.get("shard_levels", 2), opts.get("shard_width", 2)
+
+
+def shard_of(key: str, levels: int, width: int) -> str:
+    """ fan-out folders of a key, e.g. "3f/a2" for two levels of width 2 """
+    digest = hashlib.sha1(key.encode()).hexdigest()
+    return "/".join(digest[ix * width:(ix + 1) * width] for ix in range(levels))
+
+
+def key_path(root: str, key: str, levels: int = 0, width: int = 0) -> str:
+    if levels:
+        return f"{root}/{shard_of(key, levels, width)}/{key}"
+    return f"{root}/{key}"
+
+
+def _is_shard(name: str, width: int) -> bool:
+    if len(name) != width:
+        return False
+    try:
+        int(name, 16)
+    except ValueError:
+        return False
+    return True
+
+
+def _sort_key(info: KeyInfo) -> str:
+    return info.key
+
+
+def scan_shards(root: str, levels: int, width: int,
+                prefix: Optional[str] = None, start_after: Optional[str] = None,
+                with_meta: bool = False) -> Generator[Union[str, KeyInfo], None, None]:
+    """
+    Like `scan_keys` for a sharded layout. Keys are sorted inside each
+    shard and the shards are merged, so the listing is sorted like the
+    flat one and `start_after` can be used for paging. Every shard is
+    scanned to start the merge. Folders that are not shards are ignored.
+    """
+
+    def _leaves(path: str, level: int):
+        if level == 0:
+            yield path
+            return
+        with os.scandir(path) as it:
+            entries = sorted((e for e in it if e.is_dir(follow_symlinks=False)
+                              and _is_shard(e.name, width)),
+                             key=lambda e: e.name)
+        for entry in entries:
+            yield from _leaves(entry.path, level - 1)
+
+    scans = [scan_keys(leaf, prefix, start_after, with_meta)
+             for leaf in _leaves(root, levels)]
+    yield from heapq.merge(*scans, key=_sort_key if with_meta else None)
+
+
+def scan_layout(root: str, levels: int = 0, width: int = 0,
+                prefix: Optional[str] = None, start_after: Optional[str] = None,
+                with_meta: bool = False) -> Generator[Union[str, KeyInfo], None, None]:
+    """ logical keys of a store for any layout """
+    if levels:
+        return scan_shards(root, levels, width, prefix, start_after, with_meta)
+    return scan_keys(root, prefix, start_after, with_meta)
+
+
+def _remove_empty_dirs(root: str, keep: str):
+    for path, dirs, files in os.walk(root, topdown=False):
+        if path == root or path == keep or path.startswith(f"{keep}/"):
+            continue
+        try:
+            os.rmdir(path)
+        except OSError:
+            pass
+
+
+def reshard(root: str, levels: int = 2, width: int = 2,
+            from_levels: int = 0, from_width: int = 0,
+            progress: Optional[Callable[[int], None]] = None) -> int:
+    """
+    Move the files of a local store in place from one layout to another,
+    use `levels=0` for the flat layout. Files are renamed, never copied,
+    into a staging folder and then moved to `root`, so keys that look
+    like shard folders don't clash. A run interrupted at any point
+    is resumed by calling it again with the same params: once every
+    file is staged a mark is written, and a run that finds it only
+    finishes moving the staging folder to `root`. `progress` is called
+    with the keys moved every `RESHARD_PROGRESS` keys.
+    It returns the number of keys moved.
+    """
+    if (levels, width) == (from_levels, from_width):
+        return 0
+    staging = f"{root}/{RESHARD_DIR}"
+    mark = f"{root}/{RESHARD_MARK}"
+    moved = 0
+    if not os.path.exists(mark):
+        keys = scan_layout(root, from_levels, from_width)
+        for key in keys:
+            if key.startswith(f"{RESHARD_DIR}/"):
+                continue
+            dst = key_path(staging, key, levels, width)
+            mkdir_p(Path(dst).parent)
+            os.rename(key_path(root, key, from_levels, from_width), dst)
+            moved += 1
+            if progress and moved % RESHARD_PROGRESS == 0:
+                progress(moved)
+        if not os.path.isdir(staging):
+            return moved
+        _remove_empty_dirs(root, staging)
+        with open(mark, "w"):
+            pass
+
+    with os.scandir(staging) as it:
+        entries = list(it)
+    for entry in entries:
+        os.rename(entry.path, f"{root}/{entry.name}")
+    os.rmdir(staging)
+    os.unlink(mark)
+    return moved
+
+
+def stat_file(fpath: str, key: str) -> Union[KeyInfo, None]:
+    """ md5 is not given because it would need to read the whole file """
+    try:
+        st = os.stat(fpath)
+    except FileNotFoundError:
+        return None
+    return KeyInfo(key, size=st.st_size,
+                   mtime=datetime.fromtimestamp(st.st_mtime, tz=timezone.utc),
+                   etag=f"{st.st_mtime_ns:x}-{st.st_size:x}")
 
 
 def delete_file_or_dir(fpath):
@@ -20,15 +265,20 @@ def delete_file_or_dir(fpath):
 
 
 class KVLocal(GenericKVSpec):
-    """https://googleapis.dev/python/storage/latest/client.html"""
+    """
+    Keys are files under the `bucket` folder. With `layout="sharded"`
+    in `client_opts` they are spread in hashed folders, see `shard_opts`.
+    Use `reshard` to migrate an existing folder.
+    """
 
     def __init__(self, bucket: str, client_opts: Dict[str, Any] = {}):
         self._opts = client_opts
         self._bucket = bucket
+        self._levels, self._width = shard_opts(client_opts)
         mkdir_p(self._bucket)
 
     def uri(self, key):
-        return f"{self._bucket}/{key}"
+        return key_path(self._bucket, key, self._levels, self._width)
 
     def put(self, key: str, bdata: bytes):
         # obj = io.BytesIO(bdata)
@@ -40,56 +290,144 @@ class KVLocal(GenericKVSpec):
         except Exception as e:
             raise KeyWriteError(self._bucket, key, str(e))
 
-    def put_stream(self, key: str, generator: Generator[bytes, None, None]) -> bool:
+    def put_stream(self, key: str, generator: Generator[bytes, None, None]) -> KeyInfo:
+        """ It returns the size, md5 and crc32c of the data written """
         uri = self.uri(key)
         mkdir_p(Path(uri).parent)
+        stream = ChecksumStream(generator)
         try:
             with sopen(uri, "wb") as f:
-                for chunk in generator:
+                for chunk in stream:
                     f.write(chunk)
         except Exception as e:
             raise KeyWriteError(self._bucket, key, str(e))
 
-        return True
+        return stream.checksum.info(key)
 
     def get(self, key: str) -> Union[bytes, None]:
         uri = self.uri(key)
         try:
-            with sopen(uri, "rb") as f:
+            with open(uri, "rb") as f:
                 obj = f.read()
                 return obj
         except Exception as e:
             raise KeyReadError(self._bucket, key, str(e))
 
-    def from_file_gen(self, fpath) -> Generator[bytes, None, None]:
-        for chunk in sopen(fpath, "rb"):
-            yield chunk
-
-    def get_stream(self, key: str) -> Generator[bytes, None, None]:
+    def get_view(self, key: str) -> memoryview:
+        """
+        Read-only view over a mmap of the file. Pages are loaded
+        by the OS on demand and nothing is copied into the python heap.
+        The map is released when the last reference to the view is gone.
+        """
         uri = self.uri(key)
         try:
-            for chunk in sopen(uri, "rb"):
+            with open(uri, "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return memoryview(b"")
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception as e:
+            raise KeyReadError(self._bucket, key, str(e))
+        return memoryview(mm)
+
+    def from_file_gen(self, fpath,
+                      chunk_size: int = CHUNK_SIZE) -> Generator[bytes, None, None]:
+        with open(fpath, "rb") as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
                 yield chunk
+
+    def get_stream(self, key: str, chunk_size: int = CHUNK_SIZE,
+                   reuse_buffer: bool = False) -> ChecksumStream:
+        """
+        Chunks of `chunk_size` are read with `readinto` over one buffer.
+        With `reuse_buffer` each chunk is a memoryview of that buffer,
+        only valid until the next chunk is requested, and only md5 is
+        computed because crc32c would need a copy of each chunk.
+        The hashes of the data read are in `checksum` of the stream.
+        """
+        return ChecksumStream(self._iter_file(key, chunk_size, reuse_buffer),
+                              crc32c=not reuse_buffer)
+
+    def _iter_file(self, key: str, chunk_size: int,
+                   reuse_buffer: bool) -> Generator[bytes, None, None]:
+        uri = self.uri(key)
+        view = memoryview(bytearray(chunk_size))
+        try:
+            with open(uri, "rb", buffering=0) as f:
+                while True:
+                    n = f.readinto(view)
+                    if not n:
+                        break
+                    yield view[:n] if reuse_buffer else bytes(view[:n])
         except Exception as e:
             raise KeyReadError(self._bucket, key, str(e))
 
+    def copy_to(self, key: str, dest: "KVLocal", dest_key: Optional[str] = None):
+        """
+        Copy a key into another local store without moving the data
+        through python, see `copy_fd`.
+        """
+        _dest_key = dest_key or key
+        dst = dest.uri(_dest_key)
+        mkdir_p(Path(dst).parent)
+        try:
+            with open(self.uri(key), "rb") as fin, open(dst, "wb") as fout:
+                size = os.fstat(fin.fileno()).st_size
+                copied = copy_fd(fin.fileno(), fout.fileno(), size)
+        except Exception as e:
+            raise KeyWriteError(dest._bucket, _dest_key, str(e))
+        if copied != size:
+            # the source was truncated while it was copied
+            raise KeyWriteError(dest._bucket, _dest_key,
+                                f"{copied} of {size} bytes copied")
+
     def list(self) -> List[str]:
+        if self._levels:
+            return list(scan_shards(self._bucket, self._levels, self._width))
         return os.listdir(self._bucket)
 
+    def iter_keys(self, prefix: Optional[str] = None, page_size: int = 1000,
+                  start_after: Optional[str] = None, with_meta: bool = False
+                  ) -> Generator[Union[str, KeyInfo], None, None]:
+        """ Nested keys are listed, `page_size` is ignored locally """
+        return scan_layout(self._bucket, self._levels, self._width,
+                           prefix, start_after, with_meta)
+
+    def stat(self, key: str) -> Union[KeyInfo, None]:
+        return stat_file(self.uri(key), key)
+
     def delete(self, key: str):
-        delete_file_or_dir(f"{self._bucket}/{key}")
+        delete_file_or_dir(self.uri(key))
+
+    def delete_many(self, keys: Iterable[str],
+                    workers: Optional[int] = None) -> BatchResult:
+        """ unlink is cheap enough locally to not pay a thread pool """
+        results: List[Any] = []
+        errors: Dict[str, Exception] = {}
+        for key in keys:
+            results.append(None)
+            try:
+                self.delete(key)
+            except Exception as e:
+                errors[key] = e
+        return BatchResult(results=results, errors=errors)
 
 
 class AsyncKVLocal(AsyncKVSpec):
-    """For local usage and testing"""
+    """For local usage and testing, layouts are the same of `KVLocal`"""
 
     def __init__(self, bucket: str, client_opts: Dict[str, Any] = {}):
         self._opts = client_opts
         self._bucket = bucket
+        # it calls methods of this store, which can't be sent to processes
+        self._executor = executors.from_opts(client_opts, kinds=("thread",))
+        self._levels, self._width = shard_opts(client_opts)
         mkdir_p(self._bucket)
 
     def uri(self, key):
-        return f"{self._bucket}/{key}"
+        return key_path(self._bucket, key, self._levels, self._width)
 
     async def put(self, key: str, bdata: bytes):
         uri = self.uri(key)
@@ -102,17 +440,19 @@ class AsyncKVLocal(AsyncKVSpec):
 
     async def put_stream(
         self, key: str, generator: Generator[bytes, None, None]
-    ) -> bool:
+    ) -> KeyInfo:
+        """ It returns the size, md5 and crc32c of the data written """
         uri = self.uri(key)
         mkdir_p((Path(uri).parent).resolve())
+        stream = AsyncChecksumStream(generator)
         try:
             async with aiofiles.open(uri, mode="wb") as f:
-                async for data in generator:
+                async for data in stream:
                     await f.write(data)
         except Exception as e:
             raise KeyWriteError(self._bucket, key, str(e))
 
-        return True
+        return stream.checksum.info(key)
 
     async def get(self, key: str) -> Union[bytes, str, None]:
         uri = self.uri(key)
@@ -123,13 +463,19 @@ class AsyncKVLocal(AsyncKVSpec):
         except Exception as e:
             raise KeyReadError(self._bucket, key, str(e))
 
-    async def get_stream(self, key: str) -> AsyncGenerator[bytes, None]:
+    def get_stream(self, key: str,
+                   chunk_size: int = CHUNK_SIZE) -> AsyncChecksumStream:
+        """ The hashes of the data read are in `checksum` of the stream """
+        return AsyncChecksumStream(self._iter_file(key, chunk_size))
+
+    async def _iter_file(self, key: str,
+                         chunk_size: int) -> AsyncGenerator[bytes, None]:
         """PEP 0525 for Asynchronous generators"""
         uri = self.uri(key)
         try:
             async with aiofiles.open(uri, mode="rb") as f:
                 while True:
-                    data = await f.read(1024)
+                    data = await f.read(chunk_size)
                     if not data:
                         break
                     yield data
@@ -138,8 +484,26 @@ class AsyncKVLocal(AsyncKVSpec):
             raise KeyReadError(self._bucket, key, str(e))
 
     async def list(self) -> List[str]:
-        rsp = await run_async(os.listdir, self._bucket)
+        if self._levels:
+            rsp = await run_async(
+                lambda: list(scan_shards(self._bucket, self._levels, self._width)),
+                executor=self._executor)
+        else:
+            rsp = await run_async(os.listdir, self._bucket, executor=self._executor)
+        return rsp
+
+    async def iter_keys(self, prefix: Optional[str] = None, page_size: int = 1000,
+                        start_after: Optional[str] = None, with_meta: bool = False
+                        ) -> AsyncGenerator[Union[str, KeyInfo], None]:
+        async for key in iter_in_thread(scan_layout, self._bucket, self._levels,
+                                        self._width, prefix, start_after,
+                                        with_meta, maxsize=page_size,
+                                        executor=self._executor):
+            yield key
+
+    async def stat(self, key: str) -> Union[KeyInfo, None]:
+        rsp = await run_async(stat_file, self.uri(key), key, executor=self._executor)
         return rsp
 
     async def delete(self, key: str):
-        await run_async(delete_file_or_dir, f"{self._bucket}/{key}")
+        await run_async(delete_file_or_dir, self.uri(key), executor=self._executor)
@@ -0,0 +1,589 @@
+"""
+Store for many small values packed in append-only segment files.
+Each record is written as:
+
+    crc32 | key len | value len | flags | key | value
+
+An in-memory index maps each key to the offset of its value, so
+a `get` is a single `pread`. Overwritten and deleted records are
+reclaimed by compaction and sealed segments could be copied to
+any other store (e.g. GCS) to survive the VM.
+"""
+import os
+import struct
+import threading
+import zlib
+from typing import (Any, AsyncGenerator, Dict, Generator, Iterable, List,
+                    NamedTuple, Optional, Set, Tuple, Union)
+
+from labmachine import executors
+from labmachine.utils import mkdir_p, run_async
+
+from .kvspec import (AsyncKVSpec, BatchResult, GenericKVSpec, KeyInfo,
+                     KeyWriteError)
+
+# crc32, key len, value len, flags
+HEADER = struct.Struct("<IHIB")
+TOMBSTONE = 1
+MAX_KEY = 2 ** 16 - 1
+SEGMENT_BYTES = 64 * 1024 ** 2
+CHUNK_SIZE = 256 * 1024
+
+
+class SegmentError(Exception):
+    def __init__(self, fpath, offset):
+        msg = f"Corrupted record in segment {fpath} at offset {offset}"
+        super().__init__(msg)
+
+
+class Entry(NamedTuple):
+    segment: int
+    # where the value starts inside the segment
+    offset: int
+    size: int
+    # size of the whole record, header included
+    record: int
+
+
+class _Record(NamedTuple):
+    pos: int
+    key: str
+    klen: int
+    vlen: int
+    flags: int
+
+    @property
+    def end(self) -> int:
+        return self.pos + HEADER.size + self.klen + self.vlen
+
+
+def pack_record(key: str, data: bytes, flags: int = 0) -> bytes:
+    kb = key.encode()
+    if len(kb) > MAX_KEY:
+        raise ValueError(f"Key longer than {MAX_KEY} bytes")
+    head = HEADER.pack(0, len(kb), len(data), flags)[4:]
+    crc = zlib.crc32(data, zlib.crc32(kb, zlib.crc32(head)))
+    return b"".join((struct.pack("<I", crc), head, kb, data))
+
+
+def parse_records(data: bytes) -> Tuple[List[_Record], int]:
+    """
+    Records of a segment and the offset where the valid data ends.
+    Parsing stops at the first torn or corrupted record.
+    """
+    records = []
+    view = memoryview(data)
+    pos = 0
+    while pos + HEADER.size <= len(data):
+        crc, klen, vlen, flags = HEADER.unpack_from(data, pos)
+        end = pos + HEADER.size + klen + vlen
+        if end > len(data):
+            break
+        if zlib.crc32(view[pos + 4:end]) != crc:
+            break
+        key = bytes(view[pos + HEADER.size:pos + HEADER.size + klen]).decode()
+        records.append(_Record(pos, key, klen, vlen, flags))
+        pos = end
+    return records, pos
+
+
+def _write_all(fd: int, data: bytes):
+    view = memoryview(data)
+    while view:
+        n = os.write(fd, view)
+        view = view[n:]
+
+
+class PackedLog:
+    """
+    The segments of a packed store under `path`. Only the last segment
+    is written, when it reaches `segment_bytes` it is sealed and a new
+    one is started. It is thread safe.
+
+    Sealed segments are compacted in place when the bytes of stale
+    records are at least `compact_ratio` of the segment. When a `remote`
+    store is given, sealed segments are copied there by `flush`.
+    Both run every `interval` seconds in a background thread after `start`.
+    """
+
+    def __init__(self, path: str, segment_bytes: int = SEGMENT_BYTES,
+                 fsync: bool = False, compact_ratio: float = 0.5,
+                 remote: Optional[GenericKVSpec] = None,
+                 remote_prefix: str = ""):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self.compact_ratio = compact_ratio
+        self.remote = remote
+        self.remote_prefix = remote_prefix
+        self._index: Dict[str, Entry] = {}
+        self._fds: Dict[int, int] = {}
+        self._sizes: Dict[int, int] = {}
+        # bytes of stale records and of tombstones by segment
+        self._dead: Dict[int, int] = {}
+        self._tombs: Dict[int, int] = {}
+        # segment -> size when it was flushed
+        self._flushed: Dict[int, int] = {}
+        # reads in progress by fd, fds replaced meanwhile are closed by
+        # the last reader
+        self._readers: Dict[int, int] = {}
+        self._retired: Set[int] = set()
+        self._lock = threading.RLock()
+        # compaction and flush don't run at the same time
+        self._maintenance = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        mkdir_p(path)
+        self._load()
+
+    @classmethod
+    def from_opts(cls, path: str, opts: Dict[str, Any]) -> "PackedLog":
+        remote = None
+        if opts.get("remote_class"):
+            remote = GenericKVSpec.create(opts["remote_class"],
+                                          opts["remote_bucket"],
+                                          opts.get("remote_opts", {}))
+        log = cls(path,
+                  segment_bytes=opts.get("segment_bytes", SEGMENT_BYTES),
+                  fsync=opts.get("fsync", False),
+                  compact_ratio=opts.get("compact_ratio", 0.5),
+                  remote=remote,
+                  remote_prefix=opts.get("remote_prefix", ""))
+        interval = opts.get("maintenance_interval", 30)
+        if interval:
+            log.start(interval)
+        return log
+
+    def _fpath(self, segment: int) -> str:
+        return f"{self.path}/seg-{segment:08d}.log"
+
+    def _load(self):
+        segments = sorted(int(name[4:12]) for name in os.listdir(self.path)
+                          if name.startswith("seg-") and name.endswith(".log"))
+        for segment in segments:
+            fpath = self._fpath(segment)
+            with open(fpath, "rb") as f:
+                data = f.read()
+            records, end = parse_records(data)
+            if end < len(data):
+                if segment != segments[-1]:
+                    raise SegmentError(fpath, end)
+                # torn write of the last record
+                os.truncate(fpath, end)
+            self._fds[segment] = os.open(fpath, os.O_RDONLY)
+            self._sizes[segment] = end
+            self._dead[segment] = 0
+            self._tombs[segment] = 0
+            for r in records:
+                self._apply(segment, r)
+        if segments and self._sizes[segments[-1]] < self.segment_bytes:
+            self._active = segments[-1]
+            os.close(self._fds[self._active])
+            self._fds[self._active] = os.open(
+                self._fpath(self._active), os.O_RDWR | os.O_APPEND)
+        else:
+            self._new_segment((segments[-1] + 1) if segments else 1)
+
+    def _new_segment(self, segment: int):
+        self._active = segment
+        self._fds[segment] = os.open(self._fpath(segment),
+                                     os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        self._sizes[segment] = 0
+        self._dead[segment] = 0
+        self._tombs[segment] = 0
+
+    def _apply(self, segment: int, r: _Record):
+        record = r.end - r.pos
+        old = self._index.pop(r.key, None)
+        if old is not None:
+            self._dead[old.segment] += old.record
+        if r.flags & TOMBSTONE:
+            self._dead[segment] += record
+            self._tombs[segment] += record
+        else:
+            self._index[r.key] = Entry(segment, r.pos + HEADER.size + r.klen,
+                                       r.vlen, record)
+
+    def _append(self, records: List[Tuple[str, bytes, int]]):
+        buf = b"".join(pack_record(key, data, flags) for key, data, flags in records)
+        with self._lock:
+            fd = self._fds[self._active]
+            _write_all(fd, buf)
+            if self.fsync:
+                os.fsync(fd)
+            pos = self._sizes[self._active]
+            for key, data, flags in records:
+                klen = len(key.encode())
+                r = _Record(pos, key, klen, len(data), flags)
+                self._apply(self._active, r)
+                pos = r.end
+            self._sizes[self._active] = pos
+            if pos >= self.segment_bytes:
+                self._new_segment(self._active + 1)
+
+    def put(self, key: str, data: bytes):
+        self._append([(key, data, 0)])
+
+    def put_many(self, items: Iterable[Tuple[str, bytes]]):
+        """ all the records are appended with one write """
+        self._append([(key, data, 0) for key, data in items])
+
+    def delete(self, key: str):
+        with self._lock:
+            if key not in self._index:
+                return
+            self._append([(key, b"", TOMBSTONE)])
+
+    def get(self, key: str) -> Union[bytes, None]:
+        """ the lock is only taken to find the value, not to read it """
+        with self._lock:
+            entry = self._index.get(key)
+            if entry is None:
+                return None
+            fd = self._fds[entry.segment]
+            self._readers[fd] = self._readers.get(fd, 0) + 1
+        try:
+            return os.pread(fd, entry.size, entry.offset)
+        finally:
+            with self._lock:
+                self._readers[fd] -= 1
+                if not self._readers[fd]:
+                    del self._readers[fd]
+                    if fd in self._retired:
+                        self._retired.discard(fd)
+                        os.close(fd)
+
+    def _close_fd(self, fd: int):
+        """ called with the lock held, the fd still works for ongoing reads """
+        if fd in self._readers:
+            self._retired.add(fd)
+        else:
+            os.close(fd)
+
+    def entry(self, key: str) -> Union[Entry, None]:
+        return self._index.get(key)
+
+    def keys(self) -> List[str]:
+        with self._lock:
+            return list(self._index)
+
+    def sealed(self) -> List[int]:
+        with self._lock:
+            return sorted(s for s in self._sizes if s != self._active)
+
+    def _reclaimable(self, segment: int) -> int:
+        oldest = segment == min(self._sizes)
+        return self._dead[segment] - (0 if oldest else self._tombs[segment])
+
+    def compact(self) -> int:
+        """
+        Rewrite sealed segments with enough stale records.
+        It returns the amount of bytes reclaimed.
+        """
+        reclaimed = 0
+        with self._maintenance:
+            for segment in self.sealed():
+                with self._lock:
+                    size = self._sizes[segment]
+                    due = size and \
+                        self._reclaimable(segment) >= size * self.compact_ratio
+                if due:
+                    reclaimed += self._compact_segment(segment)
+        return reclaimed
+
+    def _compact_segment(self, segment: int) -> int:
+        fpath = self._fpath(segment)
+        with open(fpath, "rb") as f:
+            data = f.read()
+        records, _ = parse_records(data)
+
+        with self._lock:
+            oldest = segment == min(self._sizes)
+            keep = []
+            for r in records:
+                if r.flags & TOMBSTONE:
+                    # older segments could still have a value for the key
+                    if not oldest and r.key not in self._index:
+                        keep.append(r)
+                    continue
+                entry = self._index.get(r.key)
+                if entry and entry.segment == segment and \
+                        entry.offset == r.pos + HEADER.size + r.klen:
+                    keep.append(r)
+
+        tmp = f"{fpath}.compact"
+        with open(tmp, "wb") as f:
+            for r in keep:
+                f.write(data[r.pos:r.end])
+            f.flush()
+            os.fsync(f.fileno())
+
+        with self._lock:
+            self._close_fd(self._fds.pop(segment))
+            self._flushed.pop(segment, None)
+            dead = tombs = pos = 0
+            for r in keep:
+                record = r.end - r.pos
+                if r.flags & TOMBSTONE:
+                    tombs += record
+                    dead += record
+                else:
+                    entry = self._index.get(r.key)
+                    if entry and entry.segment == segment and \
+                            entry.offset == r.pos + HEADER.size + r.klen:
+                        self._index[r.key] = entry._replace(
+                            offset=pos + HEADER.size + r.klen)
+                    else:
+                        dead += record
+                pos += record
+            if pos == 0:
+                os.unlink(tmp)
+                os.unlink(fpath)
+                for d in (self._sizes, self._dead, self._tombs):
+                    d.pop(segment)
+            else:
+                os.replace(tmp, fpath)
+                self._fds[segment] = os.open(fpath, os.O_RDONLY)
+                self._sizes[segment] = pos
+                self._dead[segment] = dead
+                self._tombs[segment] = tombs
+        return len(data) - pos
+
+    def _read_segment(self, segment: int) -> Generator[bytes, None, None]:
+        with open(self._fpath(segment), "rb") as f:
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+
+    def flush(self) -> int:
+        """
+        Copy the sealed segments changed since the last flush to the
+        remote store and remove there the segments already removed.
+        It returns the number of segments copied. Segments the remote
+        store didn't accept are copied again by the next flush and
+        `KeyWriteError` is raised.
+        """
+        if self.remote is None:
+            return 0
+        copied = 0
+        failed: List[str] = []
+        with self._maintenance:
+            sealed = self.sealed()
+            for segment in sealed:
+                size = self._sizes[segment]
+                if self._flushed.get(segment) == size:
+                    continue
+                name = os.path.basename(self._fpath(segment))
+                if not self.remote.put_stream(f"{self.remote_prefix}{name}",
+                                              self._read_segment(segment)):
+                    failed.append(name)
+                    continue
+                self._flushed[segment] = size
+                copied += 1
+            for segment in [s for s in self._flushed if s not in self._sizes]:
+                name = os.path.basename(self._fpath(segment))
+                self.remote.delete(f"{self.remote_prefix}{name}")
+                del self._flushed[segment]
+        if failed:
+            raise KeyWriteError(self.path, f"{self.remote_prefix}{failed[0]}",
+                                f"{len(failed)} segments not copied")
+        return copied
+
+    def _worker(self, interval: float):
+        while not self._stop.wait(interval):
+            try:
+                self.compact()
+                self.flush()
+            except Exception:
+                # it will be tried again in the next round
+                pass
+
+    def start(self, interval: float = 30):
+        """ run compaction and flush every `interval` seconds """
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self._worker, args=(interval,),
+                                        name="packed-log", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        try:
+            self.flush()
+        finally:
+            with self._lock:
+                for fd in self._fds.values():
+                    os.close(fd)
+                self._fds.clear()
+            if self.remote:
+                self.remote.close()
+
+
+def _key_info(key: str, entry: Union[Entry, None]) -> Union[KeyInfo, None]:
+    if entry is None:
+        return None
+    return KeyInfo(key, size=entry.size,
+                   etag=f"{entry.segment:x}-{entry.offset:x}")
+
+
+def _iter_index(log: PackedLog, prefix: Optional[str], start_after: Optional[str],
+                with_meta: bool) -> Generator[Union[str, KeyInfo], None, None]:
+    for key in sorted(log.keys()):
+        if prefix and not key.startswith(prefix):
+            continue
+        if start_after and key <= start_after:
+            continue
+        if with_meta:
+            info = _key_info(key, log.entry(key))
+            if info:
+                yield info
+        else:
+            yield key
+
+
+class KVPacked(GenericKVSpec):
+    """
+    Small values packed in segment files under the `bucket` folder,
+    see `PackedLog`. Options taken from `client_opts`:
+
+    :param segment_bytes: size to seal a segment (default 64MB)
+    :param fsync: fsync after each write (default False)
+    :param compact_ratio: stale bytes to compact a segment (default 0.5)
+    :param maintenance_interval: seconds between compaction and flush
+        rounds, 0 disables the background thread (default 30)
+    :param remote_class: store where sealed segments are copied, optional
+    :param remote_bucket: bucket of the remote store
+    :param remote_opts: client_opts of the remote store
+    :param remote_prefix: prefix for the segments in the remote store
+    """
+
+    def __init__(self, bucket: str, client_opts: Dict[str, Any] = {}):
+        self._opts = client_opts
+        self._bucket = bucket
+        self.log = PackedLog.from_opts(bucket, client_opts)
+
+    def put(self, key: str, bdata: bytes):
+        try:
+            self.log.put(key, bdata)
+        except Exception as e:
+            raise KeyWriteError(self._bucket, key, str(e))
+
+    def put_stream(self, key: str, generator: Generator[bytes, None, None]) -> bool:
+        """ values are small, so the stream is joined in memory """
+        self.put(key, b"".join(generator))
+        return True
+
+    def put_many(self, items: Iterable[Tuple[str, bytes]],
+                 workers: Optional[int] = None) -> BatchResult:
+        _items = list(items)
+        errors: Dict[str, Exception] = {}
+        try:
+            self.log.put_many(_items)
+        except Exception as e:
+            errors = {key: e for key, _ in _items}
+        return BatchResult(results=[None] * len(_items), errors=errors)
+
+    def get(self, key: str) -> Union[bytes, None]:
+        return self.log.get(key)
+
+    def get_stream(self, key: str) -> Generator[bytes, None, None]:
+        data = self.log.get(key)
+        if data:
+            yield data
+
+    def list(self) -> List[str]:
+        return self.log.keys()
+
+    def iter_keys(self, prefix: Optional[str] = None, page_size: int = 1000,
+                  start_after: Optional[str] = None, with_meta: bool = False
+                  ) -> Generator[Union[str, KeyInfo], None, None]:
+        return _iter_index(self.log, prefix, start_after, with_meta)
+
+    def stat(self, key: str) -> Union[KeyInfo, None]:
+        return _key_info(key, self.log.entry(key))
+
+    def delete(self, key: str):
+        self.log.delete(key)
+
+    def compact(self) -> int:
+        return self.log.compact()
+
+    def flush(self) -> int:
+        return self.log.flush()
+
+    def close(self):
+        self.log.close()
+
+
+class AsyncKVPacked(AsyncKVSpec):
+    """ Async version of `KVPacked`, disk I/O is done in a thread """
+
+    def __init__(self, bucket: str, client_opts: Dict[str, Any] = {}):
+        self._opts = client_opts
+        self._bucket = bucket
+        # it calls methods of this store, which can't be sent to processes
+        self._executor = executors.from_opts(client_opts, kinds=("thread",))
+        self.log = PackedLog.from_opts(bucket, client_opts)
+
+    async def put(self, key: str, bdata: bytes):
+        try:
+            await run_async(self.log.put, key, bdata, executor=self._executor)
+        except Exception as e:
+            raise KeyWriteError(self._bucket, key, str(e))
+
+    async def put_stream(
+        self, key: str, generator: AsyncGenerator[bytes, None]
+    ) -> bool:
+        chunks = [chunk async for chunk in generator]
+        await self.put(key, b"".join(chunks))
+        return True
+
+    async def put_many(self, items: Iterable[Tuple[str, bytes]],
+                       concurrency: Optional[int] = None) -> BatchResult:
+        _items = list(items)
+        errors: Dict[str, Exception] = {}
+        try:
+            await run_async(self.log.put_many, _items, executor=self._executor)
+        except Exception as e:
+            errors = {key: e for key, _ in _items}
+        return BatchResult(results=[None] * len(_items), errors=errors)
+
+    async def get(self, key: str) -> Union[bytes, None]:
+        rsp = await run_async(self.log.get, key, executor=self._executor)
+        return rsp
+
+    async def get_stream(self, key: str) -> AsyncGenerator[bytes, None]:
+        data = await self.get(key)
+        if data:
+            yield data
+
+    async def list(self) -> List[str]:
+        return self.log.keys()
+
+    async def iter_keys(self, prefix: Optional[str] = None, page_size: int = 1000,
+                        start_after: Optional[str] = None, with_meta: bool = False
+                        ) -> AsyncGenerator[Union[str, KeyInfo], None]:
+        for key in _iter_index(self.log, prefix, start_after, with_meta):
+            yield key
+
+    async def stat(self, key: str) -> Union[KeyInfo, None]:
+        return _key_info(key, self.log.entry(key))
+
+    async def delete(self, key: str):
+        await run_async(self.log.delete, key, executor=self._executor)
+
+    async def compact(self) -> int:
+        rsp = await run_async(self.log.compact, executor=self._executor)
+        return rsp
+
+    async def flush(self) -> int:
+        rsp = await run_async(self.log.flush, executor=self._executor)
+        return rsp
+
+    async def close(self):
+        await run_async(self.log.close, executor=self._executor)
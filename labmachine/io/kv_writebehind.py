@@ -0,0 +1,421 @@
+"""
+Write-behind wrapper for KV stores. Writes are queued and the caller
+returns right away, background threads send them to the wrapped store
+in batches with `put_many` / `delete_many`:
+
+    store = GenericKVSpec.create(
+        "labmachine.io.kv_writebehind.WriteBehindKV", "my-bucket",
+        {"store_class": "labmachine.io.kv_gcs.KVGS",
+         "queue_size": 10000, "spill_dir": "/tmp/wb"})
+    for i, row in enumerate(rows):
+        store.put(f"logs/{i}", row)
+    store.flush()
+
+Only the last write of a key is kept in the queue. Reads of keys with
+pending writes are served from the queue (read-your-writes). Failed
+writes are retried with an exponential backoff.
+"""
+import itertools
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from typing import (Any, Dict, Generator, Iterable, List, NamedTuple,
+                    Optional, Tuple, Union)
+
+from labmachine.utils import mkdir_p
+
+from .kvspec import (BatchResult, GenericKVSpec, KeyInfo, KeyWriteError,
+                     run_many)
+
+PUT = "put"
+DELETE = "delete"
+CHUNK_SIZE = 256 * 1024
+# length of the key at the start of a spilled file
+KEY_HEADER = struct.Struct("<I")
+SUFFIXES = {PUT: ".op", DELETE: ".del"}
+KINDS = {v: k for k, v in SUFFIXES.items()}
+
+
+class _Op(NamedTuple):
+    seq: int
+    kind: str
+    key: str
+    size: int = 0
+    data: Optional[bytes] = None
+    fpath: Optional[str] = None
+
+
+class SpillDir:
+    """
+    Pending writes kept as files, one per write, named by the order of
+    the write. Puts keep the value (`.op`), deletes only the key (`.del`).
+    Files left by a previous process are recovered.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        mkdir_p(path)
+
+    def _fpath(self, seq: int, kind: str = PUT) -> str:
+        return f"{self.path}/{seq:016d}{SUFFIXES[kind]}"
+
+    def write(self, seq: int, key: str,
+              chunks: Iterable[bytes]) -> Tuple[str, int]:
+        """ it returns the file and the size of the value """
+        return self._write(self._fpath(seq), key, chunks)
+
+    def tombstone(self, seq: int, key: str) -> str:
+        fpath, _ = self._write(self._fpath(seq, DELETE), key, [])
+        return fpath
+
+    def _write(self, fpath: str, key: str,
+               chunks: Iterable[bytes]) -> Tuple[str, int]:
+        bkey = key.encode()
+        size = 0
+        with open(f"{fpath}.tmp", "wb") as f:
+            f.write(KEY_HEADER.pack(len(bkey)) + bkey)
+            for chunk in chunks:
+                f.write(chunk)
+                size += len(chunk)
+        os.replace(f"{fpath}.tmp", fpath)
+        return fpath, size
+
+    def read(self, fpath: str,
+             chunk_size: int = CHUNK_SIZE) -> Generator[bytes, None, None]:
+        with open(fpath, "rb") as f:
+            klen, = KEY_HEADER.unpack(f.read(KEY_HEADER.size))
+            f.seek(klen, os.SEEK_CUR)
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    def remove(self, fpath: str):
+        try:
+            os.unlink(fpath)
+        except FileNotFoundError:
+            pass
+
+    def recover(self) -> List[_Op]:
+        ops = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith(".tmp"):
+                os.unlink(entry.path)
+                continue
+            name, ext = os.path.splitext(entry.name)
+            kind = KINDS.get(ext)
+            if kind is None:
+                continue
+            with open(entry.path, "rb") as f:
+                klen, = KEY_HEADER.unpack(f.read(KEY_HEADER.size))
+                key = f.read(klen).decode()
+            size = entry.stat().st_size - KEY_HEADER.size - klen
+            ops.append(_Op(int(name), kind, key, size, fpath=entry.path))
+        return sorted(ops)
+
+
+class WriteBehindKV(GenericKVSpec):
+    """
+    Puts and deletes are queued and written by background threads.
+    Options taken from `client_opts`, besides `store_class`/`store_opts`:
+
+    :param queue_size: max writes pending, `put` blocks when the queue
+        is full (default 1000)
+    :param put_timeout: seconds `put` waits for room in the queue before
+        raising `KeyWriteError`, by default it waits forever
+    :param batch_size: writes sent to the store at once (default 32)
+    :param flush_workers: background threads (default 2)
+    :param write_retries: attempts of a failed write (default 3)
+    :param retry_backoff: seconds before the first retry of a write,
+        doubled on each attempt (default 0.5)
+    :param retry_backoff_max: max seconds between retries (default 30)
+    :param spill_dir: keep pending puts and deletes in this folder
+        instead of memory, they survive a crash and are written on the
+        next start
+
+    `flush()` waits until every pending write is done and raises
+    `KeyWriteError` if any failed since the last flush. `close()`
+    flushes too. Listings only include keys already written.
+    """
+
+    def __init__(self, bucket: str, client_opts: Dict[str, Any] = {}):
+        self._opts = client_opts
+        self._bucket = bucket
+        self.store = GenericKVSpec.create(
+            client_opts["store_class"], bucket, client_opts.get("store_opts", {}))
+        self.queue_size = client_opts.get("queue_size", 1000)
+        self.put_timeout = client_opts.get("put_timeout")
+        self.batch_size = client_opts.get("batch_size", 32)
+        self.retries = client_opts.get("write_retries", 3)
+        self.backoff = client_opts.get("retry_backoff", 0.5)
+        self.backoff_max = client_opts.get("retry_backoff_max", 30)
+        self.spill = SpillDir(client_opts["spill_dir"]) \
+            if client_opts.get("spill_dir") else None
+        # queued writes by key in arrival order and writes being sent
+        self._pending: "OrderedDict[str, _Op]" = OrderedDict()
+        self._inflight: Dict[str, _Op] = {}
+        self._attempts: Dict[int, int] = {}
+        # monotonic time before which a failed write is not retried
+        self._retry_at: Dict[int, float] = {}
+        self.failed: Dict[str, Exception] = {}
+        self.written = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        start = 0
+        if self.spill:
+            for op in self.spill.recover():
+                self._discard(self._pending.get(op.key))
+                self._pending[op.key] = op
+                start = op.seq + 1
+        self._seq = itertools.count(start)
+        self._workers = [
+            threading.Thread(target=self._run, name=f"writebehind-{i}",
+                             daemon=True)
+            for i in range(client_opts.get("flush_workers", 2))]
+        for w in self._workers:
+            w.start()
+
+    def _discard(self, op: Optional[_Op]):
+        if op is not None and op.fpath and self.spill:
+            self.spill.remove(op.fpath)
+
+    def _enqueue(self, op: _Op):
+        with self._cond:
+            room = self._cond.wait_for(
+                lambda: self._closed or op.key in self._pending
+                or len(self._pending) + len(self._inflight) < self.queue_size,
+                timeout=self.put_timeout)
+            if self._closed or not room:
+                self._discard(op)
+                reason = "store closed" if self._closed else "queue is full"
+                raise KeyWriteError(self._bucket, op.key, reason)
+            old = self._pending.get(op.key)
+            self._pending[op.key] = op
+            if old is not None:
+                self._attempts.pop(old.seq, None)
+                self._retry_at.pop(old.seq, None)
+            self._cond.notify_all()
+        self._discard(old)
+
+    def _new_put(self, key: str, chunks: Iterable[bytes]) -> _Op:
+        seq = next(self._seq)
+        if self.spill:
+            fpath, size = self.spill.write(seq, key, chunks)
+            return _Op(seq, PUT, key, size, fpath=fpath)
+        data = b"".join(chunks)
+        return _Op(seq, PUT, key, len(data), data=data)
+
+    def put(self, key: str, bdata: bytes):
+        self._enqueue(self._new_put(key, [bdata]))
+
+    def put_stream(self, key: str, generator: Generator[bytes, None, None]) -> bool:
+        """ The stream is consumed now, into `spill_dir` if given """
+        self._enqueue(self._new_put(key, generator))
+        return True
+
+    def delete(self, key: str):
+        seq = next(self._seq)
+        fpath = self.spill.tombstone(seq, key) if self.spill else None
+        self._enqueue(_Op(seq, DELETE, key, fpath=fpath))
+
+    def _next_retry(self) -> Optional[float]:
+        """ Seconds until a write waiting to be retried is due """
+        if not self._retry_at:
+            return None
+        return max(0.0, min(self._retry_at.values()) - time.monotonic())
+
+    def _take(self) -> List[_Op]:
+        """ Writes of different keys, the order of each key is kept """
+        batch = []
+        now = time.monotonic()
+        for key, op in list(self._pending.items()):
+            if key in self._inflight or self._retry_at.get(op.seq, 0) > now:
+                continue
+            del self._pending[key]
+            self._retry_at.pop(op.seq, None)
+            self._inflight[key] = op
+            batch.append(op)
+            if len(batch) >= self.batch_size:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            with self._cond:
+                batch = self._take()
+                while not batch and not self._closed:
+                    self._cond.wait(self._next_retry())
+                    batch = self._take()
+                if not batch:
+                    return
+            self._write(batch)
+
+    def _value(self, op: _Op) -> bytes:
+        if op.data is not None:
+            return op.data
+        return b"".join(self.spill.read(op.fpath))  # type: ignore
+
+    def _put_spilled(self, op: _Op):
+        """ The value is streamed from spill_dir, not loaded in memory """
+        if not self.store.put_stream(op.key, self.spill.read(op.fpath)):  # type: ignore
+            raise KeyWriteError(self._bucket, op.key, "upload failed")
+
+    def _send(self, batch: List[_Op]) -> Dict[str, Exception]:
+        """ It returns the errors by key """
+        errors: Dict[str, Exception] = {}
+        puts = [op for op in batch if op.kind == PUT and op.data is not None]
+        spilled = [op for op in batch if op.kind == PUT and op.data is None]
+        deletes = [op.key for op in batch if op.kind == DELETE]
+        if puts:
+            rsp = self.store.put_many((op.key, op.data) for op in puts)
+            errors.update(rsp.errors)
+        if spilled:
+            rsp = run_many(self._put_spilled, [op.key for op in spilled],
+                           [(op,) for op in spilled],
+                           self._batch_workers(None))
+            errors.update(rsp.errors)
+        if deletes:
+            rsp = self.store.delete_many(deletes)
+            for key, err in rsp.errors.items():
+                # deleting a key that was never written is not an error
+                if self.store.exists(key):
+                    errors[key] = err
+        return errors
+
+    def _write(self, batch: List[_Op]):
+        try:
+            errors = self._send(batch)
+        except Exception as e:
+            # the whole batch is retried, the worker keeps running
+            errors = {op.key: e for op in batch}
+        done = []
+        with self._cond:
+            for op in batch:
+                err = errors.get(op.key)
+                if err is None:
+                    self.written += 1
+                    self.failed.pop(op.key, None)
+                    done.append(op)
+                    continue
+                attempts = self._attempts.pop(op.seq, 0) + 1
+                if attempts < self.retries and op.key not in self._pending:
+                    del self._inflight[op.key]
+                    self._attempts[op.seq] = attempts
+                    delay = self.backoff * 2 ** (attempts - 1)
+                    self._retry_at[op.seq] = time.monotonic() + min(
+                        delay, self.backoff_max)
+                    self._pending[op.key] = op
+                else:
+                    self.failed[op.key] = err
+                    done.append(op)
+        # done writes are kept in flight until their spilled files are
+        # removed, so nothing is left behind when `flush` returns
+        for op in done:
+            self._discard(op)
+        with self._cond:
+            for op in done:
+                del self._inflight[op.key]
+            self._cond.notify_all()
+
+    def _lookup(self, key: str) -> Optional[_Op]:
+        with self._cond:
+            return self._pending.get(key) or self._inflight.get(key)
+
+    def _wait_key(self, key: str):
+        with self._cond:
+            self._cond.wait_for(lambda: key not in self._pending
+                                and key not in self._inflight)
+
+    def get(self, key: str) -> Union[bytes, None]:
+        op = self._lookup(key)
+        if op is not None:
+            if op.kind == DELETE:
+                return None
+            try:
+                return self._value(op)
+            except FileNotFoundError:
+                # written and removed from spill_dir meanwhile
+                pass
+        return self.store.get(key)
+
+    def get_stream(self, key: str) -> Generator[bytes, None, None]:
+        op = self._lookup(key)
+        if op is not None and op.kind == DELETE:
+            return
+        if op is not None and op.data is not None:
+            yield op.data
+            return
+        if op is not None:
+            try:
+                yield from self.spill.read(op.fpath)  # type: ignore
+                return
+            except FileNotFoundError:
+                pass
+        yield from self.store.get_stream(key)
+
+    def stat(self, key: str) -> Union[KeyInfo, None]:
+        op = self._lookup(key)
+        if op is not None:
+            return KeyInfo(key, size=op.size) if op.kind == PUT else None
+        return self.store.stat(key)
+
+    def get_if_changed(self, key: str, etag: Optional[str] = None
+                       ) -> Tuple[Union[bytes, None], Union[str, None]]:
+        """ It waits for pending writes of `key`, etags are from the store """
+        self._wait_key(key)
+        return self.store.get_if_changed(key, etag)
+
+    def list(self) -> List[str]:
+        return self.store.list()
+
+    def iter_keys(self, prefix: Optional[str] = None, page_size: int = 1000,
+                  start_after: Optional[str] = None, with_meta: bool = False
+                  ) -> Generator[Union[str, KeyInfo], None, None]:
+        return self.store.iter_keys(prefix, page_size, start_after, with_meta)
+
+    def exists_many(self, keys: Iterable[str],
+                    workers: Optional[int] = None) -> BatchResult:
+        _keys = list(keys)
+        ops = {k: self._lookup(k) for k in _keys}
+        missing = [k for k, op in ops.items() if op is None]
+        rsp = self.store.exists_many(missing, workers)
+        found = dict(zip(missing, rsp.results))
+        results = [found.get(k) if ops[k] is None else ops[k].kind == PUT
+                   for k in _keys]
+        return BatchResult(results=results, errors=rsp.errors)
+
+    def flush(self, timeout: Optional[float] = None):
+        """ Wait for the pending writes, `timeout` in seconds """
+        with self._cond:
+            done = self._cond.wait_for(
+                lambda: not self._pending and not self._inflight,
+                timeout=timeout)
+            failed = self.failed
+            self.failed = {}
+        if not done:
+            raise TimeoutError("Pending writes not flushed in time")
+        if failed:
+            key, err = next(iter(failed.items()))
+            raise KeyWriteError(self._bucket, key,
+                                f"{len(failed)} writes failed, {err}")
+
+    def stats(self) -> Dict[str, int]:
+        with self._cond:
+            return {"pending": len(self._pending),
+                    "inflight": len(self._inflight),
+                    "written": self.written,
+                    "failed": len(self.failed)}
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            with self._cond:
+                self._closed = True
+                self._cond.notify_all()
+            for w in self._workers:
+                w.join()
+            self.store.close()
@@ -1,5 +1,10 @@
+import asyncio
 from abc import ABC, abstractmethod
-from typing import Any, AsyncGenerator, Dict, Generator, List, Union
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+from typing import (Any, AsyncGenerator, AsyncIterator, Callable, Dict,
+                    Generator, Iterable, Iterator, List, NamedTuple, Optional,
+                    Tuple, Union)
 
 from labmachine.utils import get_class
 
@@ -28,6 +33,82 @@ class KeyWriteError(Exception):
         super().__init__(msg)
 
 
+class KeyInfo(NamedTuple):
+    """
+    Metadata of a key, fields not given by the backend are None.
+    `etag` is an opaque version of the value: the generation for GCS,
+    the ETag header for http and mtime plus size for local files.
+    `md5` and `crc32c` are base64 encoded as GCS does.
+    """
+    key: str
+    size: Optional[int] = None
+    mtime: Optional[datetime] = None
+    etag: Optional[str] = None
+    md5: Optional[str] = None
+    crc32c: Optional[str] = None
+
+
+class BatchResult(NamedTuple):
+    """
+    Result of a batch operation. `results` keeps the order of the keys
+    given, a failed key gets None as result and its exception in `errors`.
+    """
+    results: List[Any]
+    errors: Dict[str, Exception]
+
+
+def run_many(func: Callable, keys: List[str], args: Iterable[Tuple],
+             workers: int) -> BatchResult:
+    """
+    Run `func(*arg)` for each arg in a thread pool, keeping at most
+    `workers * 2` calls in flight so lazy iterables are not fully loaded.
+    """
+    results: List[Any] = []
+    errors: Dict[str, Exception] = {}
+    pending = {}
+
+    def _collect(done):
+        for fut in done:
+            ix = pending.pop(fut)
+            try:
+                results[ix] = fut.result()
+            except Exception as e:
+                errors[keys[ix]] = e
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for ix, arg in enumerate(args):
+            results.append(None)
+            pending[pool.submit(func, *arg)] = ix
+            if len(pending) >= workers * 2:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                _collect(done)
+        done, _ = wait(pending)
+        _collect(done)
+    return BatchResult(results=results, errors=errors)
+
+
+async def async_run_many(func: Callable, keys: List[str], args: Iterable[Tuple],
+                         concurrency: int) -> BatchResult:
+    """ Like `run_many` but for coroutines, bounded by a semaphore """
+    sem = asyncio.Semaphore(concurrency)
+
+    async def _call(arg):
+        async with sem:
+            return await func(*arg)
+
+    rsp = await asyncio.gather(*[_call(a) for a in args],
+                               return_exceptions=True)
+    results: List[Any] = []
+    errors: Dict[str, Exception] = {}
+    for key, r in zip(keys, rsp):
+        if isinstance(r, Exception):
+            errors[key] = r
+            results.append(None)
+        else:
+            results.append(r)
+    return BatchResult(results=results, errors=errors)
+
+
 class GenericKVSpec(ABC):
     """
     This is a generic KV store mostly use for project data related
@@ -48,7 +129,14 @@ class GenericKVSpec(ABC):
         pass
 
     @abstractmethod
-    def put_stream(self, key: str, generator: Generator[bytes, None, None]) -> bool:
+    def put_stream(self, key: str, generator: Generator[bytes, None, None]
+                   ) -> Union[bool, KeyInfo]:
+        """
+        A truthy value means the data was written: True or, for backends
+        computing the size and hashes while streaming, a KeyInfo with
+        them (see `checksums.ChecksumStream`). Check it with `if`, not
+        `is True`. Failures are False or a `KeyWriteError`.
+        """
         pass
 
     @abstractmethod
@@ -64,9 +152,98 @@ class GenericKVSpec(ABC):
         pass
 
     @abstractmethod
-    def get_stream(self, key: str) -> Generator[bytes, None, None]:
+    def get_stream(self, key: str) -> Iterator[bytes]:
+        """
+        Backends could return a `checksums.ChecksumStream`, the
+        hashes of the data read are in its `checksum` at the end
+        """
+        pass
+
+    def iter_keys(self, prefix: Optional[str] = None, page_size: int = 1000,
+                  start_after: Optional[str] = None, with_meta: bool = False
+                  ) -> Generator[Union[str, KeyInfo], None, None]:
+        """
+        Lazy listing of keys, optionally filtered by `prefix` and starting
+        after the key `start_after`. With `with_meta` a `KeyInfo` is yielded
+        instead of the key. This default is built over `list()`,
+        backends should override it to avoid loading every key.
+        """
+        for key in sorted(self.list()):
+            if prefix and not key.startswith(prefix):
+                continue
+            if start_after and key <= start_after:
+                continue
+            yield KeyInfo(key) if with_meta else key
+
+    @abstractmethod
+    def stat(self, key: str) -> Union[KeyInfo, None]:
+        """ Metadata of the key without downloading it, None if not found """
+        pass
+
+    def exists(self, key: str) -> bool:
+        return self.stat(key) is not None
+
+    def get_if_changed(self, key: str, etag: Optional[str] = None
+                       ) -> Tuple[Union[bytes, None], Union[str, None]]:
+        """
+        Conditional get. It returns the value and its current etag,
+        if `etag` is still the current version the value is None,
+        if the key doesn't exist both are None:
+
+            data, etag = store.get_if_changed("config.json", etag)
+            if data is not None:
+                reload(data)
+        """
+        info = self.stat(key)
+        if info is None:
+            return None, None
+        if etag and info.etag == etag:
+            return None, etag
+        return self.get(key), info.etag
+
+    def _batch_workers(self, workers: Optional[int]) -> int:
+        return workers or self._opts.get("batch_workers", 8)
+
+    def get_many(self, keys: Iterable[str],
+                 workers: Optional[int] = None) -> BatchResult:
+        _keys = list(keys)
+        return run_many(self.get, _keys, [(k,) for k in _keys],
+                        self._batch_workers(workers))
+
+    def put_many(self, items: Iterable[Tuple[str, bytes]],
+                 workers: Optional[int] = None) -> BatchResult:
+        keys: List[str] = []
+
+        def _args():
+            for key, bdata in items:
+                keys.append(key)
+                yield (key, bdata)
+
+        return run_many(self.put, keys, _args(), self._batch_workers(workers))
+
+    def delete_many(self, keys: Iterable[str],
+                    workers: Optional[int] = None) -> BatchResult:
+        _keys = list(keys)
+        return run_many(self.delete, _keys, [(k,) for k in _keys],
+                        self._batch_workers(workers))
+
+    def exists_many(self, keys: Iterable[str],
+                    workers: Optional[int] = None) -> BatchResult:
+        """ `results` are booleans, backends could use batch requests """
+        _keys = list(keys)
+        return run_many(self.exists, _keys, [(k,) for k in _keys],
+                        self._batch_workers(workers))
+
+    def close(self):
+        """Release any resource (connections, files) held by the store"""
         pass
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
     @staticmethod
     def create(store_class, bucket, opts: Dict[str, Any] = {}) -> "GenericKVSpec":
         Class = get_class(store_class)
@@ -96,7 +273,8 @@ class AsyncKVSpec(ABC):
     @abstractmethod
     async def put_stream(
         self, key: str, generator: Generator[bytes, None, None]
-    ) -> bool:
+    ) -> Union[bool, KeyInfo]:
+        """ See `GenericKVSpec.put_stream` """
         pass
 
     @abstractmethod
@@ -112,9 +290,81 @@ class AsyncKVSpec(ABC):
         pass
 
     @abstractmethod
-    async def get_stream(self, key: str) -> AsyncGenerator[bytes, None]:
+    def get_stream(self, key: str) -> AsyncIterator[bytes]:
+        """
+        Not a coroutine: it gives an async iterator to use with
+        `async for`, either an async generator or a
+        `checksums.AsyncChecksumStream`, see `GenericKVSpec.get_stream`
+        """
+        pass
+
+    async def iter_keys(self, prefix: Optional[str] = None, page_size: int = 1000,
+                        start_after: Optional[str] = None, with_meta: bool = False
+                        ) -> AsyncGenerator[Union[str, KeyInfo], None]:
+        """ See `GenericKVSpec.iter_keys` """
+        for key in sorted(await self.list()):
+            if prefix and not key.startswith(prefix):
+                continue
+            if start_after and key <= start_after:
+                continue
+            yield KeyInfo(key) if with_meta else key
+
+    @abstractmethod
+    async def stat(self, key: str) -> Union[KeyInfo, None]:
+        """ See `GenericKVSpec.stat` """
         pass
 
+    async def exists(self, key: str) -> bool:
+        return (await self.stat(key)) is not None
+
+    async def get_if_changed(self, key: str, etag: Optional[str] = None
+                             ) -> Tuple[Union[bytes, None], Union[str, None]]:
+        """ See `GenericKVSpec.get_if_changed` """
+        info = await self.stat(key)
+        if info is None:
+            return None, None
+        if etag and info.etag == etag:
+            return None, etag
+        return await self.get(key), info.etag
+
+    def _batch_concurrency(self, concurrency: Optional[int]) -> int:
+        return concurrency or self._opts.get("batch_concurrency", 16)
+
+    async def get_many(self, keys: Iterable[str],
+                       concurrency: Optional[int] = None) -> BatchResult:
+        _keys = list(keys)
+        return await async_run_many(self.get, _keys, [(k,) for k in _keys],
+                                    self._batch_concurrency(concurrency))
+
+    async def put_many(self, items: Iterable[Tuple[str, bytes]],
+                       concurrency: Optional[int] = None) -> BatchResult:
+        _items = list(items)
+        return await async_run_many(self.put, [k for k, _ in _items], _items,
+                                    self._batch_concurrency(concurrency))
+
+    async def delete_many(self, keys: Iterable[str],
+                          concurrency: Optional[int] = None) -> BatchResult:
+        _keys = list(keys)
+        return await async_run_many(self.delete, _keys, [(k,) for k in _keys],
+                                    self._batch_concurrency(concurrency))
+
+    async def exists_many(self, keys: Iterable[str],
+                          concurrency: Optional[int] = None) -> BatchResult:
+        """ See `GenericKVSpec.exists_many` """
+        _keys = list(keys)
+        return await async_run_many(self.exists, _keys, [(k,) for k in _keys],
+                                    self._batch_concurrency(concurrency))
+
+    async def close(self):
+        """Release any resource (connections, files) held by the store"""
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
     @staticmethod
     def create(store_class, bucket, opts: Dict[str, Any] = {}) -> "GenericKVSpec":
         Class = get_class(store_class)
@@ -0,0 +1,169 @@
+"""
+Incremental sync between a local directory and a prefix of a KV store,
+in the spirit of rsync. Files are compared against the listing metadata
+of the store, nothing is downloaded to be compared:
+
+    from labmachine.io.sync import sync
+
+    rsp = sync("notebooks/", store, "projects/p1/notebooks", direction="push")
+
+A file is transferred when it is missing on the other side or its size
+differs. When sizes match, the md5 or crc32c of the local file is compared
+if the store gives one (e.g. GCS), otherwise the mtime is used: a file is
+pushed when the local copy is newer and pulled when the remote is newer
+(pulled files get the remote mtime).
+"""
+import os
+from typing import Dict, Generator, List, NamedTuple, Optional
+
+from labmachine.utils import local_path
+
+from .checksums import file_checksum
+from .kvspec import GenericKVSpec, KeyInfo, KeyWriteError, run_many
+
+PUSH = "push"
+PULL = "pull"
+CHUNK_SIZE = 1024 * 1024
+_TMP_SUFFIX = ".sync-tmp"
+
+
+class SyncResult(NamedTuple):
+    """ Keys are relative to the prefix (and paths to the local dir) """
+    transferred: List[str]
+    deleted: List[str]
+    skipped: int
+    errors: Dict[str, Exception]
+
+
+def _local_files(root: str) -> Dict[str, os.stat_result]:
+    files = {}
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            if name.endswith(_TMP_SUFFIX):
+                continue
+            fpath = os.path.join(dirpath, name)
+            rel = os.path.relpath(fpath, root).replace(os.sep, "/")
+            files[rel] = os.stat(fpath)
+    return files
+
+
+def _remote_keys(store: GenericKVSpec, prefix: str) -> Dict[str, KeyInfo]:
+    keys = {}
+    for info in store.iter_keys(prefix=prefix or None, with_meta=True):
+        rel = info.key[len(prefix):]
+        # placeholders of folders created by some tools
+        if rel and not rel.endswith("/"):
+            keys[rel] = info
+    return keys
+
+
+def is_changed(fpath: str, st: os.stat_result, info: KeyInfo,
+               direction: str) -> bool:
+    """ If the local file `fpath` and the remote `info` are different """
+    if info.size is not None and info.size != st.st_size:
+        return True
+    if info.md5:
+        return file_checksum(fpath, crc32c=False).md5 != info.md5
+    if info.crc32c:
+        crc = file_checksum(fpath, md5=False).crc32c
+        if crc is not None:
+            return crc != info.crc32c
+    if info.mtime is None:
+        return True
+    if direction == PUSH:
+        return st.st_mtime > info.mtime.timestamp()
+    return info.mtime.timestamp() > st.st_mtime
+
+
+def _read_chunks(fpath: str, chunk_size: int) -> Generator[bytes, None, None]:
+    with open(fpath, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+def _download(store: GenericKVSpec, key: str, fpath: str,
+              info: Optional[KeyInfo]):
+    """ The file is written aside and moved, a failed pull leaves no trace """
+    os.makedirs(os.path.dirname(fpath) or ".", exist_ok=True)
+    tmp = f"{fpath}{_TMP_SUFFIX}"
+    try:
+        with open(tmp, "wb") as f:
+            for chunk in store.get_stream(key):
+                f.write(chunk)
+        os.replace(tmp, fpath)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    if info is not None and info.mtime is not None:
+        ts = info.mtime.timestamp()
+        os.utime(fpath, (ts, ts))
+
+
+def sync(local_dir: str, store: GenericKVSpec, prefix: str = "",
+         direction: str = PUSH, delete: bool = False, workers: int = 8,
+         dry_run: bool = False, chunk_size: int = CHUNK_SIZE) -> SyncResult:
+    """
+    Make `prefix` in `store` match `local_dir` (push) or the other way
+    around (pull). Comparing and transferring is done by `workers` threads.
+
+    :param delete: remove files or keys not found in the source
+    :param dry_run: only report what would be transferred or deleted
+    """
+    if direction not in (PUSH, PULL):
+        raise ValueError(f"Direction {direction} not supported")
+    prefix = prefix.strip("/")
+    if prefix:
+        prefix = f"{prefix}/"
+    local = _local_files(local_dir) if os.path.isdir(local_dir) else {}
+    remote = _remote_keys(store, prefix)
+    source, target = (local, remote) if direction == PUSH else (remote, local)
+
+    def _sync_one(rel: str) -> bool:
+        # remote keys could point outside of local_dir, e.g. "../x"
+        fpath = local_path(local_dir, rel)
+        info = remote.get(rel)
+        st = local.get(rel)
+        if info is not None and st is not None \
+           and not is_changed(fpath, st, info, direction):
+            return False
+        if dry_run:
+            return True
+        if direction == PUSH:
+            key = f"{prefix}{rel}"
+            # stores report some failures (e.g. a checksum mismatch) as False
+            if not store.put_stream(key, _read_chunks(fpath, chunk_size)):
+                raise KeyWriteError(store._bucket, key, "upload failed")
+        else:
+            _download(store, f"{prefix}{rel}", fpath, info)
+        return True
+
+    rels = sorted(source)
+    rsp = run_many(_sync_one, rels, [(r,) for r in rels], workers)
+    transferred = [r for r, done in zip(rels, rsp.results) if done]
+    skipped = rsp.results.count(False)
+    errors = dict(rsp.errors)
+
+    deleted: List[str] = []
+    extra = sorted(set(target) - set(source)) if delete else []
+    if extra and dry_run:
+        deleted = extra
+    elif extra and direction == PUSH:
+        drsp = store.delete_many([f"{prefix}{r}" for r in extra],
+                                 workers=workers)
+        for rel in extra:
+            if f"{prefix}{rel}" in drsp.errors:
+                errors[rel] = drsp.errors[f"{prefix}{rel}"]
+            else:
+                deleted.append(rel)
+    elif extra:
+        for rel in extra:
+            try:
+                os.remove(os.path.join(local_dir, *rel.split("/")))
+                deleted.append(rel)
+            except OSError as e:
+                errors[rel] = e
+    return SyncResult(transferred=transferred, deleted=deleted,
+                      skipped=skipped, errors=errors)
@@ -1,14 +1,29 @@
+import builtins
 import io
+import itertools
+import json
+import mimetypes
+import os
+from collections import deque
+from concurrent.futures import (FIRST_COMPLETED, Future, ThreadPoolExecutor,
+                                wait)
 from datetime import timedelta
-from typing import Dict, Generator, List, Optional, Union
+from typing import (Any, Callable, Dict, Generator, Iterable, List, Optional,
+                    Set, Tuple, Union)
 
-from labmachine import types
+from labmachine import executors, types
 from labmachine.base import StorageSpec
 from labmachine.errors import BlobNotFound, BucketForbidden, BucketNotFound
+from labmachine.io.gcs_client import batch_responses, get_client
+from labmachine.io.gcs_transfer import (DOWNLOAD_WORKERS, PART_SIZE,
+                                        SLICE_SIZE, UPLOAD_WORKERS,
+                                        composite_upload, iter_sliced,
+                                        sliced_download,
+                                        sliced_download_to_file)
+from labmachine.utils import local_path
 from smart_open import open
 
-from google.api_core.exceptions import Forbidden
-from google.cloud.storage import Client
+from google.api_core.exceptions import Forbidden, from_http_response
 from google.cloud.storage import blob as gblob
 from google.cloud.storage.bucket import Bucket as GoogleBucket
 
@@ -19,10 +34,155 @@ LOCS = {
     types.BucketLocation.ASIA.value: "ASIA",
     types.BucketLocation.US.value: "US",
     types.BucketLocation.EU.value: "EU",
-    types.BucketLocation.US_CENTRAL.value: "US-CENTRAL1",
+    types.BucketLocation.US_CENTRAL1.value: "US-CENTRAL1",
     types.BucketLocation.US_EAST1.value: "US-EAST1"
 }
 
+# max calls allowed by GCS in a batch request
+DELETE_BATCH = 100
+DELETE_WORKERS = 8
+# keys signed by each call sent to an executor
+SIGN_CHUNK = 500
+TRANSFER_WORKERS = 8
+# max small files sent at once to a worker of `upload_dir`/`download_dir`
+TRANSFER_BATCH = 64
+MANIFEST = ".labmachine-transfer"
+PART_SUFFIX = ".labmachine-part"
+
+
+def _version_name(key: str, version: Optional[str] = None) -> str:
+    return f"{key}#{version}" if version else key
+
+
+def _sign_keys(creds: str, project: Optional[str], bucket: str,
+               keys: List[str], method: str, minutes: int,
+               content_type: Optional[str]) -> List[str]:
+    """
+    Module level so it could run in a process pool, the client (and
+    its credentials) is cached by `get_client` in each process.
+    """
+    _b = get_client(creds, project).bucket(bucket)
+    expiration = timedelta(minutes=minutes)
+    return [_b.blob(key).generate_signed_url(
+        version="v4", expiration=expiration, method=method,
+        content_type=content_type) for key in keys]
+
+
+def _upload_files(creds: str, project: Optional[str], bucket: str,
+                  files: List[Tuple[str, str]],
+                  part_size: int) -> List[Optional[str]]:
+    """
+    Upload `(fpath, key)` pairs, files bigger than `part_size` in parallel
+    parts. It returns the error of each file, None when it was uploaded.
+    Module level so it could run in a process pool.
+    """
+    _b = get_client(creds, project).bucket(bucket)
+    errors: List[Optional[str]] = []
+    for fpath, key in files:
+        try:
+            if os.path.getsize(fpath) > part_size:
+                with builtins.open(fpath, "rb") as f:
+                    composite_upload(
+                        _b, key, iter(lambda: f.read(part_size), b""),
+                        part_size=part_size, workers=UPLOAD_WORKERS,
+                        content_type=mimetypes.guess_type(fpath)[0])
+            else:
+                _b.blob(key).upload_from_filename(fpath)
+            errors.append(None)
+        except Exception as e:
+            errors.append(str(e))
+    return errors
+
+
+def _download_files(creds: str, project: Optional[str], bucket: str,
+                    blobs: List[Tuple[str, int, str]],
+                    slice_size: int) -> List[Optional[str]]:
+    """
+    Download `(key, generation, fpath)`, objects bigger than `slice_size`
+    by ranges. Files are written aside and moved when complete.
+    It returns the error of each object, None when it was downloaded.
+    """
+    _b = get_client(creds, project).bucket(bucket)
+    errors: List[Optional[str]] = []
+    for key, generation, fpath in blobs:
+        tmp = f"{fpath}{PART_SUFFIX}"
+        try:
+            os.makedirs(os.path.dirname(fpath) or ".", exist_ok=True)
+            _blob = _b.get_blob(key, generation=generation)
+            if _blob is None:
+                raise BlobNotFound(bucket=bucket, key=key)
+            if _blob.size > slice_size:
+                sliced_download_to_file(_blob, tmp, slice_size=slice_size,
+                                        workers=DOWNLOAD_WORKERS)
+            else:
+                _blob.download_to_filename(tmp)
+            os.replace(tmp, fpath)
+            errors.append(None)
+        except Exception as e:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            errors.append(str(e))
+    return errors
+
+
+class _Manifest:
+    """
+    Files already transferred, as json lines appended when each one is
+    done. A file is skipped on a new run while its stamp (size and mtime
+    of the local file or generation of the object) is the same.
+    """
+
+    def __init__(self, fpath: str):
+        self.fpath = fpath
+        self._done: Dict[Tuple[str, str], Any] = {}
+        line = "\n"
+        if os.path.exists(fpath):
+            with builtins.open(fpath) as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        # the last line of an interrupted run
+                        continue
+                    self._done[(rec["object"], rec["file"])] = rec["stamp"]
+        self._f = builtins.open(fpath, "a")
+        if not line.endswith("\n"):
+            self._f.write("\n")
+
+    def is_done(self, obj: str, rel: str, stamp: Any) -> bool:
+        return self._done.get((obj, rel)) == stamp
+
+    def add(self, obj: str, rel: str, stamp: Any):
+        self._f.write(json.dumps(
+            {"object": obj, "file": rel, "stamp": stamp}) + "\n")
+        self._f.flush()
+
+    def close(self, remove: bool = False):
+        self._f.close()
+        if remove:
+            os.remove(self.fpath)
+
+
+def _batches(items: Iterable[Tuple[Any, int]], limit: int
+             ) -> Generator[List[Any], None, None]:
+    """
+    Group `(item, size)` so each batch is one big item or up to
+    `TRANSFER_BATCH` small ones adding up to `limit` bytes.
+    """
+    batch: List[Any] = []
+    size = 0
+    for item, _size in items:
+        if _size > limit:
+            yield [item]
+            continue
+        batch.append(item)
+        size += _size
+        if len(batch) >= TRANSFER_BATCH or size >= limit:
+            yield batch
+            batch, size = [], 0
+    if batch:
+        yield batch
+
 
 # class Storage(StorageSpec):
 class Storage(StorageSpec):
@@ -36,18 +196,24 @@ class Storage(StorageSpec):
 
         conf = get_auth_conf(env_var=keyvar, filepath=filepath)
 
-        self.driver = Client.from_service_account_json(conf.CREDENTIALS)
+        self._conf = conf
+        self.driver = get_client(conf.CREDENTIALS, conf.PROJECT)
         super().__init__(keyvar=keyvar, filepath=filepath)
+        if bucket:
+            # bound without a request, use `set_bucket` to check it
+            self._bucket = self.driver.bucket(bucket)
 
     def set_bucket(self, name: str) -> types.Bucket:
+        """ Fetch the bucket `name` and use it as the current one """
         try:
             b = self.driver.get_bucket(name)
         except Forbidden:
             raise BucketForbidden(name)
         except gblob.exceptions.NotFound:
-            self._bucket = b
-
-        return self._to_bucket(b)
+            raise BucketNotFound(name)
+        self._bucket = b
+        self.bucket = self._to_bucket(b)
+        return self.bucket
 
     def create_bucket(self,
                       name: str,
@@ -70,7 +236,7 @@ class Storage(StorageSpec):
 
     def _current_or_get_bucket(self, bucket=None) -> GoogleBucket:
         if bucket:
-            _b = self.driver.get_bucket(bucket)
+            _b = self.driver.bucket(bucket)
         else:
             _b = self._bucket
 
@@ -110,7 +276,7 @@ class Storage(StorageSpec):
             name=obj.name,
             providerid=self.providerid,
             size=obj.size,
-            bucket=self.bucket.name,
+            bucket=self._bucket.name,
             content_type=obj.content_type,
             metadata=obj.metadata,
             version=str(obj.generation),
@@ -135,75 +301,339 @@ class Storage(StorageSpec):
         blobs = [self._to_blob(b) for b in _blobs]
         return blobs
 
-    def put_bytes(self, key: str, *, content: Union[bytes, io.BytesIO],
-                  metadata: Optional[Dict[str, str]] = None) -> types.Blob:
+    def iter_pages(self, prefix: Optional[str] = None,
+                   page_size: int = 1000,
+                   page_token: Optional[str] = None,
+                   history: bool = False,
+                   **list_opts) -> Generator[types.BlobsPage, None, None]:
+        """
+        Pages are requested as they are consumed. The `next_page_token`
+        of a page could be given as `page_token` to continue later.
+        `list_opts` are passed to `list_blobs` (e.g. `start_offset`).
+        """
+        _blobs = self._bucket.list_blobs(prefix=prefix,
+                                         page_size=page_size,
+                                         page_token=page_token,
+                                         versions=history,
+                                         **list_opts)
+        for page in _blobs.pages:
+            yield types.BlobsPage(blobs=[self._to_blob(b) for b in page],
+                                  next_page_token=_blobs.next_page_token)
+
+    def iter_objects(self, prefix: Optional[str] = None,
+                     page_size: int = 1000,
+                     page_token: Optional[str] = None,
+                     history: bool = False) -> Generator[types.Blob, None, None]:
+        """ Like `list_objects` but blobs are yielded one page at a time """
+        for page in self.iter_pages(prefix, page_size, page_token, history):
+            yield from page.blobs
+
+    def put_bytes(self, key: str, *,
+                  content: Union[bytes, bytearray, memoryview, io.BytesIO],
+                  metadata: Optional[Dict[str, str]] = None,
+                  content_type: Optional[str] = None) -> types.Blob:
+        """
+        Metadata and content type are sent along with the data in the
+        same request.
+        """
         blob = self._bucket.blob(key)
-        blob.metdata = metadata
-        if isinstance(content, bytes):
-            blob.upload_from_file(io.BytesIO(content))
+        blob.metadata = metadata
+        if content_type:
+            blob.content_type = content_type
+        if isinstance(content, (bytes, bytearray, memoryview)):
+            # the library sends bytes, other buffers are copied once
+            data = content if isinstance(content, bytes) \
+                else memoryview(content).cast("B").tobytes()
+            blob.upload_from_string(data, content_type=content_type)
         else:
-            blob.upload_from_file(content)
+            blob.upload_from_file(content, content_type=content_type)
         return self._to_blob(blob)
 
     def put_stream(self, key: str, generator: Generator[bytes, None, None],
-                   metadata: Optional[Dict[str, str]] = None) -> bool:
-        with open(f"gs://{self.bucket.name}/{key}",
-                  "wb", client=self.driver) as f:
-            data = True
-            while data:
-                try:
-                    _data = generator.__next__()
-                    f.write(_data)
-                except StopIteration:
-                    data = False
-        if metadata:
-            blob = self._bucket.get_blob(key)
-            blob.metadata = metadata
-            blob.patch()
+                   metadata: Optional[Dict[str, str]] = None,
+                   parallel: bool = False,
+                   part_size: int = PART_SIZE,
+                   workers: int = UPLOAD_WORKERS,
+                   content_type: Optional[str] = None) -> bool:
+        """
+        Metadata and content type are sent when the upload session
+        is started, no other request is needed after the upload.
 
+        :param parallel: if true, parts of `part_size` are uploaded
+        by `workers` threads and composed at the end.
+        """
+        if parallel:
+            composite_upload(self._bucket, key, generator,
+                             part_size=part_size, workers=workers,
+                             content_type=content_type, metadata=metadata)
+            return True
+        props: Dict[str, Any] = {}
+        if metadata:
+            props["metadata"] = metadata
+        if content_type:
+            props["content_type"] = content_type
+        with open(f"gs://{self._bucket.name}/{key}", "wb",
+                  transport_params={"client": self.driver,
+                                    "blob_properties": props}) as f:
+            for chunk in generator:
+                f.write(chunk)
         return True
 
-    def get_bytes(self, key: str, version=None) -> bytes:
-        blob = self._bucket.blob(key)
+    def _get_blob_or_raise(self, key: str, version=None) -> gblob.Blob:
+        _blob = self._bucket.get_blob(key, generation=version)
+        if _blob is None:
+            raise BlobNotFound(bucket=self._bucket.name, key=key)
+        return _blob
+
+    def get_bytes(self, key: str, version=None,
+                  parallel: bool = False,
+                  slice_size: int = SLICE_SIZE,
+                  workers: int = DOWNLOAD_WORKERS) -> bytes:
+        """
+        :param parallel: if true, ranges of `slice_size` are downloaded
+        by `workers` threads into a preallocated buffer.
+        """
+        if parallel:
+            _blob = self._get_blob_or_raise(key, version)
+            return sliced_download(_blob, slice_size=slice_size,
+                                   workers=workers)
+        blob = self._bucket.blob(key, generation=version)
         try:
             obj = blob.download_as_bytes()
         except gblob.exceptions.NotFound:
-            raise BlobNotFound(bucket=self.bucket.name, key=key)
+            raise BlobNotFound(bucket=self._bucket.name, key=key)
 
         return obj
 
+    def download_file(self, key: str, fpath: str, version=None,
+                      slice_size: int = SLICE_SIZE,
+                      workers: int = DOWNLOAD_WORKERS):
+        """ Ranges of the object are written concurrently into `fpath` """
+        _blob = self._get_blob_or_raise(key, version)
+        sliced_download_to_file(_blob, fpath, slice_size=slice_size,
+                                workers=workers)
+
+    def _transfer(self, fn: Callable, bucket: str,
+                  entries: Iterable[Tuple[str, str, Any, int, Any]],
+                  limit: int, manifest: _Manifest, workers: int,
+                  executor: Optional[str],
+                  progress: Optional[Callable[[types.TransferReport], None]],
+                  report: Optional[types.TransferReport] = None
+                  ) -> types.TransferReport:
+        """
+        `entries` are `(object, rel, stamp, size, arg)`, the `arg` of
+        each one is given to `fn` in batches. At most `workers * 2`
+        batches are waiting for a worker. `entries` could add errors
+        to `report` while they are listed.
+        """
+        if report is None:
+            report = types.TransferReport()
+        args = (self._conf.CREDENTIALS, self._conf.PROJECT, bucket)
+        pending: Dict[Future, List[Tuple[str, str, Any, int, Any]]] = {}
+        pool = executors.get(executor) if executor \
+            else ThreadPoolExecutor(max_workers=workers)
+
+        def _todo():
+            for entry in entries:
+                if manifest.is_done(*entry[:3]):
+                    report.skipped += 1
+                else:
+                    yield entry, entry[3]
+
+        def _collect(done):
+            for fut in done:
+                batch = pending.pop(fut)
+                try:
+                    errors = fut.result()
+                except Exception as e:
+                    errors = [str(e)] * len(batch)
+                for (obj, rel, stamp, size, _), error in zip(batch, errors):
+                    if error is None:
+                        manifest.add(obj, rel, stamp)
+                        report.transferred += 1
+                        report.bytes += size
+                    else:
+                        report.errors[rel] = error
+                if progress:
+                    progress(report)
+
+        try:
+            for batch in _batches(_todo(), limit):
+                fut = pool.submit(fn, *args, [e[4] for e in batch], limit)
+                pending[fut] = batch
+                if len(pending) >= workers * 2:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    _collect(done)
+            done, _ = wait(pending)
+            _collect(done)
+        finally:
+            manifest.close()
+            if executor is None:
+                pool.shutdown()
+        if not report.errors:
+            os.remove(manifest.fpath)
+        return report
+
+    def upload_dir(self, local_dir: str, prefix: str = "", bucket=None,
+                   workers: int = TRANSFER_WORKERS,
+                   executor: Optional[str] = None,
+                   part_size: int = PART_SIZE,
+                   manifest: Optional[str] = None,
+                   progress: Optional[Callable[[types.TransferReport], None]] = None
+                   ) -> types.TransferReport:
+        """
+        Upload the files under `local_dir` to `prefix`, keys are their
+        relative paths. Small files are sent in batches to `workers`
+        threads, or to `executor` (see `labmachine.executors`, e.g. a
+        process pool). Files bigger than `part_size` are uploaded in
+        parallel parts.
+
+        Uploaded files are recorded in `manifest` (by default a file in
+        `local_dir`), calling it again after an interruption or errors
+        skips them. It's removed when everything was uploaded.
+        """
+        _name = bucket or self._bucket.name
+        _prefix = prefix.strip("/")
+        if _prefix:
+            _prefix = f"{_prefix}/"
+        _manifest = _Manifest(manifest or os.path.join(local_dir, MANIFEST))
+
+        def _entries():
+            for dirpath, _, filenames in os.walk(local_dir):
+                for name in sorted(filenames):
+                    fpath = os.path.join(dirpath, name)
+                    if name == MANIFEST or name.endswith(PART_SUFFIX) \
+                       or os.path.samefile(fpath, _manifest.fpath):
+                        continue
+                    st = os.stat(fpath)
+                    rel = os.path.relpath(fpath, local_dir).replace(os.sep, "/")
+                    key = f"{_prefix}{rel}"
+                    yield (f"gs://{_name}/{key}", rel,
+                           [st.st_size, st.st_mtime_ns], st.st_size,
+                           (fpath, key))
+
+        return self._transfer(_upload_files, _name, _entries(), part_size,
+                              _manifest, workers, executor, progress)
+
+    def download_dir(self, prefix: str, local_dir: str, bucket=None,
+                     workers: int = TRANSFER_WORKERS,
+                     executor: Optional[str] = None,
+                     slice_size: int = SLICE_SIZE,
+                     manifest: Optional[str] = None,
+                     progress: Optional[Callable[[types.TransferReport], None]] = None
+                     ) -> types.TransferReport:
+        """
+        Download the objects under `prefix` into `local_dir`, the
+        counterpart of `upload_dir`. The listing is streamed, objects
+        bigger than `slice_size` are downloaded by ranges. Each object
+        is pinned to the generation listed, it is recorded in the
+        manifest along with the file.
+
+        Objects whose names would be written outside of `local_dir`
+        (`..`, empty or absolute parts) are not downloaded, they are
+        reported as errors.
+        """
+        _b = self._current_or_get_bucket(bucket)
+        _prefix = prefix.strip("/")
+        if _prefix:
+            _prefix = f"{_prefix}/"
+        os.makedirs(local_dir, exist_ok=True)
+        _manifest = _Manifest(manifest or os.path.join(local_dir, MANIFEST))
+        report = types.TransferReport()
+
+        def _entries():
+            listing = _b.list_blobs(
+                prefix=_prefix or None,
+                fields="items(name,size,generation),nextPageToken")
+            for blob in listing:
+                rel = blob.name[len(_prefix):]
+                # placeholders of folders created by some tools
+                if not rel or rel.endswith("/"):
+                    continue
+                try:
+                    fpath = local_path(local_dir, rel)
+                except ValueError as e:
+                    report.errors[rel] = str(e)
+                    continue
+                yield (f"gs://{_b.name}/{blob.name}", rel, blob.generation,
+                       blob.size, (blob.name, blob.generation, fpath))
+
+        return self._transfer(_download_files, _b.name, _entries(),
+                              slice_size, _manifest, workers, executor,
+                              progress, report)
+
     def get_blob(self, key: str, version=None) -> types.Blob:
         _blob = self._bucket.get_blob(key, generation=version)
         try:
             _id = _blob.id
         except AttributeError:
-            raise BlobNotFound(bucket=self.bucket.name, key=key)
+            raise BlobNotFound(bucket=self._bucket.name, key=key)
 
         return self._to_blob(_blob)
 
-    def get_stream(self, key: str, buffer_size=256*1024) -> Generator[bytes, None, None]:
-        for chunk in open(f"gs://{self.bucket.name}/{key}",
-                          "rb",
-                          client=self.driver, buffer_size=buffer_size):
-            yield chunk
+    def get_stream(self, key: str, buffer_size=256*1024,
+                   parallel: bool = False,
+                   slice_size: int = SLICE_SIZE,
+                   workers: int = DOWNLOAD_WORKERS) -> Generator[bytes, None, None]:
+        """
+        :param parallel: if true, slices are fetched ahead concurrently
+        and yielded in order.
+        """
+        if parallel:
+            _blob = self._get_blob_or_raise(key)
+            yield from iter_sliced(_blob, slice_size=slice_size,
+                                   workers=workers)
+            return
+        with open(f"gs://{self._bucket.name}/{key}", "rb",
+                  transport_params={"client": self.driver}) as f:
+            while True:
+                chunk = f.read(buffer_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    def iter_history(self, key: str,
+                     page_size: int = 1000) -> Generator[types.Blob, None, None]:
+        """
+        Versions of `key` from the oldest to the newest. The listing is
+        bounded to [key, key + "\\0") so other keys sharing the prefix
+        are not sent by GCS.
+        """
+        for page in self.iter_pages(key, page_size=page_size, history=True,
+                                    start_offset=key,
+                                    end_offset=f"{key}\0"):
+            for blob in page.blobs:
+                if blob.name == key:
+                    yield blob
 
     def blob_history(self, key: str, max_results=None, sorted_=True) -> List[types.Blob]:
-        rows = self._bucket.list_blobs(
-            prefix=key, max_results=max_results, versions=True)
-        blobs = [self._to_blob(r) for r in rows
-                 if r.name == key]
+        """
+        The newest `max_results` versions. GCS lists them from the oldest,
+        so only the last ones are kept. With `sorted_` the newest version
+        is the first one.
+        """
+        blobs = list(deque(self.iter_history(key), maxlen=max_results))
         if sorted_:
-            return sorted(blobs, reverse=True)
+            blobs.reverse()
         return blobs
 
     def recover_blob(self, key: str, version=None):
+        """
+        Without `version` the newest one is restored: the live object
+        if there is one, otherwise the history is listed keeping only
+        its last version.
+        """
         if version:
             _version = version
         else:
-            history = self.blob_history(key)
-            if not history:
-                raise BlobNotFound(self._bucket.name, key)
-            _version = history[0].version
+            live = self._bucket.get_blob(key)
+            if live is not None:
+                _version = live.generation
+            else:
+                history = deque(self.iter_history(key), maxlen=1)
+                if not history:
+                    raise BlobNotFound(self._bucket.name, key)
+                _version = history[0].version
 
         source_blob = self._bucket.blob(key, generation=version)
 
@@ -217,9 +647,91 @@ class Storage(StorageSpec):
     def delete_blob(self, key: str, version=None):
         self._bucket.delete_blob(key, generation=version)
 
+    def _delete_batch(self, _b: GoogleBucket,
+                      items: List[Tuple[str, Optional[str]]]) -> types.DeleteReport:
+        """ One batch request, results are taken from its sub-responses """
+        report = types.DeleteReport()
+        try:
+            with self.driver.batch(raise_exception=False) as batch:
+                for key, version in items:
+                    _b.delete_blob(key, generation=version)
+        except Exception as e:
+            report.errors = {_version_name(k, v): str(e) for k, v in items}
+            return report
+        for (key, version), rsp in zip(items, batch_responses(batch)):
+            if rsp.status_code < 400:
+                report.deleted += 1
+            elif rsp.status_code == 404:
+                report.not_found += 1
+            else:
+                report.errors[_version_name(key, version)] = str(
+                    from_http_response(rsp))
+        return report
+
+    def delete_many(self, keys: Iterable[Union[str, Tuple[str, Optional[str]]]],
+                    bucket=None, workers: int = DELETE_WORKERS,
+                    progress: Optional[Callable[[types.DeleteReport], None]] = None
+                    ) -> types.DeleteReport:
+        """
+        `keys` (or `(key, version)` pairs) are deleted in batch requests
+        of up to 100, `workers` batches are sent concurrently. `keys` are
+        consumed lazily so it could be a listing. `progress` is called
+        with the totals after each batch.
+        """
+        _b = self._current_or_get_bucket(bucket)
+        items = ((k, None) if isinstance(k, str) else k for k in keys)
+        report = types.DeleteReport()
+        pending: Set[Future] = set()
+
+        def _collect(done):
+            for fut in done:
+                pending.discard(fut)
+                rsp = fut.result()
+                report.deleted += rsp.deleted
+                report.not_found += rsp.not_found
+                report.errors.update(rsp.errors)
+                if progress:
+                    progress(report)
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            while True:
+                batch = list(itertools.islice(items, DELETE_BATCH))
+                if not batch:
+                    break
+                pending.add(pool.submit(self._delete_batch, _b, batch))
+                if len(pending) >= workers * 2:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    _collect(done)
+            done, _ = wait(pending)
+            _collect(done)
+        return report
+
+    def delete_prefix(self, prefix: str, versions: bool = True, bucket=None,
+                      workers: int = DELETE_WORKERS,
+                      progress: Optional[Callable[[types.DeleteReport], None]] = None
+                      ) -> types.DeleteReport:
+        """
+        Delete every object under `prefix`, with `versions` the noncurrent
+        ones too. The listing is streamed into `delete_many`.
+        """
+        _b = self._current_or_get_bucket(bucket)
+        listing = _b.list_blobs(prefix=prefix or None, versions=versions,
+                                fields="items(name,generation),nextPageToken")
+        keys = ((b.name, b.generation if versions else None) for b in listing)
+        return self.delete_many(keys, bucket=bucket, workers=workers,
+                                progress=progress)
+
     def delete_bucket(self, bucket=None, recursive=True, timeout_seconds=60):
+        """ With `recursive` objects are removed first by `delete_prefix` """
         _b = self._current_or_get_bucket(bucket)
-        _b.delete(force=recursive, timeout=timeout_seconds)
+        if recursive:
+            report = self.delete_prefix("", bucket=bucket)
+            if report.errors:
+                key, error = next(iter(report.errors.items()))
+                raise RuntimeError(
+                    f"{len(report.errors)} objects not deleted from "
+                    f"{_b.name}, {key}: {error}")
+        _b.delete(timeout=timeout_seconds)
 
     def download_signed(self, key, minutes=15, bucket=None):
         _b = self._current_or_get_bucket(bucket)
@@ -231,6 +743,28 @@ class Storage(StorageSpec):
         )
         return url
 
+    def sign_many(self, keys: Iterable[str], method: str = "GET",
+                  minutes: int = 15, bucket=None,
+                  content_type: Optional[str] = None,
+                  executor: Optional[str] = None) -> List[str]:
+        """
+        Signed urls (v4) for `keys` in the same order. They are signed
+        locally with the key of the service account, without requests.
+        With `executor` (see `labmachine.executors`, e.g. a process pool)
+        keys are signed in chunks by its workers.
+        """
+        _name = bucket or self._bucket.name
+        _keys = list(keys)
+        args = (self._conf.CREDENTIALS, self._conf.PROJECT, _name)
+        if executor is None:
+            return _sign_keys(*args, _keys, method, minutes, content_type)
+        pool = executors.get(executor)
+        futures = [
+            pool.submit(_sign_keys, *args, _keys[ix:ix + SIGN_CHUNK],
+                        method, minutes, content_type)
+            for ix in range(0, len(_keys), SIGN_CHUNK)]
+        return [url for fut in futures for url in fut.result()]
+
     def upload_signed(self, key, minutes=15, bucket=None,
                       content_type="application/octed-stream"):
         """
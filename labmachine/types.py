@@ -290,6 +290,33 @@ class Blob(BaseModel):
         return f"<Blob: {self.id}>"
 
 
+class BlobsPage(BaseModel):
+    """ A page of a listing, `next_page_token` is None in the last one """
+    blobs: List[Blob]
+    next_page_token: Optional[str] = None
+
+
+class DeleteReport(BaseModel):
+    """
+    Progress of a bulk delete, `errors` are by key (`key#version`
+    for a specific version). Missing objects are not errors.
+    """
+    deleted: int = 0
+    not_found: int = 0
+    errors: Dict[str, str] = {}
+
+
+class TransferReport(BaseModel):
+    """
+    Progress of a directory transfer, `errors` are by path relative to
+    the directory. `skipped` files were already done by a previous run.
+    """
+    transferred: int = 0
+    skipped: int = 0
+    bytes: int = 0
+    errors: Dict[str, str] = {}
+
+
 class Bucket(BaseModel):
     name: str
     url: str
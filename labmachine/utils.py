@@ -1,14 +1,16 @@
 import asyncio
 import math
 import os
+from functools import partial
 from importlib import import_module
 from pathlib import Path
-from typing import Any, Dict
+from typing import Any, AsyncGenerator, Callable, Dict, Generator, Optional
 
 import tomli
 import tomli_w
 from nanoid import generate
 
+from labmachine import executors
 from labmachine.defaults import NANO_ID_ALPHABET
 
 
@@ -19,13 +21,113 @@ def generate_random(size=10, strategy="nanoid", alphabet=NANO_ID_ALPHABET) -> st
     raise NotImplementedError("Strategy %s not implemented", strategy)
 
 
-async def run_async(func, *args, **kwargs):
-    """Run sync functions from async code"""
+async def run_async(func, *args, executor: Optional[str] = None, **kwargs):
+    """
+    Run sync functions from async code in the executor named `executor`,
+    see `labmachine.executors`.
+    """
     loop = asyncio.get_running_loop()
-    rsp = await loop.run_in_executor(None, func, *args, **kwargs)
+    pool = executors.get(executor)
+    if kwargs:
+        rsp = await loop.run_in_executor(pool, partial(func, *args, **kwargs))
+    else:
+        rsp = await loop.run_in_executor(pool, func, *args)
     return rsp
 
 
+_STREAM_END = object()
+
+
+async def iter_in_thread(gen_func: Callable[..., Generator], *args,
+                         maxsize: int = 8, executor: Optional[str] = None
+                         ) -> AsyncGenerator[Any, None]:
+    """
+    Consume a blocking generator from async code. Items are pulled one
+    by one in the executor named `executor`, which must be a thread pool.
+    At most `maxsize` items are waiting for the consumer, so the producer
+    is paused when the consumer is slow.
+    """
+    pool = executors.get(executor)
+    if pool.kind != "thread":
+        raise ValueError(f"Executor {pool.name} is a {pool.kind} pool, "
+                         "generators need a thread one")
+    queue: asyncio.Queue = asyncio.Queue(maxsize)
+    gen = None
+    # the call running in the pool, if any
+    pending = None
+
+    def _next():
+        nonlocal gen
+        if gen is None:
+            gen = gen_func(*args)
+        return next(gen, _STREAM_END)
+
+    def _close(_=None):
+        if gen is not None:
+            gen.close()
+
+    async def _producer():
+        nonlocal pending
+        try:
+            while True:
+                pending = pool.submit(_next)
+                item = await asyncio.wrap_future(pending)
+                await queue.put((item, None))
+                if item is _STREAM_END:
+                    break
+        except Exception as e:
+            await queue.put((_STREAM_END, e))
+
+    task = asyncio.ensure_future(_producer())
+    try:
+        while True:
+            item, error = await queue.get()
+            if item is _STREAM_END:
+                if error:
+                    raise error
+                break
+            yield item
+    finally:
+        task.cancel()
+        # the generator is closed once the call running is done
+        if pending is not None:
+            pending.add_done_callback(_close)
+
+
+def iter_from_async(agen: AsyncGenerator[Any, None],
+                    loop: asyncio.AbstractEventLoop) -> Generator[Any, None, None]:
+    """
+    The other side of `iter_in_thread`: to be used from a worker thread,
+    it pulls one item at a time from an async generator running in `loop`.
+    """
+
+    async def _next():
+        return await agen.__anext__()
+
+    while True:
+        try:
+            yield asyncio.run_coroutine_threadsafe(_next(), loop).result()
+        except StopAsyncIteration:
+            break
+
+
+def local_path(local_dir: str, rel: str) -> str:
+    """
+    Path of the object name `rel` under `local_dir`. Names with empty,
+    `.` or `..` parts are refused with ValueError, as any path resolved
+    outside of `local_dir`.
+    """
+    parts = rel.split("/")
+    if any(p in ("", ".", "..") or os.sep in p
+           or (os.altsep and os.altsep in p) for p in parts):
+        raise ValueError(f"Unsafe object name {rel}")
+    root = os.path.realpath(local_dir)
+    fpath = os.path.join(local_dir, *parts)
+    if os.path.commonpath([root, os.path.realpath(fpath)]) != root:
+        raise ValueError(f"Object name {rel} is outside of {local_dir}")
+    return fpath
+
+
 def mkdir_p(fp):
     """Make the fullpath
     similar to mkdir -p in unix systems.
@@ -0,0 +1,16 @@
+import os
+
+from labmachine.bench.kv import StandIns
+
+
+def test_stand_ins_restore_the_emulator_host(monkeypatch):
+    monkeypatch.setenv("STORAGE_EMULATOR_HOST", "http://before")
+    with StandIns() as stand_ins:
+        assert stand_ins.store_args("gcs")[0] == "bench"
+        assert os.environ["STORAGE_EMULATOR_HOST"] != "http://before"
+    assert os.environ["STORAGE_EMULATOR_HOST"] == "http://before"
+
+    monkeypatch.delenv("STORAGE_EMULATOR_HOST")
+    with StandIns() as stand_ins:
+        stand_ins.store_args("gcs")
+    assert "STORAGE_EMULATOR_HOST" not in os.environ
@@ -0,0 +1,26 @@
+from labmachine.io.checksums import Checksum, ChecksumStream
+from labmachine.io.kv_local import KVLocal
+
+
+def test_buffers_are_hashed_like_bytes():
+    ref = Checksum()
+    ref.update(b"abcdef")
+    checksum = Checksum()
+    for chunk in (bytearray(b"ab"), memoryview(b"xcdx")[1:3], b"ef"):
+        checksum.update(chunk)
+    assert (checksum.md5, checksum.crc32c, checksum.size) == \
+        (ref.md5, ref.crc32c, 6)
+
+
+def test_streams_of_buffers(tmp_path):
+    kv = KVLocal(str(tmp_path))
+    info = kv.put_stream("k", iter([bytearray(b"ab"), memoryview(b"cd")]))
+    assert kv.get("k") == b"abcd" and info.size == 4
+    stream = ChecksumStream(iter([b"abcd"]))
+    list(stream)
+    assert info.md5 == stream.checksum.md5
+    assert info.crc32c == stream.checksum.crc32c
+
+    reused = kv.get_stream("k", chunk_size=3, reuse_buffer=True)
+    assert b"".join(bytes(c) for c in reused) == b"abcd"
+    assert reused.checksum.md5 == info.md5 and reused.checksum.crc32c is None
@@ -0,0 +1,62 @@
+import asyncio
+import time
+
+import pytest
+
+from labmachine import executors
+from labmachine.io.kv_packed import AsyncKVPacked
+from labmachine.utils import iter_in_thread
+
+
+def test_process_pool_reports_active_calls():
+    pool = executors.configure("test-procs", max_workers=1, kind="process")
+    try:
+        futs = [pool.submit(time.sleep, 0.5) for _ in range(2)]
+        deadline = time.time() + 10
+        while pool.metrics()["active"] != 1 and time.time() < deadline:
+            time.sleep(0.01)
+        metrics = pool.metrics()
+        assert (metrics["active"], metrics["queued"]) == (1, 1)
+        for fut in futs:
+            fut.result()
+        metrics = pool.metrics()
+        assert (metrics["active"], metrics["queued"]) == (0, 0)
+        assert metrics["completed"] == 2
+    finally:
+        executors.shutdown()
+
+
+def test_stores_refuse_process_pools(tmp_path):
+    executors.configure("test-procs", max_workers=1, kind="process")
+    try:
+        with pytest.raises(ValueError):
+            AsyncKVPacked(str(tmp_path), {"executor": "test-procs"})
+        with pytest.raises(ValueError):
+            AsyncKVPacked(str(tmp_path), {"executor": "other",
+                                          "executor_workers": 1,
+                                          "executor_kind": "process"})
+    finally:
+        executors.shutdown()
+
+
+def _count(n):
+    yield from range(n)
+
+
+def test_iter_in_thread_uses_the_executor():
+    pool = executors.configure("test-iter", max_workers=2)
+
+    async def main():
+        items = [i async for i in iter_in_thread(
+            _count, 5, maxsize=2, executor="test-iter")]
+        gen = iter_in_thread(_count, 3, executor="test-iter")
+        assert await gen.__anext__() == 0
+        await gen.aclose()
+        return items
+
+    try:
+        # five items and the end of the generator
+        assert asyncio.run(main()) == [0, 1, 2, 3, 4]
+        assert pool.metrics()["completed"] >= 6
+    finally:
+        executors.shutdown()
@@ -0,0 +1,42 @@
+import pytest
+
+pytest.importorskip("google.cloud.storage")
+
+from labmachine.bench.servers import FakeGCSServer  # noqa: E402
+from labmachine.io import gcs_client  # noqa: E402
+from labmachine.io.kv_gcs import KVGS  # noqa: E402
+
+
+@pytest.fixture
+def server(monkeypatch):
+    with FakeGCSServer() as srv:
+        monkeypatch.setenv("STORAGE_EMULATOR_HOST", srv.url)
+        requests = []
+        handle = srv.gcs.handle
+
+        def _handle(method, url, headers, body):
+            requests.append((method, url))
+            return handle(method, url, headers, body)
+
+        srv.gcs.handle = _handle
+        srv.requests = requests
+        yield srv
+
+
+def test_clients_are_shared(server):
+    a = KVGS("bench", {"project": "p"})
+    b = KVGS("other", {"project": "p"})
+    assert a.client is b.client
+    assert KVGS("bench", {"project": "q"}).client is not a.client
+
+    gcs_client.clear()
+    assert KVGS("bench", {"project": "p"}).client is not a.client
+    gcs_client._after_fork()
+    assert not gcs_client._clients
+
+
+def test_buckets_are_bound_without_requests(server):
+    kv = KVGS("missing", {"project": "p"})
+    assert not server.requests
+    assert kv.get("k") is None
+    assert server.requests
@@ -0,0 +1,67 @@
+import pytest
+
+pytest.importorskip("google.cloud.storage")
+
+from labmachine.bench.servers import FakeGCSServer  # noqa: E402
+from labmachine.io import gcs_transfer  # noqa: E402
+from labmachine.io.gcs_client import get_client  # noqa: E402
+
+DATA = bytes(range(256)) * 40
+
+
+@pytest.fixture
+def bucket(monkeypatch):
+    with FakeGCSServer() as srv:
+        monkeypatch.setenv("STORAGE_EMULATOR_HOST", srv.url)
+        b = get_client(project="p").bucket("bench")
+        b.objects = srv.gcs.buckets["bench"]
+        yield b
+
+
+def _chunks(data, size):
+    return (data[ix:ix + size] for ix in range(0, len(data), size))
+
+
+def test_composite_upload_in_levels(bucket, monkeypatch):
+    monkeypatch.setattr(gcs_transfer, "COMPOSE_LIMIT", 4)
+    blob = gcs_transfer.composite_upload(
+        bucket, "k", _chunks(DATA, 1000), part_size=1000, workers=3,
+        content_type="text/plain", metadata={"a": "1"})
+    assert blob.size == len(DATA)
+    # the parts and the intermediate objects are removed
+    assert list(bucket.objects) == ["k"]
+    assert bucket.objects["k"]["data"] == DATA
+    resource = bucket.objects["k"]["resource"]
+    assert resource["contentType"] == "text/plain"
+    assert resource["metadata"] == {"a": "1"}
+
+
+def test_composite_upload_of_a_single_part(bucket):
+    gcs_transfer.composite_upload(bucket, "k", iter([b"a", b"b"]),
+                                  part_size=1000)
+    assert list(bucket.objects) == ["k"]
+    assert bucket.objects["k"]["data"] == b"ab"
+
+
+def test_sliced_download_gives_bytes(bucket):
+    bucket.blob("k").upload_from_string(DATA)
+    data = gcs_transfer.sliced_download(bucket.get_blob("k"),
+                                        slice_size=1000, workers=3)
+    assert type(data) is bytes and data == DATA
+
+
+def test_iter_sliced_keeps_the_order(bucket):
+    bucket.blob("k").upload_from_string(DATA)
+    chunks = list(gcs_transfer.iter_sliced(bucket.get_blob("k"),
+                                           slice_size=1000, workers=2))
+    assert [len(c) for c in chunks] == [1000] * 10 + [240]
+    assert b"".join(chunks) == DATA
+
+
+def test_sliced_download_to_file(bucket, tmp_path):
+    bucket.blob("k").upload_from_string(DATA)
+    fpath = tmp_path / "k"
+    fpath.write_bytes(b"x" * 100_000)
+    gcs_transfer.sliced_download_to_file(bucket.get_blob("k"), str(fpath),
+                                         slice_size=1000, workers=3)
+    assert fpath.read_bytes() == DATA
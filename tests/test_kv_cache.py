@@ -0,0 +1,104 @@
+import asyncio
+import os
+
+from labmachine.io.kv_cache import AsyncCachedKV, CachedKV, DiskTier
+
+
+class _PutDuringGet:
+    """ Store whose `get` sees a concurrent put after reading the old value """
+
+    def __init__(self, store, cached):
+        self.store = store
+        self.cached = cached
+        self.raced = False
+
+    def get(self, key):
+        data = self.store.get(key)
+        if not self.raced:
+            self.raced = True
+            self.cached.put(key, b"new")
+        return data
+
+    def put(self, key, data):
+        return self.store.put(key, data)
+
+
+def test_read_through_does_not_keep_stale_values(tmp_path):
+    kv = CachedKV(str(tmp_path / "store"), {
+        "store_class": "labmachine.io.kv_local.KVLocal",
+        "disk_path": str(tmp_path / "cache")})
+    kv.put("k", b"old")
+    kv.store = _PutDuringGet(kv.store, kv)
+    assert kv.get("k") == b"old"
+    assert kv.get("k") == b"new"
+
+
+def test_async_get_stream_counts_one_disk_hit(tmp_path):
+    async def main():
+        kv = AsyncCachedKV(str(tmp_path / "store"), {
+            "store_class": "labmachine.io.kv_local.AsyncKVLocal",
+            "disk_path": str(tmp_path / "cache"), "disk_policy": "lfu"})
+        await kv.put("k", b"value")
+        await kv.get("k")
+        kv.cache.memory.invalidate("k")
+        chunks = [c async for c in kv.get_stream("k")]
+        return kv, chunks
+
+    kv, chunks = asyncio.run(main())
+    assert b"".join(chunks) == b"value"
+    assert kv.stats()["hits_disk"] == 1
+    name = kv.cache.disk._name("k")
+    # one hit when it was cached, one for the read
+    assert kv.cache.disk._index[name][1] == 2
+
+
+def test_lfu_evicts_the_least_used(tmp_path):
+    disk = DiskTier(str(tmp_path), max_bytes=30, policy="lfu")
+    for key in ("a", "b", "c"):
+        disk.set(key, b"x" * 10)
+    for _ in range(3):
+        disk.get("a")
+        disk.get("c")
+    disk.set("d", b"x" * 10)
+    # "b" and "d" have one hit, "b" is older
+    assert disk.get("b") is None
+    assert [disk.get(k) for k in ("a", "c", "d")] == [b"x" * 10] * 3
+    # the heap doesn't grow with every hit
+    for _ in range(5000):
+        disk.get("a")
+    assert len(disk._heap) < 2 * len(disk._index) + 1024 + 1
+
+
+def test_get_stream_falls_back_when_evicted(tmp_path):
+    kv = CachedKV(str(tmp_path / "store"), {
+        "store_class": "labmachine.io.kv_local.KVLocal",
+        "disk_path": str(tmp_path / "cache"), "memory_bytes": 0})
+    kv.put("k", b"value")
+    kv.get("k")
+    file = kv.cache.disk.file
+
+    def _evicted(key):
+        fpath = file(key)
+        os.unlink(fpath)
+        return fpath
+
+    kv.cache.disk.file = _evicted
+    assert b"".join(kv.get_stream("k")) == b"value"
+    assert kv.stats()["misses"] == 2
+
+
+def test_delete_many_drops_both_tiers(tmp_path):
+    kv = CachedKV(str(tmp_path / "store"), {
+        "store_class": "labmachine.io.kv_local.KVLocal",
+        "disk_path": str(tmp_path / "cache")})
+    for key in ("a", "b"):
+        kv.put(key, b"value")
+        kv.get(key)
+    batches = []
+    delete_many = kv.store.delete_many
+    kv.store.delete_many = lambda keys, workers: batches.append(keys) or \
+        delete_many(keys, workers)
+    rsp = kv.delete_many(["a", "b"])
+    assert not rsp.errors and batches == [["a", "b"]]
+    assert kv.cache.get("a") is None and kv.cache.get("b") is None
+    assert not kv.store.exists("a") and not kv.store.exists("b")
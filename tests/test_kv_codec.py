@@ -0,0 +1,67 @@
+import asyncio
+
+import pytest
+
+from labmachine.io import kv_codec
+from labmachine.io.kv_codec import (MAGIC, AsyncCodecKV, CodecError, CodecKV,
+                                    Decoder, available_codecs, decode, encode)
+
+DATA = b"labmachine " * 5000
+
+
+def _chunks(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize("codec", available_codecs())
+def test_round_trip(codec):
+    encoded = encode(DATA, codec)
+    assert encoded.startswith(MAGIC)
+    assert decode(encoded) == DATA
+    decoder = Decoder()
+    # the frame is split between chunks
+    assert b"".join(decoder.iter(_chunks(encoded, 3))) == DATA
+    assert decoder.codec == codec
+    assert decode(encode(b"", codec)) == b""
+
+
+@pytest.mark.parametrize("value", [
+    b"", b"\x89", b"plain value", MAGIC, MAGIC + b"\x07rest",
+    # a known id but not followed by the data of that codec
+    MAGIC + b"\x01not gzip", MAGIC + b"\x02x"])
+def test_legacy_values_are_read_as_they_are(value):
+    assert decode(value) == value
+    decoder = Decoder()
+    assert b"".join(decoder.iter(_chunks(value, 2))) == value
+    assert decoder.codec == "none"
+
+
+def test_truncated_values_fail():
+    encoded = encode(DATA, "gzip")
+    with pytest.raises(CodecError):
+        decode(encoded[:len(encoded) // 2])
+
+
+def test_codec_kv_by_prefix(tmp_path):
+    opts = {"store_class": "labmachine.io.kv_local.KVLocal",
+            "codec": "gzip", "codec_prefixes": {"raw/": "none"}}
+    kv = CodecKV(str(tmp_path), opts)
+    kv.put("a", DATA)
+    assert kv.put_stream("raw/b", iter(_chunks(DATA, 1000)))
+    assert kv.get("a") == DATA
+    assert b"".join(kv.get_stream("raw/b")) == DATA
+    assert kv.store.stat("a").size < len(DATA)
+    assert kv.store.stat("raw/b").size == len(DATA) + kv_codec.HEADER_SIZE
+    # written without the wrapper
+    kv.store.put("legacy", MAGIC + b"\x01plain")
+    assert kv.get("legacy") == MAGIC + b"\x01plain"
+
+    async def main():
+        akv = AsyncCodecKV(str(tmp_path), {**opts, "store_class":
+                                           "labmachine.io.kv_local.AsyncKVLocal"})
+        data = await akv.get("a")
+        chunks = [c async for c in akv.get_stream("raw/b")]
+        await akv.close()
+        return data, b"".join(chunks)
+
+    assert asyncio.run(main()) == (DATA, DATA)
@@ -0,0 +1,92 @@
+import os
+import random
+import threading
+import time
+
+from labmachine.io import kv_dedup
+from labmachine.io.kv_dedup import Chunker, DedupKV
+
+OPTS = {"chunk_min": 256, "chunk_avg": 1024, "chunk_max": 4096}
+
+
+def _data(size, seed=0):
+    return random.Random(seed).getrandbits(size * 8).to_bytes(size, "little")
+
+
+def test_chunker_is_content_defined():
+    data = _data(200_000)
+    chunks = list(Chunker(256, 1024, 4096).iter(
+        data[i:i + 999] for i in range(0, len(data), 999)))
+    assert b"".join(chunks) == data
+    assert all(256 <= len(c) <= 4096 for c in chunks[:-1])
+
+    # an insert only changes the chunks around it
+    edited = data[:100_000] + b"edit" + data[100_000:]
+    after = list(Chunker(256, 1024, 4096).iter([edited]))
+    assert len(set(chunks) & set(after)) >= len(chunks) - 3
+
+
+def test_chunker_keeps_a_small_buffer():
+    chunker = Chunker(256, 1024, 4096)
+    data = _data(100_000, seed=2)
+    chunks = []
+    for i in range(0, len(data), 50_000):
+        chunks.extend(chunker.feed(data[i:i + 50_000]))
+        assert len(chunker._buf) < 4096 and chunker._pos == 0
+    chunks.extend(chunker.finish())
+    assert b"".join(chunks) == data
+
+
+def _age_chunks(tmp_path):
+    """ unreferenced chunks are old enough for gc """
+    past = time.time() - 3600
+    for root, _, files in os.walk(tmp_path / "chunks"):
+        for name in files:
+            os.utime(os.path.join(root, name), (past, past))
+
+
+def test_gc_keeps_chunks_leased_by_an_upload(tmp_path):
+    kv = DedupKV(str(tmp_path), {"store_class": "labmachine.io.kv_local.KVLocal",
+                                 "upload_window": 1, **OPTS})
+    data = _data(50_000, seed=1)
+    kv.put("old", data)
+    kv.delete("old")
+    _age_chunks(tmp_path)
+
+    def stream():
+        yield data[:25_000]
+        # the chunks before are deduplicated against the old ones
+        kv.gc(min_age=60)
+        yield data[25_000:]
+
+    kv.put_stream("new", stream())
+    assert kv.get("new") == data
+    assert list(kv.store.iter_keys("leases/")) == []
+
+
+def test_uploads_wait_for_running_gc_batches(tmp_path, monkeypatch):
+    monkeypatch.setattr(kv_dedup, "GC_POLL", 0.01)
+    kv = DedupKV(str(tmp_path), {"store_class": "labmachine.io.kv_local.KVLocal",
+                                 **OPTS})
+    data = _data(50_000, seed=3)
+    kv.put("old", data)
+    kv.delete("old")
+    _age_chunks(tmp_path)
+    delete_many = kv.store.delete_many
+    upload = threading.Thread(target=kv.put, args=("new", data))
+
+    def _racing(keys, workers=None):
+        keys = list(keys)
+        if keys and keys[0].startswith("chunks/") and not upload.is_alive():
+            # the leases were read already, the upload reuses the chunks
+            upload.start()
+            while upload.is_alive() and not list(kv.store.iter_keys("leases/")):
+                time.sleep(0.01)
+            time.sleep(0.1)
+        return delete_many(keys, workers)
+
+    kv.store.delete_many = _racing
+    assert kv.gc(min_age=60) > 0
+    upload.join()
+    assert kv.get("new") == data
+    assert list(kv.store.iter_keys("gc/")) == []
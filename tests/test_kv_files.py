@@ -0,0 +1,45 @@
+import asyncio
+
+import pytest
+
+from labmachine.bench.servers import FilesServer
+from labmachine.io.kv_files import AsyncKVFiles, KVFiles
+
+KEYS = ["a.txt", "a/b/c", "a/b/d", "a/e", "b", "c/x"]
+
+
+@pytest.fixture
+def server():
+    with FilesServer() as srv:
+        yield srv
+
+
+def test_kvfiles_iter_keys(server):
+    with KVFiles("bucket", {"url": server.url}) as kv:
+        for key in KEYS:
+            assert kv.put(key, key.encode())
+        assert kv.list() == KEYS
+        assert list(kv.iter_keys(prefix="a/b")) == ["a/b/c", "a/b/d"]
+        assert list(kv.iter_keys(start_after="a/b/c")) == KEYS[2:]
+        info = next(kv.iter_keys(prefix="a/e", with_meta=True))
+        assert info.key == "a/e" and info.size == 3
+
+
+def test_kvfiles_empty_listing(server):
+    with KVFiles("bucket", {"url": server.url}) as kv:
+        assert kv.list() == []
+
+
+def test_async_kvfiles_iter_keys(server):
+    async def main():
+        kv = AsyncKVFiles("bucket", {"url": server.url})
+        for key in KEYS:
+            await kv.put(key, key.encode())
+        keys = await kv.list()
+        filtered = [k async for k in kv.iter_keys(prefix="a/", start_after="a/b/c")]
+        await kv.close()
+        return keys, filtered
+
+    keys, filtered = asyncio.run(main())
+    assert keys == KEYS
+    assert filtered == ["a/b/d", "a/e"]
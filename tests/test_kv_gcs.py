@@ -0,0 +1,130 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("google.cloud.storage")
+
+from labmachine.bench.servers import FakeGCSServer  # noqa: E402
+from labmachine.io import kv_gcs  # noqa: E402
+from labmachine.io.kvspec import KeyReadError  # noqa: E402
+
+
+@pytest.fixture
+def server(monkeypatch):
+    with FakeGCSServer() as srv:
+        monkeypatch.setenv("STORAGE_EMULATOR_HOST", srv.url)
+        requests = []
+        handle = srv.gcs.handle
+
+        def _handle(method, url, headers, body):
+            requests.append((method, url))
+            return handle(method, url, headers, body)
+
+        srv.gcs.handle = _handle
+        srv.requests = requests
+        yield srv
+
+
+def test_put_stream_uses_the_upload_response(server):
+    kv = kv_gcs.KVGS("bench", {"project": "p"})
+    info = kv.put_stream("k", iter([b"a" * 1000, b"b" * 1000]))
+    assert info.size == 2000 and info.md5 and info.crc32c
+    assert info.etag == server.gcs.buckets["bench"]["k"]["resource"]["generation"]
+    # the metadata comes with the upload, it's not requested again
+    assert not [u for m, u in server.requests if "/o/k" in u]
+
+
+def test_put_stream_deletes_corrupt_objects(server, monkeypatch):
+    upload = kv_gcs.stream_upload
+
+    def _corrupt(bucket, key, stream):
+        list(stream)
+        return upload(bucket, key, iter([b"corrupt"]))
+
+    monkeypatch.setattr(kv_gcs, "stream_upload", _corrupt)
+    kv = kv_gcs.KVGS("bench", {"project": "p"})
+    assert kv.put_stream("k", iter([b"data"])) is False
+    assert "k" not in server.gcs.buckets["bench"]
+
+
+def test_sliced_downloads(server):
+    data = bytes(range(256)) * 40
+    kv = kv_gcs.KVGS("bench", {"project": "p", "sliced_download": True,
+                               "slice_size": 4096, "download_workers": 2})
+    kv.put("big", data)
+    kv.put("small", b"data")
+    server.requests.clear()
+    assert kv.get("big") == data
+    stream = kv.get_stream("big")
+    assert b"".join(stream) == data and stream.checksum.crc32c
+    assert kv.get("small") == b"data"
+    media = [u for m, u in server.requests if "alt=media" in u and "/o/big" in u]
+    assert len(media) == 6
+
+
+def test_async_streams(server):
+    data = bytes(range(256)) * 40
+
+    async def _chunks():
+        for ix in range(0, len(data), 1000):
+            yield data[ix:ix + 1000]
+
+    async def main():
+        kv = kv_gcs.AsyncKVGS("bench", {"project": "p", "stream_queue": 2})
+        await kv.put_stream("k", _chunks())
+        stream = kv.get_stream("k", chunk_size=4096)
+        chunks = [c async for c in stream]
+        with pytest.raises(KeyReadError):
+            [c async for c in kv.get_stream("missing")]
+        return chunks, stream.checksum
+
+    chunks, checksum = asyncio.run(main())
+    assert [len(c) for c in chunks] == [4096, 4096, 2048]
+    assert b"".join(chunks) == data and checksum.crc32c
+
+
+def test_iter_keys_requests_pages_lazily(server):
+    kv = kv_gcs.KVGS("bench", {"project": "p"})
+    for key in ("a", "b", "c", "d", "e"):
+        kv.put(f"p/{key}", b"data")
+    kv.put("q", b"data")
+    server.requests.clear()
+    keys = kv.iter_keys(prefix="p/", page_size=2, start_after="p/a")
+    # start_offset is inclusive, p/a comes in the first page
+    assert next(keys) == "p/b"
+    assert len(server.requests) == 1
+    assert list(keys) == ["p/c", "p/d", "p/e"]
+    assert len(server.requests) == 3
+    infos = list(kv.iter_keys(prefix="p/", page_size=2, with_meta=True))
+    assert [(i.key, i.size) for i in infos][:2] == [("p/a", 4), ("p/b", 4)]
+
+
+def test_batch_deletes_and_checks(server):
+    kv = kv_gcs.KVGS("bench", {"project": "p"})
+    keys = [f"k{i:03d}" for i in range(150)]
+    for key in keys[:-1]:
+        server.gcs._store("bench", key, b"data", {})
+    server.requests.clear()
+    assert kv.exists_many(keys).results == [True] * 149 + [False]
+    rsp = kv.delete_many(keys)
+    assert list(rsp.errors) == ["k149"] and len(rsp.results) == 150
+    assert not server.gcs.buckets["bench"]
+    batches = [u for m, u in server.requests if u.startswith("/batch")]
+    assert len(batches) == 4
+
+
+def test_failed_batches_are_sent_one_by_one(server):
+    kv = kv_gcs.KVGS("bench", {"project": "p"})
+    for key in ("a", "b"):
+        server.gcs._store("bench", key, b"data", {})
+    handle = server.gcs.handle
+
+    def _handle(method, url, headers, body):
+        if url.startswith("/batch"):
+            return 503, {}, b"unavailable"
+        return handle(method, url, headers, body)
+
+    server.gcs.handle = _handle
+    assert kv.exists_many(["a", "c"]).results == [True, False]
+    rsp = kv.delete_many(["a", "b"])
+    assert not rsp.errors and not server.gcs.buckets["bench"]
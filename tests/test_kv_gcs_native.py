@@ -0,0 +1,129 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("google.auth")
+
+from labmachine.bench.servers import FakeGCSServer  # noqa: E402
+from labmachine.io.kv_gcs_native import NativeAsyncKVGS  # noqa: E402
+from labmachine.io.kvspec import KeyReadError, KeyWriteError  # noqa: E402
+
+BIG = bytes(range(256)) * 2400
+
+
+@pytest.fixture
+def server(monkeypatch):
+    with FakeGCSServer() as srv:
+        monkeypatch.setenv("STORAGE_EMULATOR_HOST", srv.url)
+        requests = []
+        handle = srv.gcs.handle
+
+        def _handle(method, url, headers, body):
+            requests.append((method, url.split("?")[0]))
+            if srv.reply:
+                rsp = srv.reply(method, url, headers)
+                if rsp:
+                    return rsp
+            return handle(method, url, headers, body)
+
+        srv.reply = None
+        srv.gcs.handle = _handle
+        srv.requests = requests
+        yield srv
+
+
+class _Tokens:
+    """ the first token is rejected by the server """
+
+    def __init__(self):
+        self.refreshed = 0
+
+    async def headers(self, force=False):
+        if force:
+            self.refreshed += 1
+        return {"Authorization": f"Bearer t{self.refreshed}"}
+
+
+def _run(main):
+    async def _main():
+        kv = NativeAsyncKVGS("bench", {"upload_chunk": 256 * 1024})
+        try:
+            return await main(kv)
+        finally:
+            await kv.close()
+    return asyncio.run(_main())
+
+
+def test_put_and_get(server):
+    async def main(kv):
+        await kv.put("small", b"data")
+        info = await kv.put_stream("big", iter([BIG[:100_000], BIG[100_000:]]))
+        stream = kv.get_stream("big", chunk_size=64 * 1024)
+        chunks = [c async for c in stream]
+        return info, await kv.get("small"), b"".join(chunks), stream.checksum
+
+    info, small, big, checksum = _run(main)
+    assert small == b"data" and big == BIG
+    assert info.size == len(BIG) and info.md5 == checksum.md5
+    assert info.etag == server.gcs.buckets["bench"]["big"]["resource"]["generation"]
+
+
+def test_put_stream_deletes_corrupt_objects(server):
+    def _corrupt(method, url, headers):
+        if method == "PUT" and "*" not in headers.get("Content-Range"):
+            server.reply = None
+            rsp = server.gcs.handle(method, url, headers, b"corrupt")
+            server.reply = _corrupt
+            return rsp
+        return None
+
+    async def main(kv):
+        server.reply = _corrupt
+        with pytest.raises(KeyWriteError):
+            await kv.put_stream("k", iter([b"data"]))
+
+    _run(main)
+    assert "k" not in server.gcs.buckets["bench"]
+
+
+def test_tokens_are_refreshed_on_401(server):
+    def _reject(method, url, headers):
+        if headers.get("Authorization") == "Bearer t0":
+            return 401, {}, b"expired"
+        return None
+
+    async def main(kv):
+        kv.tokens = _Tokens()
+        await kv.put("k", b"data")
+        kv.tokens = _Tokens()
+        data = b"".join([c async for c in kv.get_stream("k")])
+        return data, kv.tokens.refreshed
+
+    server.reply = _reject
+    assert _run(main) == (b"data", 1)
+
+
+def test_only_idempotent_requests_are_retried(server):
+    failures = [0]
+
+    def _unavailable(method, url, headers):
+        if failures[0]:
+            failures[0] -= 1
+            return 503, {}, b"unavailable"
+        return None
+
+    async def main(kv):
+        failures[0] = 1
+        with pytest.raises(KeyWriteError):
+            await kv.put("k", b"data")
+        await kv.put("k", b"data")
+        failures[0] = 1
+        assert [c async for c in kv.get_stream("k")] == [b"data"]
+        with pytest.raises(KeyReadError):
+            [c async for c in kv.get_stream("missing")]
+
+    server.reply = _unavailable
+    _run(main)
+    posts = [u for m, u in server.requests if m == "POST"]
+    gets = [u for m, u in server.requests if m == "GET" and u.endswith("/k")]
+    assert (len(posts), len(gets)) == (2, 2)
@@ -0,0 +1,150 @@
+import asyncio
+import itertools
+import os
+
+import pytest
+
+from labmachine.io import kv_local
+from labmachine.io.kv_local import AsyncKVLocal, KVLocal, reshard
+from labmachine.io.kvspec import KeyReadError, KeyWriteError
+
+KEYS = [f"key{i}" for i in range(30)] + ["a/b"]
+
+
+def _store(root, **opts):
+    kv = KVLocal(str(root), opts)
+    for key in KEYS:
+        kv.put(key, key.encode())
+    return kv
+
+
+def _check(root, **opts):
+    kv = KVLocal(str(root), opts)
+    for key in KEYS:
+        assert kv.get(key) == key.encode()
+    assert sorted(kv.iter_keys()) == sorted(KEYS)
+
+
+@pytest.mark.parametrize("fail_at", [5, len(KEYS) + 3])
+def test_reshard_resumes_after_interruption(tmp_path, monkeypatch, fail_at):
+    """ it fails while staging files or while moving the staging folder """
+    _store(tmp_path)
+    rename = os.rename
+    calls = []
+
+    def _rename(src, dst):
+        calls.append(src)
+        if len(calls) == fail_at:
+            raise OSError("interrupted")
+        rename(src, dst)
+
+    monkeypatch.setattr(kv_local.os, "rename", _rename)
+    with pytest.raises(OSError):
+        reshard(str(tmp_path), levels=2, width=2)
+    monkeypatch.setattr(kv_local.os, "rename", rename)
+
+    reshard(str(tmp_path), levels=2, width=2)
+    _check(tmp_path, layout="sharded")
+    assert not os.path.exists(tmp_path / kv_local.RESHARD_DIR)
+    assert not os.path.exists(tmp_path / kv_local.RESHARD_MARK)
+
+
+def test_reshard_back_to_flat(tmp_path):
+    _store(tmp_path, layout="sharded")
+    assert reshard(str(tmp_path), levels=0, width=0,
+                   from_levels=2, from_width=2) == len(KEYS)
+    _check(tmp_path)
+
+
+def test_sharded_keys_are_sorted_for_paging(tmp_path):
+    kv = _store(tmp_path, layout="sharded")
+    assert list(kv.iter_keys()) == sorted(KEYS)
+    pages, last = [], None
+    while True:
+        page = list(itertools.islice(kv.iter_keys(start_after=last), 7))
+        if not page:
+            break
+        pages.extend(page)
+        last = page[-1]
+    assert pages == sorted(KEYS)
+    infos = list(kv.iter_keys(prefix="key1", with_meta=True))
+    assert [i.key for i in infos] == sorted(k for k in KEYS
+                                            if k.startswith("key1"))
+
+
+def test_reshard_reports_progress(tmp_path, monkeypatch):
+    monkeypatch.setattr(kv_local, "RESHARD_PROGRESS", 10)
+    _store(tmp_path)
+    calls = []
+    reshard(str(tmp_path), levels=1, width=2, progress=calls.append)
+    assert calls == [10, 20, 30]
+
+
+def _pages(kv, size, **kwargs):
+    pages, last = [], None
+    while True:
+        page = list(itertools.islice(
+            kv.iter_keys(start_after=last, **kwargs), size))
+        if not page:
+            return pages
+        pages.append(page)
+        last = page[-1]
+
+
+def test_iter_keys_pages(tmp_path):
+    kv = KVLocal(str(tmp_path))
+    for key in ("b", "a0", "a/c/d", "a/b", "a-c"):
+        kv.put(key, key.encode())
+    assert _pages(kv, 2) == [["a-c", "a/b"], ["a/c/d", "a0"], ["b"]]
+    assert _pages(kv, 2, prefix="a/") == [["a/b", "a/c/d"]]
+    infos = list(kv.iter_keys(prefix="a/c", with_meta=True))
+    assert [(i.key, i.size) for i in infos] == [("a/c/d", 5)]
+
+    async def main():
+        akv = AsyncKVLocal(str(tmp_path))
+        return [k async for k in akv.iter_keys(prefix="a", start_after="a/b")]
+
+    assert asyncio.run(main()) == ["a/c/d", "a0"]
+
+
+def test_views_and_streams(tmp_path):
+    kv = KVLocal(str(tmp_path))
+    data = bytes(range(256)) * 10
+    kv.put("k", data)
+    kv.put("empty", b"")
+    view = kv.get_view("k")
+    assert view.readonly and view == data
+    assert kv.get_view("empty") == b""
+    with pytest.raises(KeyReadError):
+        kv.get_view("missing")
+
+    stream = kv.get_stream("k", chunk_size=1000)
+    chunks = list(stream)
+    assert [len(c) for c in chunks] == [1000, 1000, 560]
+    assert all(type(c) is bytes for c in chunks)
+    reused = [bytes(c) for c in kv.get_stream("k", chunk_size=1000,
+                                              reuse_buffer=True)]
+    assert b"".join(reused) == data
+    assert stream.checksum.size == len(data)
+
+
+@pytest.mark.parametrize("syscalls", [(), ("copy_file_range",),
+                                      ("copy_file_range", "sendfile")])
+def test_copy_to(tmp_path, monkeypatch, syscalls):
+    # without the syscalls the copy falls back to the next way
+    for name in syscalls:
+        monkeypatch.delattr(os, name, raising=False)
+    src = KVLocal(str(tmp_path / "src"))
+    data = bytes(range(256)) * 1000
+    src.put("k", data)
+    dest = KVLocal(str(tmp_path / "dest"))
+    src.copy_to("k", dest, "a/b")
+    assert dest.get("a/b") == data
+
+
+def test_copy_to_fails_on_a_short_copy(tmp_path, monkeypatch):
+    src = _store(tmp_path / "src")
+    dest = KVLocal(str(tmp_path / "dest"))
+    monkeypatch.setattr(kv_local, "copy_fd", lambda src, dst, size: size - 1)
+    with pytest.raises(KeyWriteError):
+        src.copy_to("key1", dest)
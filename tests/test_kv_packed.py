@@ -0,0 +1,73 @@
+import os
+
+import pytest
+
+from labmachine.io.kv_local import KVLocal
+from labmachine.io import kv_packed
+from labmachine.io.kv_packed import PackedLog
+from labmachine.io.kvspec import KeyWriteError
+
+
+class _Flaky(KVLocal):
+    """ put_stream returns False the first time, like KVGS or KVFiles """
+
+    failures = 1
+
+    def put_stream(self, key, generator):
+        if self.failures:
+            self.failures -= 1
+            list(generator)
+            return False
+        return super().put_stream(key, generator)
+
+
+def test_flush_keeps_failed_segments_dirty(tmp_path):
+    remote = _Flaky(str(tmp_path / "remote"))
+    log = PackedLog(str(tmp_path / "log"), segment_bytes=64, remote=remote)
+    for i in range(10):
+        log.put(f"key{i}", b"x" * 40)
+    sealed = len(log.sealed())
+    assert sealed > 1
+
+    with pytest.raises(KeyWriteError):
+        log.flush()
+    assert len(list(remote.iter_keys())) == sealed - 1
+    assert log.flush() == 1
+    assert len(list(remote.iter_keys())) == sealed
+    assert log.flush() == 0
+    log.close()
+
+
+def test_close_releases_everything_when_flush_fails(tmp_path):
+    remote = _Flaky(str(tmp_path / "remote"))
+    closed = []
+    remote.close = lambda: closed.append(True)
+    log = PackedLog(str(tmp_path / "log"), segment_bytes=64, remote=remote)
+    for i in range(3):
+        log.put(f"key{i}", b"x" * 40)
+
+    with pytest.raises(KeyWriteError):
+        log.close()
+    assert log._fds == {} and closed
+
+
+def test_get_reads_while_the_segment_is_compacted(tmp_path, monkeypatch):
+    log = PackedLog(str(tmp_path / "log"), segment_bytes=128, compact_ratio=0.3)
+    log.put("keep", b"k" * 40)
+    log.put("gone", b"g" * 40)
+    log.delete("gone")
+    log.put("new", b"n" * 40)
+    pread = os.pread
+
+    def _compacting(fd, size, offset):
+        # the segment is rewritten after the offset was resolved
+        monkeypatch.setattr(kv_packed.os, "pread", pread)
+        assert log.compact() > 0
+        assert log._retired == {fd}
+        return pread(fd, size, offset)
+
+    monkeypatch.setattr(kv_packed.os, "pread", _compacting)
+    assert log.get("keep") == b"k" * 40
+    assert log._readers == {} and log._retired == set()
+    assert log.get("keep") == b"k" * 40
+    log.close()
@@ -0,0 +1,93 @@
+import time
+
+import pytest
+
+from labmachine.io.kv_local import KVLocal
+from labmachine.io.kv_writebehind import WriteBehindKV
+from labmachine.io.kvspec import KeyWriteError
+
+
+class _Broken(KVLocal):
+    """ put_many raises the first `failures` times, put_stream returns False """
+
+    failures = 1
+    calls = []
+
+    def put_many(self, items, workers=None):
+        _Broken.calls.append(time.monotonic())
+        if _Broken.failures:
+            _Broken.failures -= 1
+            raise RuntimeError("connection reset")
+        return super().put_many(items, workers)
+
+    def put_stream(self, key, generator):
+        list(generator)
+        return False
+
+
+def _store(tmp_path, **opts):
+    kv = WriteBehindKV(str(tmp_path / "store"), {
+        "store_class": "labmachine.io.kv_local.KVLocal",
+        "flush_workers": 1, "retry_backoff": 0.01, **opts})
+    kv.store = _Broken(str(tmp_path / "store"))
+    return kv
+
+
+def test_batch_errors_are_retried(tmp_path):
+    _Broken.failures = 1
+    kv = _store(tmp_path)
+    kv.put("a", b"1")
+    kv.flush(timeout=10)
+    assert kv.store.get("a") == b"1"
+
+    _Broken.failures = 10
+    kv.put("b", b"2")
+    with pytest.raises(KeyWriteError):
+        kv.flush(timeout=10)
+    # the worker is still running
+    _Broken.failures = 0
+    kv.put("c", b"3")
+    kv.flush(timeout=10)
+    assert kv.store.get("c") == b"3"
+    kv.close()
+
+
+def test_spilled_values_are_streamed(tmp_path):
+    _Broken.failures = 0
+    kv = _store(tmp_path, spill_dir=str(tmp_path / "spill"))
+    kv.put("a", b"1")
+    with pytest.raises(KeyWriteError):
+        kv.flush(timeout=10)
+    assert not kv.store.exists("a")
+    kv.close()
+
+
+def test_retries_back_off(tmp_path):
+    _Broken.failures = 2
+    _Broken.calls = []
+    kv = _store(tmp_path, retry_backoff=0.1)
+    kv.put("a", b"1")
+    kv.flush(timeout=10)
+    first, second, third = _Broken.calls
+    assert second - first >= 0.1 and third - second >= 0.2
+    kv.close()
+
+
+def test_spilled_deletes_survive_a_crash(tmp_path):
+    opts = {"store_class": "labmachine.io.kv_local.KVLocal",
+            "spill_dir": str(tmp_path / "spill")}
+    store = str(tmp_path / "store")
+    KVLocal(store).put("a", b"1")
+    # without workers the writes stay pending, like a process that died
+    crashed = WriteBehindKV(store, {**opts, "flush_workers": 0})
+    crashed.put("b", b"2")
+    crashed.delete("a")
+    crashed.put("c", b"3")
+    crashed.delete("c")
+
+    kv = WriteBehindKV(store, opts)
+    kv.flush(timeout=10)
+    assert kv.store.get("b") == b"2"
+    assert not kv.store.exists("a") and not kv.store.exists("c")
+    assert not list((tmp_path / "spill").iterdir())
+    kv.close()
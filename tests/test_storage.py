@@ -0,0 +1,215 @@
+import json
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+pytest.importorskip("google.cloud.storage")
+
+from labmachine import executors  # noqa: E402
+from labmachine.bench.servers import FakeGCSServer  # noqa: E402
+from labmachine.errors import BlobNotFound, BucketNotFound  # noqa: E402
+from labmachine.io import gcs_client  # noqa: E402
+from labmachine.providers.google import storage  # noqa: E402
+from labmachine.providers.google.storage import (  # noqa: E402
+    TRANSFER_BATCH, Storage, _batches, _Manifest)
+
+
+@pytest.fixture
+def server(monkeypatch):
+    with FakeGCSServer(buckets=("b",)) as srv:
+        monkeypatch.setenv("STORAGE_EMULATOR_HOST", srv.url)
+        monkeypatch.setenv("GCE_CREDENTIALS", "x")
+        monkeypatch.setenv("GCE_PROJECT", "p")
+        yield srv
+
+
+def _objects(server):
+    return server.gcs.buckets["b"]
+
+
+def test_set_bucket_checks_the_bucket(server):
+    # bound without a request
+    st = Storage("missing", keyvar="NOPE")
+    with pytest.raises(BucketNotFound):
+        st.set_bucket("missing")
+    assert st.set_bucket("b").name == "b"
+
+
+def test_parallel_put_stream_keeps_content_type(server):
+    st = Storage("b", keyvar="NOPE")
+    st.put_stream("k", iter([b"a" * 300, b"b" * 300]), parallel=True,
+                  part_size=256, content_type="text/plain")
+    assert _objects(server)["k"]["resource"]["contentType"] == "text/plain"
+
+
+def test_batches_group_small_items():
+    items = [("big", 100), ("a", 10), ("b", 10), ("c", 10), ("d", 1)]
+    assert list(_batches(items, 25)) == [["big"], ["a", "b", "c"], ["d"]]
+    small = [(i, 1) for i in range(TRANSFER_BATCH + 1)]
+    assert [len(b) for b in _batches(small, 1000)] == [TRANSFER_BATCH, 1]
+
+
+def test_manifest_resumes_after_an_interrupted_line(tmp_path):
+    fpath = str(tmp_path / "manifest")
+    m = _Manifest(fpath)
+    m.add("gs://b/a", "a", [1, 2])
+    m.close()
+    with open(fpath, "a") as f:
+        f.write('{"object": "gs://b/b", "fi')
+
+    m = _Manifest(fpath)
+    assert m.is_done("gs://b/a", "a", [1, 2])
+    assert not m.is_done("gs://b/a", "a", [1, 3])
+    assert not m.is_done("gs://b/b", "b", 1)
+    m.add("gs://b/b", "b", 1)
+    m.close()
+    assert _Manifest(fpath).is_done("gs://b/b", "b", 1)
+
+
+def test_download_dir_refuses_names_outside_of_it(server, tmp_path):
+    for name in ("p/ok", "p/../../evil", "p/a//b", "p//abs"):
+        server.gcs._store("b", name, b"data", {})
+    st = Storage("b", keyvar="NOPE")
+    out = tmp_path / "out" / "dir"
+
+    report = st.download_dir("p", str(out))
+    assert report.transferred == 1
+    assert sorted(report.errors) == ["../../evil", "/abs", "a//b"]
+    assert (out / "ok").read_bytes() == b"data"
+    assert not (tmp_path / "evil").exists()
+
+    # the manifest is kept while there are errors
+    report = st.download_dir("p", str(out))
+    assert (report.transferred, report.skipped) == (0, 1)
+
+
+def test_parallel_downloads(server, tmp_path):
+    st = Storage("b", keyvar="NOPE")
+    data = bytes(range(256)) * 40
+    st.put_bytes("k", content=data)
+    assert st.get_bytes("k", parallel=True, slice_size=1000) == data
+    chunks = list(st.get_stream("k", parallel=True, slice_size=1000))
+    assert len(chunks) == 11 and b"".join(chunks) == data
+    st.download_file("k", str(tmp_path / "k"), slice_size=1000)
+    assert (tmp_path / "k").read_bytes() == data
+    with pytest.raises(BlobNotFound):
+        st.get_bytes("missing", parallel=True)
+
+
+def test_put_bytes_accepts_buffers(server):
+    st = Storage("b", keyvar="NOPE")
+    for content in (b"data", bytearray(b"data"), memoryview(b"xdatax")[1:5]):
+        blob = st.put_bytes("k", content=content, metadata={"a": "1"},
+                            content_type="text/plain")
+        assert blob.size == 4
+        assert st.get_bytes("k") == b"data"
+    resource = _objects(server)["k"]["resource"]
+    assert resource["metadata"] == {"a": "1"}
+    assert resource["contentType"] == "text/plain"
+
+
+@pytest.fixture
+def versioned(monkeypatch):
+    with FakeGCSServer(buckets=("b",), versioning=True) as srv:
+        monkeypatch.setenv("STORAGE_EMULATOR_HOST", srv.url)
+        monkeypatch.setenv("GCE_CREDENTIALS", "x")
+        monkeypatch.setenv("GCE_PROJECT", "p")
+        yield srv
+
+
+def test_blob_history_gives_the_newest_versions(versioned):
+    st = Storage("b", keyvar="NOPE")
+    for data in (b"v1", b"v2", b"v3"):
+        st.put_bytes("k", content=data)
+    st.put_bytes("k2", content=b"other")
+
+    newest = st.blob_history("k", max_results=2)
+    assert [st.get_bytes("k", b.version) for b in newest] == [b"v3", b"v2"]
+    oldest_first = st.blob_history("k", sorted_=False)
+    assert [st.get_bytes("k", b.version) for b in oldest_first] == \
+        [b"v1", b"v2", b"v3"]
+
+
+def test_recover_blob(versioned):
+    st = Storage("b", keyvar="NOPE")
+    v1 = st.put_bytes("k", content=b"v1").version
+    st.put_bytes("k", content=b"v2")
+    st.delete_blob("k")
+    with pytest.raises(BlobNotFound):
+        st.get_blob("k")
+
+    # the newest noncurrent version is restored
+    st.recover_blob("k")
+    assert st.get_bytes("k") == b"v2"
+    st.recover_blob("k", version=v1)
+    assert st.get_bytes("k") == b"v1"
+    with pytest.raises(BlobNotFound):
+        st.recover_blob("missing")
+
+
+def test_delete_many(server):
+    st = Storage("b", keyvar="NOPE")
+    for ix in range(250):
+        server.gcs._store("b", f"k{ix}", b"data", {})
+    reports = []
+    keys = (f"k{ix}" for ix in range(260))
+    report = st.delete_many(keys, workers=2,
+                            progress=lambda r: reports.append(r.deleted))
+    assert (report.deleted, report.not_found, report.errors) == (250, 10, {})
+    assert len(reports) == 3 and reports[-1] == 250
+    assert not _objects(server)
+
+
+def test_delete_prefix_removes_every_version(versioned):
+    st = Storage("b", keyvar="NOPE")
+    for data in (b"v1", b"v2"):
+        st.put_bytes("p/a", content=data)
+        st.put_bytes("p/b", content=data)
+    st.put_bytes("q", content=b"v1")
+    report = st.delete_prefix("p/")
+    assert (report.deleted, report.errors) == (4, {})
+    assert st.blob_history("p/a") == [] and st.blob_history("p/b") == []
+    assert st.get_bytes("q") == b"v1"
+
+
+@pytest.fixture
+def service_account(tmp_path, monkeypatch):
+    """ a key made up locally, urls are signed without requests """
+    rsa = pytest.importorskip("cryptography.hazmat.primitives.asymmetric.rsa")
+    from cryptography.hazmat.primitives import serialization
+
+    monkeypatch.delenv("STORAGE_EMULATOR_HOST", raising=False)
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = key.private_bytes(serialization.Encoding.PEM,
+                            serialization.PrivateFormat.PKCS8,
+                            serialization.NoEncryption())
+    fpath = tmp_path / "sa.json"
+    fpath.write_text(json.dumps({
+        "type": "service_account", "project_id": "p",
+        "private_key_id": "1", "private_key": pem.decode(),
+        "client_email": "sa@p.iam.gserviceaccount.com", "client_id": "1",
+        "token_uri": "https://oauth2.googleapis.com/token"}))
+    yield str(fpath)
+    gcs_client.clear()
+
+
+def test_sign_many(service_account, monkeypatch):
+    monkeypatch.setattr(storage, "SIGN_CHUNK", 2)
+    executors.configure("test-sign", max_workers=2)
+    try:
+        st = Storage("b", filepath=service_account)
+        keys = [f"k{ix}" for ix in range(5)]
+        urls = st.sign_many(keys, method="PUT", minutes=5,
+                            content_type="text/plain")
+        pooled = st.sign_many(keys, executor="test-sign")
+    finally:
+        executors.shutdown()
+    for key, url, other in zip(keys, urls, pooled):
+        parts = urlparse(url)
+        query = parse_qs(parts.query)
+        assert parts.path == f"/b/{key}" == urlparse(other).path
+        assert query["X-Goog-Expires"] == ["300"]
+        assert query["X-Goog-Credential"][0].startswith("sa@p.iam")
+        assert "X-Goog-Signature" in query
+    signed = parse_qs(urlparse(urls[0]).query)["X-Goog-SignedHeaders"][0]
+    assert "content-type" in signed
@@ -0,0 +1,48 @@
+from labmachine.io.kv_local import KVLocal
+from labmachine.io.kvspec import KeyInfo, KeyWriteError
+from labmachine.io.sync import sync
+
+
+class _Rejecting(KVLocal):
+    """ put_stream returns False, like KVGS on a checksum mismatch """
+
+    def put_stream(self, key, generator):
+        list(generator)
+        return False
+
+
+def test_push_reports_rejected_uploads(tmp_path):
+    local = tmp_path / "local"
+    local.mkdir()
+    (local / "a.txt").write_bytes(b"a")
+    store = _Rejecting(str(tmp_path / "remote"))
+
+    rsp = sync(str(local), store, "p")
+    assert rsp.transferred == []
+    assert isinstance(rsp.errors["a.txt"], KeyWriteError)
+
+    rsp = sync(str(local), KVLocal(str(tmp_path / "remote")), "p")
+    assert rsp.transferred == ["a.txt"] and not rsp.errors
+
+
+class _Listing(KVLocal):
+    """ lists keys that could escape the local dir """
+
+    def iter_keys(self, prefix=None, page_size=1000, start_after=None,
+                  with_meta=False):
+        yield from super().iter_keys(prefix, page_size, start_after, with_meta)
+        for key in ("p/../x", "p/a//b"):
+            yield KeyInfo(key, size=1) if with_meta else key
+
+
+def test_pull_refuses_keys_outside_of_the_dir(tmp_path):
+    store = _Listing(str(tmp_path / "remote"))
+    store.put("p/ok", b"ok")
+    local = tmp_path / "out" / "local"
+
+    rsp = sync(str(local), store, "p", direction="pull")
+    assert rsp.transferred == ["ok"]
+    assert sorted(rsp.errors) == ["../x", "a//b"]
+    assert all(isinstance(e, ValueError) for e in rsp.errors.values())
+    assert (local / "ok").read_bytes() == b"ok"
+    assert not (tmp_path / "out" / "x").exists()
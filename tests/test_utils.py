@@ -0,0 +1,56 @@
+import asyncio
+
+import pytest
+
+from labmachine.utils import iter_from_async, iter_in_thread
+
+
+def test_iter_in_thread_pauses_and_stops_the_producer():
+    produced = []
+    closed = []
+
+    def _gen():
+        try:
+            for i in range(100):
+                produced.append(i)
+                yield i
+        finally:
+            closed.append(True)
+
+    async def main():
+        gen = iter_in_thread(_gen, maxsize=2)
+        assert await gen.__anext__() == 0
+        await asyncio.sleep(0.2)
+        # two items queued and one waiting for room
+        assert len(produced) <= 4
+        await gen.aclose()
+        await asyncio.sleep(0.2)
+
+    asyncio.run(main())
+    assert closed and len(produced) <= 4
+
+
+def test_iter_in_thread_raises_the_errors():
+    def _gen():
+        yield 1
+        raise OSError("reset")
+
+    async def main():
+        return [i async for i in iter_in_thread(_gen)]
+
+    with pytest.raises(OSError):
+        asyncio.run(main())
+
+
+def test_iter_from_async():
+    async def _agen():
+        for i in range(3):
+            await asyncio.sleep(0)
+            yield i
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, lambda: list(iter_from_async(_agen(), loop)))
+
+    assert asyncio.run(main()) == [0, 1, 2]